@@ -65,10 +65,12 @@ const HomeScreen = ({ navigation }) => {
 
     setLoading(true);
     try {
-      const currentTime = new Date().toTimeString().slice(0, 5); // HH:MM format
+      const now = new Date();
+      const currentTime = now.toTimeString().slice(0, 5); // HH:MM format
       const userContext = {
         filters: filters,
         time: currentTime,
+        day: (now.getDay() + 6) % 7, // 0 = Monday, like the backend
         location: [userLocation.latitude, userLocation.longitude],
         urgency: urgency,
       };
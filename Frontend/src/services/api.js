@@ -1,10 +1,31 @@
 import axios from 'axios';
+import AsyncStorage from '@react-native-async-storage/async-storage';
 
 // const API_BASE_URL = 'http://localhost:5000/api'; //Backend URL^^ add later... somebody
 const API_BASE_URL = 'http://192.168.1.87:5001/api'; 
+const USER_ID_KEY = 'userId';
+
+// A random id made on first launch and kept on the device, so the backend
+// can keep this user's visit history apart from everyone else's.
+let userIdPromise = null;
+export const getUserId = () => {
+  if (!userIdPromise) {
+    userIdPromise = AsyncStorage.getItem(USER_ID_KEY).then(async (stored) => {
+      if (stored) return stored;
+      const id = `${Date.now().toString(36)}-${Math.random().toString(36).slice(2, 12)}`;
+      await AsyncStorage.setItem(USER_ID_KEY, id);
+      return id;
+    });
+  }
+  return userIdPromise;
+};
+
 export const getTopBathrooms = async (userContext) => {
   try {
-    const response = await axios.post(`${API_BASE_URL}/top-bathrooms`, userContext);
+    const response = await axios.post(`${API_BASE_URL}/top-bathrooms`, {
+      ...userContext,
+      user_id: await getUserId(),
+    });
     return response.data;
   } catch (error) {
     console.error('Error fetching bathrooms:', error);
@@ -12,9 +33,36 @@ export const getTopBathrooms = async (userContext) => {
   }
 };
 
+// Bathrooms inside bbox ([south, west, north, east]) for offline use.
+// Pass the version of the last sync as `since` to get only what changed;
+// resolves to null when that copy is still current.
+export const syncBathrooms = async (bbox, since) => {
+  try {
+    const response = await axios.get(`${API_BASE_URL}/sync`, {
+      params: since ? { bbox: bbox.join(','), since } : { bbox: bbox.join(',') },
+      validateStatus: (status) => status === 200 || status === 304,
+    });
+    return response.status === 304 ? null : response.data;
+  } catch (error) {
+    console.error('Error syncing bathrooms:', error);
+    throw error;
+  }
+};
+
+// Applies a sync payload to a cache of { version, bathrooms: { [id]: bathroom } }.
+export const applySync = (cache, payload) => {
+  const bathrooms = payload.full ? {} : { ...cache.bathrooms };
+  payload.removed.forEach((id) => { delete bathrooms[id]; });
+  payload.bathrooms.forEach((bathroom) => { bathrooms[bathroom.id] = bathroom; });
+  return { version: payload.version, bathrooms };
+};
+
 export const recordVisit = async (bathroomId) => {
   try {
-    await axios.post(`${API_BASE_URL}/record-visit`, { bathroom_id: bathroomId });
+    await axios.post(`${API_BASE_URL}/record-visit`, {
+      bathroom_id: bathroomId,
+      user_id: await getUserId(),
+    });
   } catch (error) {
     console.error('Error recording visit:', error);
   }
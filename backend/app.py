@@ -1,43 +1,733 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify
 from flask_cors import CORS
+from collections import deque
+import itertools
 import json
-from ranking import rank_bathrooms
+import math
+import os
+import signal
+import time
+import numpy as np
+from changelog import Changelog, changelog_path, snap_bbox
+from columnar import (RankedStream, box_distances, rank_batch, rank_nearby, rank_rows, region_bounds,
+                      region_candidates)
+from crowd_reports import CROWD_LEVELS, CrowdReports
+from dataset_store import default_data_path, iter_dataset
+from history_store import HistoryStore
+from metrics import COUNT_BUCKETS, Registry, Sampler
+from pagination import StreamSessions, decode_cursor, encode_cursor, query_hash
+from ranking import KM_PER_DEGREE
+from records import PROJECTIONS
+from result_cache import ResultCache
+from review_store import MAX_RATING, MIN_RATING, ReviewStore
+from scoring import ScoringModels
+from shards import ShardRouter, default_manifest_path
+from snapshot import SnapshotManager
+from tiles import TileSet, rank_from_tiles
+
+DATA_PATH = default_data_path('data')
+DATASET_POLL_SECONDS = 2.0
+HISTORY_PATH = 'data/history.sqlite3'
+REVIEWS_PATH = 'data/reviews.sqlite3'
+CROWD_PATH = 'data/crowd.sqlite3'
+TILES_PATH = 'data/tiles.npz'  # written by scripts/build_tiles.py
+# weight sets requests can be scored with, see scoring.ScoringModels
+SCORING_MODELS_PATH = 'scoring_models.json'
+# written by scripts/shard_dataset.py; when present it replaces DATA_PATH
+SHARDS_MANIFEST = default_manifest_path('data')
+# bytes of shard files kept loaded; JSON shards take several times that in memory
+SHARD_MEMORY_BUDGET = 512 * 1024 * 1024
+HISTORY_HALF_LIFE_DAYS = None  # e.g. 30 to let old visits fade out
+# visits to a bathroom not repeated for this long are forgotten
+HISTORY_MAX_AGE_DAYS = 365
+ANONYMOUS_USER = 'anonymous'
+MAX_BATCH_CONTEXTS = 100
+TOP_K = 10
+CACHE_MAX_ENTRIES = 4096
+CACHE_TTL_SECONDS = 120
+CACHE_CELL_SIZE = 0.002  # degrees, roughly 200m
+CACHE_TIME_BUCKET = 15  # minutes
+MAX_PAGE_SIZE = 50
+STREAM_SESSIONS = 256
+STREAM_TTL_SECONDS = 60
+# written by save_versioned() in the dataset scripts
+CHANGELOG_PATH = changelog_path(DATA_PATH)
+# sync bboxes are widened to this grid (degrees) so nearby viewports share payloads
+SYNC_BBOX_STEP = 0.01
+MAX_SYNC_RECORDS = 20000
+# send "X-Profile: 1" to sample one request; off unless the env var is set
+PROFILING_ENABLED = os.environ.get('BATHROOM_PROFILING') == '1'
+PROFILE_HEADER = 'X-Profile'
+MAX_PROFILES = 20
+# pid of serve.py's master when running preforked; it reloads the dataset
+# and re-forks the workers, so /api/reload asks it to
+prefork_master = None
 
 app = Flask(__name__)
 CORS(app)
-user_history = {}
-with open('data/bathrooms.json') as f:
-    bathrooms = json.load(f)
+history = HistoryStore(HISTORY_PATH, half_life_days=HISTORY_HALF_LIFE_DAYS, max_age_days=HISTORY_MAX_AGE_DAYS)
+history.start()
+result_cache = ResultCache(CACHE_MAX_ENTRIES, CACHE_TTL_SECONDS, CACHE_CELL_SIZE, CACHE_TIME_BUCKET)
+reviews = ReviewStore(REVIEWS_PATH)
+reviews.start()
+stream_sessions = StreamSessions(STREAM_SESSIONS, STREAM_TTL_SECONDS)
+# cached results can lag an expiring report by the cache TTL
+crowd_reports = CrowdReports(CROWD_PATH)
+crowd_reports.start()
+scoring_models = ScoringModels.load(SCORING_MODELS_PATH) if os.path.exists(SCORING_MODELS_PATH) else ScoringModels()
+changelog = Changelog(CHANGELOG_PATH)
+if changelog.version() == 0 and os.path.exists(DATA_PATH):
+    # first run against a dataset written before the changelog existed
+    changelog.commit(iter_dataset(DATA_PATH), 'app startup')
+
+def load_tiles(snapshot):
+    if os.path.exists(TILES_PATH):
+        try:
+            return TileSet.load(TILES_PATH, snapshot.columns, snapshot.index, snapshot.version, top_k=TOP_K)
+        except (OSError, ValueError, KeyError) as e:
+            app.logger.warning('ignoring %s: %s', TILES_PATH, e)
+    return TileSet(snapshot.columns, snapshot.index, snapshot.version, top_k=TOP_K)
+
+def swap_dataset(old, new):
+    global tiles
+    # cached rows belong to one snapshot; the version in the cache key keeps
+    # racing requests from caching old rows under the new snapshot
+    result_cache.clear()
+    stream_sessions.clear()
+    tiles = tiles.rebase(new.columns, new.index, new.version)
+
+def shard_evicted(name):
+    # entries whose search reached the shard can't be checked against it
+    # any more once it's gone
+    shard = shards.shards.get(name)
+    if shard is not None:
+        result_cache.invalidate_where(
+            lambda entry: shard.distance(*entry.context['location'])
+            <= shards.search_radius(entry.context) + cell_half_diagonal())
+
+def shards_changed():
+    result_cache.clear()
+    stream_sessions.clear()
+
+if os.path.exists(SHARDS_MANIFEST):
+    shards = ShardRouter(SHARDS_MANIFEST, SHARD_MEMORY_BUDGET, on_evict=shard_evicted, on_change=shards_changed)
+    dataset = tiles = None
+else:
+    shards = None
+    dataset = SnapshotManager(DATA_PATH, on_swap=swap_dataset)
+    tiles = load_tiles(dataset.current)
+    dataset.start_polling(DATASET_POLL_SECONDS)
+
+metrics = Registry()
+REQUESTS = metrics.counter('bathroom_requests_total', 'Requests by endpoint and status code.', ('endpoint', 'status'))
+REQUEST_SECONDS = metrics.histogram('bathroom_request_seconds', 'Request latency by endpoint.', ('endpoint',))
+STAGE_SECONDS = metrics.histogram('bathroom_stage_seconds', 'Time in filter, score and serialize stages.', ('endpoint', 'stage'))
+CANDIDATES = metrics.histogram('bathroom_candidates', 'Candidate rows before and after filtering.', ('phase',), COUNT_BUCKETS)
+CACHE_LOOKUPS = metrics.counter('bathroom_cache_lookups_total', 'Result cache lookups.', ('result',))
+TILE_LOOKUPS = metrics.counter('bathroom_tile_lookups_total', 'Unfiltered requests served from tiles or not.', ('result',))
+REVIEWS = metrics.counter('bathroom_reviews_total', 'Reviews submitted.')
+CROWD_REPORTS = metrics.counter('bathroom_crowd_reports_total', 'Crowd reports by reported level.', ('level',))
+SYNC_REQUESTS = metrics.counter('bathroom_sync_requests_total', 'Sync requests by outcome.', ('result',))
+SCORED_WITH = metrics.counter('bathroom_scoring_model_requests_total', 'Ranked contexts by scoring model.', ('model',))
+metrics.gauge('bathroom_tiles', 'Precomputed top-k tiles in memory.', lambda: {(): len(tiles) if tiles else 0})
+metrics.gauge('bathroom_stream_sessions', 'Paginated result streams kept for later pages.',
+              lambda: {(): len(stream_sessions)})
+metrics.gauge('bathroom_cache_entries', 'Entries in the result cache.',
+              lambda: {(): result_cache.stats()['entries']})
+metrics.gauge('bathroom_dataset_rows', 'Bathrooms in the current snapshot (loaded shards when sharded).',
+              lambda: {(): sum(len(s.bathrooms) for _, s in loaded_snapshots())})
+metrics.gauge('bathroom_dataset_version', 'Version of the current snapshot or shard manifest.',
+              lambda: {(): dataset.current.version if shards is None else shards.version})
+metrics.gauge('bathroom_shards_loaded', 'Shards in memory.', lambda: {(): len(shards.loaded()) if shards else 0})
+metrics.gauge('bathroom_shard_bytes', 'Bytes of shard files loaded.', lambda: {(): shards.loaded_bytes() if shards else 0})
+# (profile id, collapsed stacks), newest last
+profiles = deque(maxlen=MAX_PROFILES)
+profile_ids = itertools.count(1)
+
+@app.before_request
+def start_request():
+    g.started = time.perf_counter()
+    if PROFILING_ENABLED and request.headers.get(PROFILE_HEADER):
+        g.sampler = Sampler().start()
+
+@app.after_request
+def finish_request(response):
+    endpoint = request.endpoint or 'unknown'
+    REQUEST_SECONDS.observe(time.perf_counter() - g.started, endpoint)
+    REQUESTS.inc(endpoint, str(response.status_code))
+    if 'scoring_model' in g:
+        # lets clients attribute what they do next to the weights they saw
+        response.headers['X-Scoring-Model'] = g.scoring_model
+    sampler = g.pop('sampler', None)
+    if sampler is not None:
+        profile_id = next(profile_ids)
+        profiles.append((profile_id, sampler.stop()))
+        response.headers[PROFILE_HEADER] = f'/api/profiles/{profile_id}'
+    return response
+
+@app.teardown_request
+def end_request(exc):
+    # unhandled errors are counted by finish_request, which Flask runs on
+    # the 500 response too; this only stops a sampler a failed request left
+    sampler = g.pop('sampler', None)
+    if sampler is not None:
+        sampler.stop()
+
+def filter_candidates(snapshot, filters, crowd=None):
+    with STAGE_SECONDS.time(request.endpoint, 'filter'):
+        candidates = snapshot.filter_index.resolve(filters, crowd)
+    located = len(snapshot.columns.located)
+    CANDIDATES.observe(located, 'before')
+    CANDIDATES.observe(located if candidates is None else len(candidates), 'after')
+    return candidates
+
+def user_id_of(user_context):
+    return str(user_context.get('user_id') or ANONYMOUS_USER)
+
+def scoring_model_of(user_context):
+    """(the context naming its scoring model, the model); KeyError for an unknown model."""
+    model = scoring_models.choose(user_context, user_id_of(user_context))
+    SCORED_WITH.inc(model.name)
+    return dict(user_context, model=model.name), model
+
+def radius_error(user_context):
+    """Why the context's max_radius_km is invalid, None if it's absent or fine."""
+    radius = user_context.get('max_radius_km')
+    if radius is None:
+        return None
+    if isinstance(radius, bool) or not isinstance(radius, (int, float)) \
+            or not math.isfinite(radius) or radius <= 0:
+        return "'max_radius_km' must be a positive number"
+    return None
+
+def loaded_snapshots():
+    """(shard name or None, snapshot) for the data in memory."""
+    return [(None, dataset.current)] if shards is None else shards.loaded()
+
+def holders(bathroom_id):
+    """(snapshot, row, how cached results name the row) for a bathroom id."""
+    return [(snapshot, row, row if name is None else (name, row))
+            for name, snapshot in loaded_snapshots()
+            for row in snapshot.columns.id_rows.get(bathroom_id, ())]
+
+def known_bathroom(bathroom_id):
+    if shards is None:
+        return bool(dataset.current.columns.id_rows.get(bathroom_id))
+    return bool(shards.shards_of(bathroom_id))
+
+def invalidate_bathroom(bathroom_id, user_id=None):
+    for snapshot, row, member in holders(bathroom_id):
+        crowd = crowd_reports.view(snapshot.columns)
+        ratings = reviews.view(snapshot.columns)
+        result_cache.invalidate_where(
+            lambda entry: row_changes_entry(snapshot, entry, row, user_id, crowd, ratings, member))
+
+def row_changes_entry(snapshot, entry, row, user_id=None, crowd=None, ratings=None, member=None):
+    # an entry changes if the bathroom is among its candidates or, scored
+    # afresh, could now rank somewhere in its region; user_id limits this
+    # to one user's entries
+    if user_id is not None and user_id_of(entry.context) != user_id:
+        return False
+    if (row if member is None else member) in entry.rows:
+        return True
+    context = entry.context
+    columns = snapshot.columns
+    if not snapshot.filter_index.matches(row, context.get('filters', {}), crowd):
+        return False
+    box, minutes = result_cache.region(entry.key)
+    if context.get('max_radius_km') is not None:
+        nearest, _ = box_distances(columns.lat[row], columns.lon[row], box)
+        if nearest > float(context['max_radius_km']) / KM_PER_DEGREE:
+            return False
+    user_history = history.view(user_id_of(context))
+    model = scoring_models.get(context.get('model'))
+    _, upper = region_bounds(columns, context, box, minutes, user_history, np.array([row]), crowd, ratings, model)
+    return upper[0] >= entry.tau
+
+def region_rows(snapshot, user_context, key, user_history, candidates, crowd, ratings, model, reference=None):
+    """The key's region candidates, found for its representative context
+    and cached; None if there are too many to cache."""
+    context = result_cache.representative(user_context, key)
+    box, minutes = result_cache.region(key)
+    rows, tau = region_candidates(snapshot.columns, snapshot.index, context, box, minutes, user_history, TOP_K,
+                                  candidates, crowd, ratings, model, reference)
+    if rows is not None:
+        result_cache.put(key, rows, context, tau)
+    return rows
+
+def fragments_of(snapshot, rows, crowd, ratings, projection='full'):
+    """The rows' pre-encoded records; only rows with a live crowd level
+    or live ratings are encoded afresh."""
+    fragments = [snapshot.fragments.get(row, projection) for row in rows]
+    live = {}
+    if len(crowd):
+        found, pos = crowd.lookup(np.asarray(rows, dtype=np.int64))
+        for i in np.flatnonzero(found):
+            live.setdefault(i, {})['crowd_updates'] = crowd.levels[pos[i]]
+    if len(ratings):
+        found, _ = ratings.lookup(np.asarray(rows, dtype=np.int64))
+        reviewed = {i: snapshot.bathrooms[rows[i]] for i in np.flatnonzero(found)}
+        live_ratings = reviews.live_ratings(reviewed.values())
+        for i, record in reviewed.items():
+            live.setdefault(i, {})['ratings'] = live_ratings[record.get('id')]
+    for i, changes in live.items():
+        record = dict(snapshot.bathrooms[rows[i]], **changes)
+        fragments[i] = snapshot.fragments.encode(record, projection)
+    return fragments
+
+def render(snapshot, rows, crowd, ratings, projection='full'):
+    """JSON array of the rows' records, joined from pre-encoded fragments."""
+    return b'[' + b','.join(fragments_of(snapshot, rows, crowd, ratings, projection)) + b']'
+
+def render_sharded(pairs, projection='full'):
+    """render() for (shard name, row) pairs, in their order."""
+    fragments = [None] * len(pairs)
+    by_shard = {}
+    for i, (name, row) in enumerate(pairs):
+        by_shard.setdefault(name, []).append((i, row))
+    for name, items in by_shard.items():
+        snapshot = shards.snapshot(name)
+        positions, rows = zip(*items)
+        found = fragments_of(snapshot, list(rows), crowd_reports.view(snapshot.columns),
+                             reviews.view(snapshot.columns), projection)
+        for i, fragment in zip(positions, found):
+            fragments[i] = fragment
+    return b'[' + b','.join(fragments) + b']'
+
+def merge_shards(ranked, context, user_history, top_k, model=None):
+    """The top_k (shard name, row) of per-shard ranked rows, ties going to the earlier shard."""
+    found = []
+    for name, rows in ranked.items():
+        snapshot = shards.snapshot(name)
+        rows = np.sort(rows)
+        scores = snapshot.columns.score(context, user_history, rows, crowd_reports.view(snapshot.columns),
+                                        reviews.view(snapshot.columns), model)
+        order = shards.order[name]
+        found.extend((-score, order, int(row), name) for score, row in zip(scores.tolist(), rows))
+    found.sort()
+    return [(name, row) for _, _, row, name in found[:top_k]]
+
+def rank_sharded(context, user_history, top_k, model=None):
+    """(shard name, row) of the top_k across the shards in the search radius.
+
+    `context` must carry max_radius_km; each shard ranks within it and
+    the lists are merged.
+    """
+    ranked = {}
+    for name in shards.route(context):
+        snapshot = shards.snapshot(name)
+        crowd = crowd_reports.view(snapshot.columns)
+        ratings = reviews.view(snapshot.columns)
+        candidates = filter_candidates(snapshot, context.get('filters', {}), crowd)
+        with STAGE_SECONDS.time(request.endpoint, 'score'):
+            ranked[name] = rank_nearby(snapshot.columns, snapshot.index, context, user_history, top_k,
+                                       candidates, crowd, ratings, model)
+    with STAGE_SECONDS.time(request.endpoint, 'score'):
+        return merge_shards(ranked, context, user_history, top_k, model)
+
+def sharded_context(user_context):
+    context = dict(user_context)
+    if context.get('max_radius_km') is None:
+        context['max_radius_km'] = shards.search_radius(context) * KM_PER_DEGREE
+    return context
+
+def cell_half_diagonal():
+    return result_cache.cell_size * math.sqrt(2) / 2
+
+def region_pairs(user_context, key, user_history, model=None):
+    """region_rows() across the shards any location in the key's cell
+    searches, as (shard name, row) pairs; None if there are too many."""
+    context = result_cache.representative(user_context, key)
+    box, minutes = result_cache.region(key)
+    reach = dict(context, max_radius_km=float(context['max_radius_km']) + cell_half_diagonal() * KM_PER_DEGREE)
+    pairs, taus = [], []
+    for name in shards.route(reach):
+        snapshot = shards.snapshot(name)
+        crowd = crowd_reports.view(snapshot.columns)
+        ratings = reviews.view(snapshot.columns)
+        candidates = filter_candidates(snapshot, context.get('filters', {}), crowd)
+        with STAGE_SECONDS.time(request.endpoint, 'score'):
+            rows, tau = region_candidates(snapshot.columns, snapshot.index, context, box, minutes, user_history,
+                                          TOP_K, candidates, crowd, ratings, model)
+        if rows is None:
+            return None
+        pairs.extend((name, int(row)) for row in rows)
+        taus.append(tau)
+    # a row can only rank if it beats the loosest shard's threshold
+    result_cache.put(key, pairs, context, min(taus, default=-np.inf))
+    return pairs
+
+def top_sharded(user_context, key, model=None):
+    """The top (shard name, row) pairs for a sharded_context(), from the
+    key's cached candidates where there are few enough of them."""
+    user_history = history.view(user_id_of(user_context))
+    pairs = result_cache.get(key)
+    CACHE_LOOKUPS.inc('miss' if pairs is None else 'hit')
+    if pairs is None:
+        pairs = region_pairs(user_context, key, user_history, model)
+    if pairs is None:
+        return rank_sharded(user_context, user_history, TOP_K, model)
+    ranked = {}
+    for name, row in pairs:
+        ranked.setdefault(name, []).append(row)
+    with STAGE_SECONDS.time(request.endpoint, 'score'):
+        for name, rows in ranked.items():
+            snapshot = shards.snapshot(name)
+            ranked[name] = rank_rows(snapshot.columns, user_context, user_history, np.array(rows, dtype=np.int64),
+                                     TOP_K, crowd_reports.view(snapshot.columns), reviews.view(snapshot.columns),
+                                     model)
+        return merge_shards(ranked, user_context, user_history, TOP_K, model)
+
+def top_bathrooms_sharded(user_context, projection, model):
+    # no tiles or stream sessions here: each query ranks its shards afresh
+    # unless cached, and later pages rank offset + limit and slice
+    shards.check()
+    user_context = sharded_context(user_context)
+    paged = 'limit' in user_context or 'cursor' in user_context
+    limit, offset = TOP_K, 0
+    key = result_cache.key(user_context, shards.version)
+    if paged:
+        limit = user_context.get('limit', TOP_K)
+        if isinstance(limit, bool) or not isinstance(limit, int) or not 1 <= limit <= MAX_PAGE_SIZE:
+            return jsonify({"error": f"'limit' must be an integer from 1 to {MAX_PAGE_SIZE}"}), 400
+        if user_context.get('cursor') is not None:
+            try:
+                _, offset, cursor_query = decode_cursor(str(user_context['cursor']))
+            except ValueError:
+                return jsonify({"error": "invalid cursor"}), 400
+            if cursor_query != query_hash(key):
+                return jsonify({"error": "cursor belongs to a different query"}), 400
+    if paged:
+        pairs = rank_sharded(user_context, history.view(user_id_of(user_context)), offset + limit + 1, model)
+        page = pairs[offset:offset + limit]
+        more = len(pairs) > offset + limit
+        next_cursor = encode_cursor(None, offset + len(page), query_hash(key)) if more else None
+        with STAGE_SECONDS.time(request.endpoint, 'serialize'):
+            return json_response(b'{"results":' + render_sharded(page, projection)
+                                 + b',"next_cursor":' + json.dumps(next_cursor).encode() + b'}')
+    pairs = top_sharded(user_context, key, model)
+    with STAGE_SECONDS.time(request.endpoint, 'serialize'):
+        return json_response(render_sharded(pairs, projection))
+
+def json_response(body):
+    return Response(body, mimetype='application/json')
+
+def projection_of(user_context):
+    projection = user_context.get('fields', 'full')
+    return projection if projection in PROJECTIONS else None
 
 @app.route('/api/top-bathrooms', methods=['POST'])
 def get_top_bathrooms():
     user_context = request.json
-    filters = user_context.get('filters', {}) 
-    filtered = []
-    print(user_context)
-    for bathroom in bathrooms:
-        if 'amenities' in filters:
-            required = set(filters['amenities'])
-            if not required.issubset(set(bathroom.get('amenities', []))):
-                continue
-        if 'crowd' in filters:
-            if bathroom.get('crowd_updates', 'medium') != filters['crowd']:
-                continue
-        filtered.append(bathroom)
-    top = rank_bathrooms(filtered, user_context, user_history)
-    return jsonify(top)
+    filters = user_context.get('filters', {})
+    app.logger.debug('top-bathrooms %s', user_context)
+    projection = projection_of(user_context)
+    if projection is None:
+        return jsonify({"error": f"'fields' must be one of {', '.join(PROJECTIONS)}"}), 400
+    error = radius_error(user_context)
+    if error is not None:
+        return jsonify({"error": error}), 400
+    try:
+        user_context, model = scoring_model_of(user_context)
+    except KeyError:
+        return jsonify({"error": f"unknown scoring model {user_context.get('model')!r}"}), 400
+    g.scoring_model = model.name
+    user_context = result_cache.exact(user_context)
+    if shards is not None:
+        return top_bathrooms_sharded(user_context, projection, model)
+    if 'limit' in user_context or 'cursor' in user_context:
+        return top_bathrooms_page(user_context, projection, model)
+    snapshot = dataset.current
+    crowd = crowd_reports.view(snapshot.columns)
+    ratings = reviews.view(snapshot.columns)
+    key = result_cache.key(user_context, snapshot.version)
+    user_history = history.view(user_id_of(user_context))
+    rows = result_cache.get(key)
+    CACHE_LOOKUPS.inc('miss' if rows is None else 'hit')
+    with STAGE_SECONDS.time(request.endpoint, 'score'):
+        if rows is not None:
+            rows = rank_rows(snapshot.columns, user_context, user_history, rows, TOP_K, crowd, ratings, model)
+        else:
+            candidates = filter_candidates(snapshot, filters, crowd)
+            current_tiles = tiles
+            # tiles hold the default weights' top rows
+            if candidates is None and user_context.get('max_radius_km') is None and model.is_default \
+                    and current_tiles.version == snapshot.version:
+                rows = rank_from_tiles(current_tiles, snapshot.columns, user_context, user_history, TOP_K,
+                                       crowd, ratings)
+                TILE_LOOKUPS.inc('miss' if rows is None else 'hit')
+            if rows is None:
+                found = region_rows(snapshot, user_context, key, user_history, candidates, crowd, ratings, model)
+                if found is None:
+                    rows = rank_nearby(snapshot.columns, snapshot.index, user_context, user_history, TOP_K,
+                                       candidates, crowd, ratings, model)
+                else:
+                    rows = rank_rows(snapshot.columns, user_context, user_history, found, TOP_K,
+                                     crowd, ratings, model)
+    with STAGE_SECONDS.time(request.endpoint, 'serialize'):
+        return json_response(render(snapshot, rows.tolist(), crowd, ratings, projection))
+
+def top_bathrooms_page(user_context, projection, model):
+    # {"results": [...], "next_cursor": ...}; the cursor names a stream
+    # session, the offset of the next page and the query it belongs to
+    limit = user_context.get('limit', TOP_K)
+    if isinstance(limit, bool) or not isinstance(limit, int) or not 1 <= limit <= MAX_PAGE_SIZE:
+        return jsonify({"error": f"'limit' must be an integer from 1 to {MAX_PAGE_SIZE}"}), 400
+    snapshot = dataset.current
+    key = result_cache.key(user_context, snapshot.version)
+    query = query_hash(key)
+    session, offset = None, 0
+    if user_context.get('cursor') is not None:
+        try:
+            session_id, offset, cursor_query = decode_cursor(str(user_context['cursor']))
+        except ValueError:
+            return jsonify({"error": "invalid cursor"}), 400
+        if cursor_query != query:
+            return jsonify({"error": "cursor belongs to a different query"}), 400
+        session = stream_sessions.get(session_id, snapshot.version)
+    crowd = crowd_reports.view(snapshot.columns)
+    ratings = reviews.view(snapshot.columns)
+    if session is None:
+        candidates = filter_candidates(snapshot, user_context.get('filters', {}), crowd)
+        stream = RankedStream(snapshot.columns, snapshot.index, user_context,
+                              history.view(user_id_of(user_context)), candidates, crowd, ratings, model)
+        session_id, session = stream_sessions.start(stream, snapshot.version)
+    with session.lock, STAGE_SECONDS.time(request.endpoint, 'score'):
+        rows = session.stream.page(offset, limit).tolist()
+        more = not session.stream.done or offset + len(rows) < len(session.stream.ranked)
+    next_cursor = encode_cursor(session_id, offset + len(rows), query) if more and rows else None
+    with STAGE_SECONDS.time(request.endpoint, 'serialize'):
+        return json_response(b'{"results":' + render(snapshot, rows, crowd, ratings, projection)
+                             + b',"next_cursor":' + json.dumps(next_cursor).encode() + b'}')
+
+@app.route('/api/top-bathrooms/batch', methods=['POST'])
+def get_top_bathrooms_batch():
+    contexts = (request.json or {}).get('contexts')
+    if not isinstance(contexts, list) or len(contexts) > MAX_BATCH_CONTEXTS:
+        return jsonify({"error": f"expected 'contexts' with at most {MAX_BATCH_CONTEXTS} entries"}), 400
+    projection = projection_of(request.json)
+    if projection is None:
+        return jsonify({"error": f"'fields' must be one of {', '.join(PROJECTIONS)}"}), 400
+    models = []
+    for i, user_context in enumerate(contexts):
+        if not isinstance(user_context, dict):
+            return jsonify({"error": f"context {i} is not an object"}), 400
+        error = radius_error(user_context)
+        if error is not None:
+            return jsonify({"error": f"context {i}: {error}"}), 400
+        try:
+            user_context, model = scoring_model_of(user_context)
+        except KeyError:
+            return jsonify({"error": f"unknown scoring model {user_context.get('model')!r}"}), 400
+        contexts[i] = result_cache.exact(user_context)
+        models.append(model)
+    # the batch shares region candidates with /api/top-bathrooms and ranks
+    # each context at its own location and time, so each list is the one
+    # it returns
+    if shards is not None:
+        shards.check()
+        results = []
+        for user_context, model in zip(contexts, models):
+            user_context = sharded_context(user_context)
+            pairs = top_sharded(user_context, result_cache.key(user_context, shards.version), model)
+            results.append(render_sharded(pairs, projection))
+        return json_response(b'[' + b','.join(results) + b']')
+    snapshot = dataset.current
+    crowd = crowd_reports.view(snapshot.columns)
+    ratings = reviews.view(snapshot.columns)
+    keys = [result_cache.key(user_context, snapshot.version) for user_context in contexts]
+    found = {}
+    # missed keys with the same filters, user and model share one candidate
+    # set and one scan for the rows their thresholds are taken from
+    groups = {}
+    for user_context, key in zip(contexts, keys):
+        if key in found:
+            continue
+        found[key] = result_cache.get(key)
+        CACHE_LOOKUPS.inc('miss' if found[key] is None else 'hit')
+        if found[key] is None:
+            group = (json.dumps(user_context.get('filters', {}), sort_keys=True), user_id_of(user_context),
+                     user_context['model'])
+            groups.setdefault(group, []).append((key, user_context))
+    with STAGE_SECONDS.time(request.endpoint, 'score'):
+        for (_, user_id, model_name), members in groups.items():
+            model = scoring_models.get(model_name)
+            user_history = history.view(user_id)
+            candidates = filter_candidates(snapshot, members[0][1].get('filters', {}), crowd)
+            references = rank_batch(snapshot.columns, snapshot.index,
+                                    [result_cache.representative(context, key) for key, context in members],
+                                    user_history, candidates=candidates, crowd=crowd, ratings=ratings, model=model)
+            for (key, context), reference in zip(members, references):
+                found[key] = region_rows(snapshot, context, key, user_history, candidates, crowd, ratings, model,
+                                         reference)
+        ranked = []
+        for user_context, key, model in zip(contexts, keys, models):
+            user_history = history.view(user_id_of(user_context))
+            if found[key] is None:
+                candidates = filter_candidates(snapshot, user_context.get('filters', {}), crowd)
+                rows = rank_nearby(snapshot.columns, snapshot.index, user_context, user_history, TOP_K,
+                                   candidates, crowd, ratings, model)
+            else:
+                rows = rank_rows(snapshot.columns, user_context, user_history, found[key], TOP_K,
+                                 crowd, ratings, model)
+            ranked.append(rows.tolist())
+    with STAGE_SECONDS.time(request.endpoint, 'serialize'):
+        return json_response(b'[' + b','.join(render(snapshot, rows, crowd, ratings, projection)
+                                              for rows in ranked) + b']')
 
 @app.route('/api/record-visit', methods=['POST'])
 def record_visit():
     data = request.json
     bathroom_id = data.get("bathroom_id")
-    print(f"Recording visit for bathroom_id: {bathroom_id}")
+    app.logger.debug('record-visit %s', bathroom_id)
 
     if bathroom_id:
-        user_history[bathroom_id] = user_history.get(bathroom_id, 0) + 1
+        user_id = user_id_of(data)
+        history.record(user_id, bathroom_id)
+        invalidate_bathroom(bathroom_id, user_id)
 
     return jsonify({"status": "ok"})
 
+@app.route('/api/report-crowd', methods=['POST'])
+def report_crowd():
+    data = request.json or {}
+    bathroom_id = data.get("bathroom_id")
+    level = str(data.get("level", "")).lower()
+    if level not in CROWD_LEVELS:
+        return jsonify({"error": f"'level' must be one of {', '.join(CROWD_LEVELS)}"}), 400
+    if not known_bathroom(bathroom_id):
+        return jsonify({"error": "unknown bathroom"}), 404
+    app.logger.debug('report-crowd %s %s', bathroom_id, level)
+    summary = crowd_reports.report(bathroom_id, level)
+    CROWD_REPORTS.inc(level)
+    # unlike a visit this can move the bathroom in any user's list
+    invalidate_bathroom(bathroom_id)
+    return jsonify({"status": "ok", "bathroom_id": bathroom_id, **summary})
+
+@app.route('/api/rate-bathroom', methods=['POST'])
+def rate_bathroom():
+    data = request.json or {}
+    # the app sends {bathroomId, rating}; rating is the overall score
+    bathroom_id = data.get("bathroom_id") or data.get("bathroomId")
+    review = {}
+    for field, value in (("overall", data.get("rating", data.get("overall"))),
+                         ("cleanliness", data.get("cleanliness")),
+                         ("safety", data.get("safety"))):
+        if value is None:
+            continue
+        if isinstance(value, bool) or not isinstance(value, (int, float)) \
+                or not MIN_RATING <= value <= MAX_RATING:
+            return jsonify({"error": f"'{field}' must be a number from {MIN_RATING:g} to {MAX_RATING:g}"}), 400
+        review[field] = value
+    if not review:
+        return jsonify({"error": "expected 'rating', 'cleanliness' or 'safety'"}), 400
+    if not known_bathroom(bathroom_id):
+        return jsonify({"error": "unknown bathroom"}), 404
+    app.logger.debug('rate-bathroom %s %s', bathroom_id, review)
+    summary = reviews.record(bathroom_id, review)
+    REVIEWS.inc()
+    if 'cleanliness' in review or 'safety' in review:
+        invalidate_bathroom(bathroom_id)
+    return jsonify({"status": "ok", "bathroom_id": bathroom_id, "ratings": summary})
+
+def parse_bbox(value):
+    """(south, west, north, east) from 'south,west,north,east'; ValueError if it isn't one."""
+    try:
+        south, west, north, east = (float(v) for v in (value or '').split(','))
+    except ValueError:
+        raise ValueError("'bbox' must be south,west,north,east") from None
+    if not all(math.isfinite(v) for v in (south, west, north, east)) \
+            or not -90 <= south <= north <= 90 or not -180 <= west <= east <= 180:
+        raise ValueError("'bbox' must be south,west,north,east with south <= north and west <= east")
+    return south, west, north, east
+
+def sync_etag(version, bbox, gzip):
+    return f"v{version}-{'_'.join(f'{v:g}' for v in bbox)}" + ('-gzip' if gzip else '')
+
+@app.route('/api/sync', methods=['GET'])
+def sync():
+    # GET /api/sync?bbox=south,west,north,east[&since=<version>]. The ETag
+    # names the changelog version, the snapped box and the encoding:
+    # If-None-Match on it (or since=the version) gets a 304, an older
+    # `since` gets only what changed in the box
+    try:
+        bbox = snap_bbox(*parse_bbox(request.args.get('bbox')), SYNC_BBOX_STEP)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    since = request.args.get('since', type=int)
+    version = changelog.version()
+    if version == 0:
+        return jsonify({"error": "no dataset changelog yet"}), 503
+    gzip = bool(request.accept_encodings['gzip'])
+    if request.if_none_match.contains(sync_etag(version, bbox, gzip)) or since == version:
+        SYNC_REQUESTS.inc('not_modified')
+        response = Response(status=304)
+        response.headers['Vary'] = 'Accept-Encoding'
+        response.set_etag(sync_etag(version, bbox, gzip))
+        return response
+    with STAGE_SECONDS.time(request.endpoint, 'serialize'):
+        payload = changelog.payload(bbox, since, MAX_SYNC_RECORDS)
+    if payload is None:
+        SYNC_REQUESTS.inc('too_large')
+        return jsonify({"error": f"more than {MAX_SYNC_RECORDS} bathrooms in bbox; sync a smaller area"}), 413
+    version, body, compressed = payload
+    SYNC_REQUESTS.inc('delta' if since is not None and 0 < since < version else 'full')
+    if gzip:
+        response = Response(compressed, mimetype='application/json')
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = Response(body, mimetype='application/json')
+    response.headers['Vary'] = 'Accept-Encoding'
+    # clients keep the payload but revalidate before using it
+    response.headers['Cache-Control'] = 'no-cache'
+    response.set_etag(sync_etag(version, bbox, gzip))
+    return response
+
+@app.route('/api/sync/history', methods=['GET'])
+def sync_history():
+    return jsonify(changelog.history())
+
+@app.route('/api/cache-stats', methods=['GET'])
+def cache_stats():
+    return jsonify(result_cache.stats())
+
+@app.route('/api/shard-stats', methods=['GET'])
+def shard_stats():
+    if shards is None:
+        return jsonify({"error": "dataset is not sharded"}), 404
+    return jsonify(shards.stats())
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/profiles/<int:profile_id>', methods=['GET'])
+def get_profile(profile_id):
+    for known_id, stacks in list(profiles):
+        if known_id == profile_id:
+            return Response(stacks + '\n', mimetype='text/plain')
+    return jsonify({"error": "unknown profile"}), 404
+
+@app.route('/api/reload', methods=['POST'])
+def reload_dataset():
+    if shards is not None:
+        shards.check(force=True)
+        return jsonify({
+            "status": "ok" if shards.last_error is None else "error",
+            "error": shards.last_error,
+            **shards.stats(),
+        })
+    if prefork_master is not None:
+        os.kill(prefork_master, signal.SIGHUP)
+        return jsonify({"status": "reloading", "version": dataset.current.version}), 202
+    snapshot = dataset.reload(force=True)
+    return jsonify({
+        "status": "ok" if dataset.last_error is None else "error",
+        "error": dataset.last_error,
+        "version": snapshot.version,
+        "count": len(snapshot.bathrooms),
+    })
+
 if __name__ == '__main__':
     # app.run(debug=True)
     app.run(host="0.0.0.0", port=5001, debug=True)
\ No newline at end of file
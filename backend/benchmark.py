@@ -0,0 +1,306 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import time
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+
+from columnar import rank_nearby
+from hours import compile_opening_hours
+from ranking import rank_bathrooms
+from snapshot import DatasetSnapshot
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SIZES = [1000, 10000, 100000, 1000000]
+# rank_bathrooms is a Python loop over every row; past this it takes seconds per call
+LEGACY_MAX_ROWS = 100000
+# southern California, where the real dataset lives
+REGION = (33.0, 34.5, -118.6, -117.0)
+AMENITY_RATES = {
+    'wheelchair': 0.55, 'baby_changing': 0.3, 'gender_neutral': 0.25, 'single_stall': 0.2,
+    'sink': 0.8, 'paper_towels': 0.5, 'hand_dryer': 0.4, 'mirror': 0.6,
+}
+HOURS_MIX = {
+    '00:00-23:59': 0.35, '24/7': 0.1, '08:00-22:00': 0.2, '06:00-20:00': 0.1,
+    'Mo-Fr 07:00-19:00; Sa 09:00-17:00; Su off': 0.15, '22:00-02:00': 0.05,
+    'Mo-Su 10:00-14:00, 16:00-21:00': 0.05,
+}
+CROWD_MIX = {'low': 0.35, 'medium': 0.35, 'high': 0.2, 'unknown': 0.1}
+BRANDS = ['Starbucks', 'Target', 'Del Taco', 'Library', 'Park', 'Gas Station', 'Mall', 'Campus', 'Cafe']
+
+
+class SyntheticIds:
+    """Bathroom ids for a SyntheticDataset, made up on access."""
+
+    def __init__(self, count):
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, row):
+        return f'syn-{row}'
+
+    def __iter__(self):
+        return (f'syn-{row}' for row in range(self.count))
+
+
+class SyntheticDataset:
+    """Generated bathrooms held as store-style columns.
+
+    Locations cluster around random town centres, with a sprinkle spread
+    over the whole region; amenities, hours and crowd levels follow the
+    mixes above. Like BathroomStore it exposes column()/header, so
+    snapshots take the arrays as-is, and records are built on access, so
+    10M rows only cost their arrays.
+    """
+
+    def __init__(self, count, seed=0):
+        rng = np.random.default_rng(seed)
+        self.count = count
+        self.ids = SyntheticIds(count)
+        lat_min, lat_max, lon_min, lon_max = REGION
+        towns = max(5, count // 2000)
+        centre_lat = rng.uniform(lat_min, lat_max, towns)
+        centre_lon = rng.uniform(lon_min, lon_max, towns)
+        spread = rng.uniform(0.005, 0.04, towns)
+        # a few big towns, many small ones
+        weights = 1.0 / np.arange(1, towns + 1)
+        town = rng.choice(towns, count, p=weights / weights.sum())
+        self.lat = np.round(centre_lat[town] + rng.normal(0, 1, count) * spread[town], 6)
+        self.lon = np.round(centre_lon[town] + rng.normal(0, 1, count) * spread[town], 6)
+        scattered = rng.random(count) < 0.05
+        self.lat[scattered] = rng.uniform(lat_min, lat_max, scattered.sum())
+        self.lon[scattered] = rng.uniform(lon_min, lon_max, scattered.sum())
+
+        unrated = rng.random(count) < 0.2
+        self.cleanliness = np.where(unrated, 0.0, np.round(rng.uniform(1, 5, count), 1))
+        self.safety = np.where(unrated, 0.0, np.round(rng.uniform(1, 5, count), 1))
+
+        self.amenity_tags = list(AMENITY_RATES)
+        self.amenity_mask = np.zeros(count, dtype=np.uint64)
+        for bit, rate in enumerate(AMENITY_RATES.values()):
+            self.amenity_mask |= (rng.random(count) < rate).astype(np.uint64) << np.uint64(bit)
+
+        self.crowd_levels = list(CROWD_MIX)
+        self.crowd_code = rng.choice(len(CROWD_MIX), count, p=list(CROWD_MIX.values())).astype(np.int16)
+        self.hours = list(HOURS_MIX)
+        self.schedule_id = rng.choice(len(HOURS_MIX), count, p=list(HOURS_MIX.values())).astype(np.int32)
+        self.brand = rng.integers(0, len(BRANDS), count)
+        self.header = {
+            'count': count,
+            'amenity_tags': self.amenity_tags,
+            'crowd_levels': self.crowd_levels,
+            'schedules': [compile_opening_hours(h) for h in self.hours],
+        }
+
+    def column(self, name):
+        return getattr(self, name)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, row):
+        mask = int(self.amenity_mask[row])
+        return {
+            'id': self.ids[row],
+            'name': f'{BRANDS[self.brand[row]]} #{row}',
+            'amenities': [tag for bit, tag in enumerate(self.amenity_tags) if mask >> bit & 1],
+            'location': [float(self.lat[row]), float(self.lon[row])],
+            'ratings': {'cleanliness': float(self.cleanliness[row]), 'safety': float(self.safety[row])},
+            'opening_hours': self.hours[self.schedule_id[row]],
+            'crowd_updates': self.crowd_levels[self.crowd_code[row]],
+        }
+
+    def __iter__(self):
+        for row in range(self.count):
+            yield self[row]
+
+
+def query_contexts(dataset, count, seed=1):
+    """Request bodies like the app sends, placed near where bathrooms are."""
+    rng = np.random.default_rng(seed)
+    rows = rng.integers(0, len(dataset), count)
+    contexts = []
+    for row in rows.tolist():
+        context = {
+            'location': [float(dataset.lat[row] + rng.normal(0, 0.01)),
+                         float(dataset.lon[row] + rng.normal(0, 0.01))],
+            'time': f'{rng.integers(0, 24):02d}:{rng.integers(0, 60):02d}',
+            'day': int(rng.integers(0, 7)),
+            'urgency': str(rng.choice(['low', 'normal', 'high'], p=[0.2, 0.6, 0.2])),
+            'user_id': 'benchmark',
+        }
+        filters = {}
+        if rng.random() < 0.3:
+            filters['amenities'] = [str(t) for t in rng.choice(list(AMENITY_RATES)[:4], rng.integers(1, 3), replace=False)]
+        if rng.random() < 0.1:
+            filters['crowd'] = 'low'
+        if filters:
+            context['filters'] = filters
+        if rng.random() < 0.2:
+            context['max_radius_km'] = float(rng.choice([1, 2, 5]))
+        contexts.append(context)
+    return contexts
+
+
+def summarize(latencies, elapsed):
+    ms = np.array(latencies) * 1000
+    return {
+        'queries': len(latencies),
+        'p50_ms': round(float(np.percentile(ms, 50)), 4),
+        'p95_ms': round(float(np.percentile(ms, 95)), 4),
+        'p99_ms': round(float(np.percentile(ms, 99)), 4),
+        'mean_ms': round(float(ms.mean()), 4),
+        'throughput_qps': round(len(latencies) / elapsed, 2) if elapsed else None,
+    }
+
+
+def timed(run, contexts):
+    latencies = []
+    start = time.perf_counter()
+    for context in contexts:
+        t = time.perf_counter()
+        run(context)
+        latencies.append(time.perf_counter() - t)
+    return summarize(latencies, time.perf_counter() - start)
+
+
+def bench_size(size, args, client, app_module):
+    print(f'--- {size} bathrooms', flush=True)
+    result = {'size': size}
+    start = time.perf_counter()
+    dataset = SyntheticDataset(size, seed=args.seed)
+    result['generate_s'] = round(time.perf_counter() - start, 3)
+
+    # build once traced for peak memory, once untraced for time
+    tracemalloc.start()
+    DatasetSnapshot(dataset, 0)
+    result['build_peak_mb'] = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 1)
+    tracemalloc.stop()
+    start = time.perf_counter()
+    snapshot = DatasetSnapshot(dataset, 0)
+    result['build_s'] = round(time.perf_counter() - start, 3)
+
+    contexts = query_contexts(dataset, args.queries, seed=args.seed + 1)
+    stages = {}
+
+    if size <= args.legacy_max:
+        records = list(dataset)
+        legacy_queries = contexts[:max(1, args.queries // 10)] if size > 10000 else contexts
+
+        def legacy(context):
+            # rank_bathrooms has no filter support; filter first like app.py used to
+            wanted = set(context.get('filters', {}).get('amenities', []))
+            rows = [b for b in records if wanted.issubset(b['amenities'])] if wanted else records
+            return rank_bathrooms(rows, context, {}, 10)
+
+        stages['rank_bathrooms'] = timed(legacy, legacy_queries)
+        del records
+
+    def columnar(context):
+        candidates = snapshot.filter_index.resolve(context.get('filters', {}))
+        return rank_nearby(snapshot.columns, snapshot.index, context, {}, 10, candidates)
+
+    stages['rank_nearby'] = timed(columnar, contexts)
+
+    if client is not None:
+        app_module.dataset.install(dataset)
+
+        def endpoint(context):
+            response = client.post('/api/top-bathrooms', json=context)
+            assert response.status_code == 200, response.status_code
+            return response.get_data()
+
+        stages['flask_top_bathrooms'] = timed(endpoint, contexts)
+        result['cache'] = app_module.result_cache.stats()
+
+    tracemalloc.start()
+    for context in contexts[:20]:
+        columnar(context)
+    result['query_peak_mb'] = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 2)
+    tracemalloc.stop()
+
+    result['stages'] = stages
+    result['max_rss_mb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    for name, stats in stages.items():
+        print(f"{name:<20} p50 {stats['p50_ms']:9.3f}ms  p95 {stats['p95_ms']:9.3f}ms  "
+              f"p99 {stats['p99_ms']:9.3f}ms  {stats['throughput_qps']:>9} q/s", flush=True)
+    print(f"build {result['build_s']}s, build peak {result['build_peak_mb']}MB, "
+          f"max rss {result['max_rss_mb']}MB", flush=True)
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BASE_DIR,
+                              capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(previous_path, results):
+    """Print p50/p95 of this run relative to an earlier results file."""
+    with open(previous_path, 'r', encoding='utf-8') as f:
+        previous = {r['size']: r for r in json.load(f)['results']}
+    print(f'--- compared with {previous_path} (ratio > 1 is slower)')
+    for result in results:
+        old = previous.get(result['size'])
+        if old is None:
+            continue
+        for name, stats in result['stages'].items():
+            before = old['stages'].get(name)
+            if not before:
+                continue
+            ratios = [stats[k] / before[k] if before[k] else float('nan') for k in ('p50_ms', 'p95_ms')]
+            print(f"{result['size']:>9} {name:<20} p50 x{ratios[0]:.2f}  p95 x{ratios[1]:.2f}")
+
+
+def main(args):
+    output = os.path.abspath(args.output)
+    previous = os.path.abspath(args.compare) if args.compare else None
+    client = app_module = None
+    if not args.no_flask:
+        # app.py opens data/ relative to the working directory
+        os.chdir(BASE_DIR)
+        import app as app_module
+        client = app_module.app.test_client()
+
+    results = [bench_size(size, args, client, app_module) for size in args.sizes]
+    report = {
+        'meta': {
+            'timestamp': datetime.utcnow().isoformat() + 'Z',
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'queries': args.queries,
+            'seed': args.seed,
+        },
+        'results': results,
+    }
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f'Wrote {output}')
+    if previous:
+        compare(previous, results)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark ranking on synthetic datasets')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help='Dataset sizes to run (10000000 needs roughly 2GB of RAM)')
+    parser.add_argument('--queries', type=int, default=200, help='Requests per size and stage')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--legacy-max', type=int, default=LEGACY_MAX_ROWS,
+                        help='Largest size to run rank_bathrooms on')
+    parser.add_argument('--no-flask', action='store_true', help='Skip the /api/top-bathrooms runs')
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--compare', help='Earlier results file to compare against')
+    args = parser.parse_args()
+    main(args)
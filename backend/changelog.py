@@ -0,0 +1,249 @@
+import gzip
+import hashlib
+import json
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from dataset_store import encode_record, iter_dataset, save_dataset
+
+CHANGELOG_NAME = 'changelog.sqlite3'
+MAX_CACHED_PAYLOADS = 128
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS versions (
+    version INTEGER PRIMARY KEY,
+    created_at REAL NOT NULL,
+    source TEXT,
+    added INTEGER NOT NULL,
+    changed INTEGER NOT NULL,
+    removed INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS records (
+    id TEXT PRIMARY KEY,
+    version INTEGER NOT NULL,
+    removed INTEGER NOT NULL DEFAULT 0,
+    lat REAL,
+    lon REAL,
+    digest BLOB NOT NULL,
+    body BLOB
+);
+CREATE INDEX IF NOT EXISTS records_lat ON records (lat);
+CREATE INDEX IF NOT EXISTS records_version ON records (version);
+CREATE TABLE IF NOT EXISTS moves (
+    id TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    lat REAL NOT NULL,
+    lon REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS moves_version ON moves (version);
+"""
+
+UPSERT = """
+INSERT INTO records (id, version, removed, lat, lon, digest, body) VALUES (?, ?, 0, ?, ?, ?, ?)
+ON CONFLICT (id) DO UPDATE SET
+    version = excluded.version, removed = 0, lat = excluded.lat, lon = excluded.lon,
+    digest = excluded.digest, body = excluded.body
+"""
+
+
+def changelog_path(dataset_path):
+    return os.path.join(os.path.dirname(dataset_path), CHANGELOG_NAME)
+
+
+def location_of(bathroom):
+    loc = bathroom.get('location')
+    if isinstance(loc, (list, tuple)) and len(loc) >= 2:
+        try:
+            return float(loc[0]), float(loc[1])
+        except (TypeError, ValueError):
+            pass
+    return None, None
+
+
+def save_versioned(path, data, source=None, indent=2):
+    """save_dataset, then record what changed in the dataset's changelog.
+
+    Dataset writes that clients should sync go through here. Returns the
+    changelog version the data is at.
+    """
+    save_dataset(path, data, indent=indent)
+    return commit_version(path, data, source)
+
+
+def commit_version(path, bathrooms=None, source=None):
+    """Record the dataset written at `path` in its changelog; returns the version.
+
+    For scripts that write the file themselves (streamed or replaced in
+    place); without `bathrooms` the file is read back record by record.
+    """
+    changelog = Changelog(changelog_path(path))
+    try:
+        return changelog.commit(iter_dataset(path) if bathrooms is None else bathrooms, source)
+    finally:
+        changelog.close()
+
+
+class Changelog:
+    """Versioned copy of the dataset's records for client sync, in SQLite.
+
+    Each commit diffs a dataset against the stored records and bumps the
+    version if anything was added, changed or removed; every record keeps
+    the version it last changed in and its encoded JSON. Removed records
+    stay as tombstones and earlier locations of moved records are kept,
+    so a client at any earlier version can be told exactly what changed
+    inside its bounding box.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._payloads = OrderedDict()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(SCHEMA)
+        self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+    def version(self):
+        with self._lock:
+            return self._db.execute('SELECT COALESCE(MAX(version), 0) FROM versions').fetchone()[0]
+
+    def commit(self, bathrooms, source=None, now=None):
+        """Record the dataset's contents; returns the new version (unchanged if nothing changed).
+
+        Records without an id can't be synced and are left out; of
+        duplicate ids the first is kept.
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            db = self._db
+            # diff and write in one transaction, so concurrent commits
+            # can't both take the same version
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                version = db.execute('SELECT COALESCE(MAX(version), 0) FROM versions').fetchone()[0] + 1
+                known = {bathroom_id: (digest, lat, lon, removed) for bathroom_id, digest, lat, lon, removed
+                         in db.execute('SELECT id, digest, lat, lon, removed FROM records')}
+                seen = set()
+                upserts, moves = [], []
+                added = changed = 0
+                for bathroom in bathrooms:
+                    bathroom_id = bathroom.get('id')
+                    if bathroom_id is None or str(bathroom_id) in seen:
+                        continue
+                    bathroom_id = str(bathroom_id)
+                    seen.add(bathroom_id)
+                    body = encode_record(bathroom)
+                    digest = hashlib.sha1(body).digest()
+                    lat, lon = location_of(bathroom)
+                    old = known.get(bathroom_id)
+                    if old is not None and not old[3] and old[0] == digest:
+                        continue
+                    if old is None or old[3]:
+                        added += 1
+                    else:
+                        changed += 1
+                        if old[1] is not None and (old[1], old[2]) != (lat, lon):
+                            moves.append((bathroom_id, version, old[1], old[2]))
+                    upserts.append((bathroom_id, version, lat, lon, digest, body))
+                removed = [(version, bathroom_id) for bathroom_id, old in known.items()
+                           if bathroom_id not in seen and not old[3]]
+                if not upserts and not removed:
+                    db.rollback()
+                    return version - 1
+                db.execute('INSERT INTO versions (version, created_at, source, added, changed, removed) '
+                           'VALUES (?, ?, ?, ?, ?, ?)', (version, now, source, added, changed, len(removed)))
+                db.executemany(UPSERT, upserts)
+                db.executemany('UPDATE records SET version = ?, removed = 1, body = NULL WHERE id = ?', removed)
+                db.executemany('INSERT INTO moves (id, version, lat, lon) VALUES (?, ?, ?, ?)', moves)
+                db.commit()
+            except BaseException:
+                db.rollback()
+                raise
+            self._payloads.clear()
+        return version
+
+    def history(self, limit=20):
+        with self._lock:
+            rows = self._db.execute('SELECT version, created_at, source, added, changed, removed FROM versions '
+                                    'ORDER BY version DESC LIMIT ?', (limit,)).fetchall()
+        return [dict(zip(('version', 'created_at', 'source', 'added', 'changed', 'removed'), row)) for row in rows]
+
+    def payload(self, bbox, since=None, max_records=None):
+        """(version, JSON bytes, gzip bytes) for the records in bbox; None past max_records.
+
+        bbox is (south, west, north, east). With `since` (a version the
+        client has) only records changed after it are sent, plus the ids
+        of records that left the box; otherwise everything in it.
+        """
+        version = self.version()
+        full = since is None or not 0 < since <= version
+        key = (version, None if full else since, bbox, max_records)
+        with self._lock:
+            cached = self._payloads.get(key)
+            if cached is not None:
+                self._payloads.move_to_end(key)
+                return cached
+            south, west, north, east = bbox
+            in_box = 'lat BETWEEN ? AND ? AND lon BETWEEN ? AND ?'
+            box = (south, north, west, east)
+            db = self._db
+            # one read transaction, so the rows match the version read
+            db.execute('BEGIN')
+            try:
+                version = db.execute('SELECT COALESCE(MAX(version), 0) FROM versions').fetchone()[0]
+                full = since is None or not 0 < since <= version
+                if full:
+                    count = db.execute(f'SELECT COUNT(*) FROM records WHERE removed = 0 AND {in_box}',
+                                       box).fetchone()[0]
+                    if max_records is not None and count > max_records:
+                        return None
+                    bodies = [body for body, in db.execute(
+                        f'SELECT body FROM records WHERE removed = 0 AND {in_box}', box)]
+                    removed = []
+                else:
+                    # records changed in the box, and those that were in it
+                    # at some version after `since` (moved away or removed)
+                    ids = {bathroom_id for bathroom_id, in db.execute(
+                        f'SELECT id FROM records WHERE version > ? AND {in_box}', (since, *box))}
+                    ids.update(bathroom_id for bathroom_id, in db.execute(
+                        f'SELECT id FROM moves WHERE version > ? AND {in_box}', (since, *box)))
+                    bodies, removed = [], []
+                    for bathroom_id in sorted(ids):
+                        lat, lon, gone, body = db.execute(
+                            'SELECT lat, lon, removed, body FROM records WHERE id = ?', (bathroom_id,)).fetchone()
+                        if gone or lat is None or not (south <= lat <= north and west <= lon <= east):
+                            removed.append(bathroom_id)
+                        else:
+                            bodies.append(body)
+            finally:
+                db.commit()
+        if max_records is not None and len(bodies) > max_records:
+            return None
+        body = (b'{"version":%d,"since":%s,"full":%s,"removed":%s,"bathrooms":['
+                % (version, b'null' if full else b'%d' % since, b'true' if full else b'false',
+                   json.dumps(removed).encode())
+                + b','.join(bodies) + b']}')
+        result = (version, body, gzip.compress(body, compresslevel=6))
+        with self._lock:
+            self._payloads[(version, None if full else since, bbox, max_records)] = result
+            while len(self._payloads) > MAX_CACHED_PAYLOADS:
+                self._payloads.popitem(last=False)
+        return result
+
+
+def snap_bbox(south, west, north, east, step):
+    """bbox widened to a grid of `step` degrees, so nearby viewports share payloads."""
+    return (round(math.floor(south / step) * step, 9), round(math.floor(west / step) * step, 9),
+            round(math.ceil(north / step) * step, 9), round(math.ceil(east / step) * step, 9))
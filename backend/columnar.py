@@ -0,0 +1,612 @@
+import numpy as np
+
+from hours import bathroom_schedule, minute_of_week
+from ranking import CROWD_SCORE, DISTANCE_SCORE_FACTOR, KM_PER_DEGREE, MAX_DISTANCE_SCORE, distance_weight
+from scoring import (
+    AMENITIES, CLEANLINESS, CROWD, DEFAULT_MODEL, FEATURES, HISTORY, OPEN, PROXIMITY, SAFETY,
+    add_weighted,
+)
+
+# filtered candidate sets up to this size skip the spatial search
+DIRECT_SCORE_LIMIT = 20000
+# minute-of-week -> per-schedule open flags, shared by requests in that minute
+OPEN_CACHE_SIZE = 64
+# batches scan their candidates in blocks of about this many scores, and
+# fall back to per-context spatial search above BATCH_SCAN_LIMIT candidates
+BATCH_BLOCK_CELLS = 1 << 20
+BATCH_SCAN_LIMIT = 200000
+# a region's candidate superset is given up on past this many rows
+MAX_REGION_CANDIDATES = 2000
+# slack for float rounding between score bounds and exact scores
+BOUND_EPS = 1e-6
+
+
+def top_k_positions(scores, rows, top_k):
+    """Positions of the top_k scores, ties broken by row like a stable sort."""
+    positions = np.arange(len(scores))
+    if len(scores) > top_k:
+        part = np.argpartition(-scores, top_k - 1)[:top_k]
+        # keep every row tied with the k-th score so ties resolve by row
+        positions = np.flatnonzero(scores >= scores[part].min())
+    order = np.lexsort((rows[positions], -scores[positions]))[:top_k]
+    return positions[order]
+
+
+def top_k_rows(scores, rows, top_k):
+    return rows[top_k_positions(scores, rows, top_k)]
+
+
+class BathroomColumns:
+    """Column arrays over a bathrooms list, built once at load time.
+
+    Scores are a ScoringModel's weights times the feature matrix from
+    features(). With the default model they are identical to
+    `ranking.rank_bathrooms`; each term is added in the same order so the
+    float sums match exactly.
+    """
+
+    def __init__(self, bathrooms):
+        n = len(bathrooms)
+        self.ids = [b.get('id') for b in bathrooms]
+        self.lat = np.full(n, np.nan)
+        self.lon = np.full(n, np.nan)
+        self.cleanliness = np.zeros(n)
+        self.safety = np.zeros(n)
+        # crowd_updates values as written; scoring lowercases them
+        self.crowd_levels = []
+        self.crowd_code = np.zeros(n, dtype=np.int16)
+        self.amenity_bits = {}
+        self.amenity_mask = np.zeros(n, dtype=np.uint64)
+        # rows share interned weekly schedules
+        self.schedules = []
+        self.schedule_id = np.zeros(n, dtype=np.int32)
+
+        crowd_codes = {}
+        schedule_ids = {}
+        for row, bathroom in enumerate(bathrooms):
+            loc = bathroom.get('location')
+            if loc:
+                self.lat[row], self.lon[row] = loc[0], loc[1]
+            ratings = bathroom.get('ratings') or {}
+            self.cleanliness[row] = ratings.get('cleanliness') or 0.0
+            self.safety[row] = ratings.get('safety') or 0.0
+
+            crowd = bathroom.get('crowd_updates', 'medium')
+            if crowd not in crowd_codes:
+                crowd_codes[crowd] = len(self.crowd_levels)
+                self.crowd_levels.append(crowd)
+            self.crowd_code[row] = crowd_codes[crowd]
+
+            mask = 0
+            for tag in bathroom.get('amenities', []):
+                if tag not in self.amenity_bits:
+                    if len(self.amenity_bits) == 64:
+                        raise ValueError('more than 64 distinct amenity tags')
+                    self.amenity_bits[tag] = len(self.amenity_bits)
+                mask |= 1 << self.amenity_bits[tag]
+            self.amenity_mask[row] = mask
+
+            schedule = tuple(tuple(i) for i in bathroom_schedule(bathroom))
+            if schedule not in schedule_ids:
+                schedule_ids[schedule] = len(self.schedules)
+                self.schedules.append(schedule)
+            self.schedule_id[row] = schedule_ids[schedule]
+        self._derive()
+
+    @classmethod
+    def from_store(cls, store):
+        """Columns straight from a BathroomStore's arrays, no records parsed."""
+        self = cls.__new__(cls)
+        self.ids = store.ids
+        for name in ('lat', 'lon', 'cleanliness', 'safety', 'crowd_code', 'amenity_mask', 'schedule_id'):
+            setattr(self, name, store.column(name))
+        self.amenity_bits = {tag: bit for bit, tag in enumerate(store.header['amenity_tags'])}
+        self.crowd_levels = store.header['crowd_levels']
+        self.schedules = [tuple(tuple(i) for i in s) for s in store.header['schedules']]
+        self._derive()
+        return self
+
+    def _derive(self):
+        # lookups computed from the base arrays, whichever way they were loaded
+        self.crowd_points = np.array(
+            [CROWD_SCORE.get(str(level).lower(), 1) for level in self.crowd_levels], dtype=np.float64)
+        # schedule_start/end/owner hold every interval of every schedule
+        intervals = [(start, end, sid) for sid, schedule in enumerate(self.schedules)
+                     for start, end in schedule]
+        intervals = np.array(intervals, dtype=np.int32).reshape(-1, 3)
+        self.schedule_start, self.schedule_end, self.schedule_owner = intervals.T
+        self._open_cache = {}
+        self._id_rows = None
+        self.located = np.flatnonzero(~np.isnan(self.lat))
+        self._static_bounds = {}
+        self.static_bound = self.model_static_bound(DEFAULT_MODEL)
+
+    @property
+    def id_rows(self):
+        # built on first use; stores with millions of rows rarely need it
+        if self._id_rows is None:
+            id_rows = {}
+            for row, bathroom_id in enumerate(self.ids):
+                id_rows.setdefault(bathroom_id, []).append(row)
+            self._id_rows = id_rows
+        return self._id_rows
+
+    def __len__(self):
+        return len(self.ids)
+
+    def amenity_query_mask(self, amenities):
+        mask = 0
+        for tag in set(amenities):
+            if tag in self.amenity_bits:
+                mask |= 1 << self.amenity_bits[tag]
+        return mask
+
+    def open_schedules(self, minute):
+        """Boolean per interned schedule: open at this minute of the week."""
+        flags = self._open_cache.get(minute)
+        if flags is None:
+            hit = (self.schedule_start <= minute) & (minute < self.schedule_end)
+            flags = np.zeros(len(self.schedules), dtype=bool)
+            flags[self.schedule_owner[hit]] = True
+            if len(self._open_cache) >= OPEN_CACHE_SIZE:
+                self._open_cache.clear()
+            self._open_cache[minute] = flags
+        return flags
+
+    def open_range(self, start, end):
+        """Per interned schedule: (open at some minute, open at every minute) of [start, end)."""
+        start_i, end_i, owner = self.schedule_start, self.schedule_end, self.schedule_owner
+        any_open = np.zeros(len(self.schedules), dtype=bool)
+        all_open = np.zeros(len(self.schedules), dtype=bool)
+        any_open[owner[(start_i < end) & (end_i > start)]] = True
+        # intervals are merged, so full coverage means one interval covers it
+        all_open[owner[(start_i <= start) & (end_i >= end)]] = True
+        return any_open, all_open
+
+    def open_now(self, rows, minute):
+        return self.open_schedules(minute)[self.schedule_id[rows]]
+
+    def crowd_scores(self, rows, crowd=None):
+        # live reported levels (a CrowdView) win over the static field
+        points = self.crowd_points[self.crowd_code[rows]]
+        if crowd is not None and len(crowd):
+            live, pos = crowd.lookup(rows)
+            points[live] = crowd.points[pos[live]]
+        return points
+
+    def rating_scores(self, rows, ratings=None):
+        # live review ratings (a RatingsView) win over the dataset's
+        cleanliness = self.cleanliness[rows]
+        safety = self.safety[rows]
+        if ratings is not None and len(ratings):
+            live, pos = ratings.lookup(rows)
+            cleanliness = np.where(live, ratings.cleanliness[pos], cleanliness)
+            safety = np.where(live, ratings.safety[pos], safety)
+        return cleanliness, safety
+
+    def static_scores(self, model, cleanliness, safety, crowd_points):
+        w = model.weights
+        return w[OPEN] + cleanliness * w[CLEANLINESS] + safety * w[SAFETY] + crowd_points * w[CROWD]
+
+    def model_static_bound(self, model):
+        """Upper bound of the location independent part of the score
+        (open + ratings + crowd), used to stop the spatial search early."""
+        bound = self._static_bounds.get(model.key)
+        if bound is None:
+            static = self.static_scores(model, self.cleanliness, self.safety, self.crowd_points[self.crowd_code])
+            bound = float(static.max()) if len(static) else 0.0
+            self._static_bounds[model.key] = bound
+        return bound
+
+    def live_static_bound(self, crowd=None, ratings=None, model=None):
+        """The static bound, raised if live crowd levels or ratings score above the static ones."""
+        model = model or DEFAULT_MODEL
+        bound = self.model_static_bound(model)
+        rows = [view.rows for view in (crowd, ratings) if view is not None and len(view)]
+        if not rows:
+            return bound
+        rows = np.unique(np.concatenate(rows))
+        cleanliness, safety = self.rating_scores(rows, ratings)
+        live = self.static_scores(model, cleanliness, safety, self.crowd_scores(rows, crowd))
+        return max(bound, float(live.max()))
+
+    def features(self, user_context, user_history, rows, crowd=None, ratings=None):
+        """Feature matrix for the given sorted rows, one row per entry of FEATURES."""
+        minute = minute_of_week(user_context.get('time'), user_context.get('day'))
+        weight = distance_weight(user_context.get("urgency", "normal"))
+        user_lat, user_lng = user_context['location']
+
+        features = np.zeros((len(FEATURES), len(rows)))
+        features[OPEN] = self.open_now(rows, minute)
+        query_mask = self.amenity_query_mask(user_context.get('filters', {}).get('amenities', []))
+        if query_mask:
+            features[AMENITIES] = self.amenity_matches(query_mask, rows)
+        features[CLEANLINESS], features[SAFETY] = self.rating_scores(rows, ratings)
+        features[CROWD] = self.crowd_scores(rows, crowd)
+        dist = np.sqrt((user_lat - self.lat[rows]) ** 2 + (user_lng - self.lon[rows]) ** 2)
+        features[PROXIMITY] = np.maximum(0, MAX_DISTANCE_SCORE - dist * DISTANCE_SCORE_FACTOR * weight)
+        if user_history:
+            features[HISTORY] = self.history_scores(user_history, rows)
+        return features
+
+    def score(self, user_context, user_history, rows, crowd=None, ratings=None, model=None):
+        """Scores for the given sorted rows; the default model's match rank_bathrooms.
+
+        The same floats as model.apply(self.features(...)), without
+        building the matrix.
+        """
+        w = (model or DEFAULT_MODEL).key
+        minute = minute_of_week(user_context.get('time'), user_context.get('day'))
+        weight = distance_weight(user_context.get("urgency", "normal"))
+        user_lat, user_lng = user_context['location']
+
+        score = self.open_now(rows, minute) * w[OPEN]
+
+        query_mask = self.amenity_query_mask(user_context.get('filters', {}).get('amenities', []))
+        if query_mask:
+            add_weighted(score, self.amenity_matches(query_mask, rows), w[AMENITIES])
+
+        cleanliness, safety = self.rating_scores(rows, ratings)
+        add_weighted(score, cleanliness, w[CLEANLINESS])
+        add_weighted(score, safety, w[SAFETY])
+        add_weighted(score, self.crowd_scores(rows, crowd), w[CROWD])
+
+        dist = np.sqrt((user_lat - self.lat[rows]) ** 2 + (user_lng - self.lon[rows]) ** 2)
+        add_weighted(score, np.maximum(0, MAX_DISTANCE_SCORE - dist * DISTANCE_SCORE_FACTOR * weight), w[PROXIMITY])
+
+        if user_history:
+            add_weighted(score, self.history_scores(user_history, rows), w[HISTORY])
+        return score
+
+    def score_batch(self, contexts, user_history, rows, crowd=None, ratings=None, model=None):
+        """Score matrix with one row per context, same arithmetic as score()."""
+        w = (model or DEFAULT_MODEL).weights
+        minutes = [minute_of_week(c.get('time'), c.get('day')) for c in contexts]
+        weights = np.array([distance_weight(c.get("urgency", "normal")) for c in contexts],
+                           dtype=np.float64)[:, None]
+        locations = np.array([c['location'] for c in contexts], dtype=np.float64)
+
+        schedule_id = self.schedule_id[rows]
+        score = np.stack([self.open_schedules(m)[schedule_id] for m in minutes]) * w[OPEN]
+
+        for i, context in enumerate(contexts):
+            query_mask = self.amenity_query_mask(context.get('filters', {}).get('amenities', []))
+            # zero features still add 0.0, as in score()
+            score[i] += (self.amenity_matches(query_mask, rows) if query_mask else 0.0) * w[AMENITIES]
+
+        cleanliness, safety = self.rating_scores(rows, ratings)
+        score += cleanliness * w[CLEANLINESS]
+        score += safety * w[SAFETY]
+        score += self.crowd_scores(rows, crowd) * w[CROWD]
+
+        dist = np.sqrt((locations[:, :1] - self.lat[rows]) ** 2 + (locations[:, 1:] - self.lon[rows]) ** 2)
+        score += np.maximum(0, MAX_DISTANCE_SCORE - dist * DISTANCE_SCORE_FACTOR * weights) * w[PROXIMITY]
+
+        score += (self.history_scores(user_history, rows) if user_history else 0.0) * w[HISTORY]
+        for i, context in enumerate(contexts):
+            if context.get('max_radius_km') is not None:
+                score[i, dist[i] > float(context['max_radius_km']) / KM_PER_DEGREE] = -np.inf
+        return score
+
+    def amenity_matches(self, query_mask, rows):
+        masks = self.amenity_mask[rows]
+        matches = np.zeros(len(rows))
+        for bit in range(64):
+            if query_mask >> bit & 1:
+                matches += (masks >> np.uint64(bit)) & np.uint64(1)
+        return matches
+
+    def history_scores(self, user_history, rows):
+        history = np.zeros(len(rows))
+        for bathroom_id, value in user_history.items():
+            for row in self.id_rows.get(bathroom_id, ()):
+                pos = np.searchsorted(rows, row)
+                if pos < len(rows) and rows[pos] == row:
+                    history[pos] = value
+        return history
+
+    def rank(self, user_context, user_history, top_k=10, rows=None, crowd=None, ratings=None, model=None):
+        """Vectorized rank_bathrooms over `rows` (default: every located row)."""
+        if rows is None:
+            rows = self.located
+        scores = self.score(user_context, user_history, rows, crowd, ratings, model)
+        return top_k_rows(scores, rows, top_k)
+
+
+def search_bound(columns, user_context, user_history, crowd=None, ratings=None, model=None):
+    """Upper bound of every score term except distance."""
+    model = model or DEFAULT_MODEL
+    wanted = set(user_context.get('filters', {}).get('amenities', []))
+    bound = columns.live_static_bound(crowd, ratings, model) + len(wanted) * model.weights[AMENITIES]
+    if user_history:
+        bound += max(0, max(user_history.values())) * model.weights[HISTORY]
+    return bound
+
+
+def distance_bound(radius, weight, model=None):
+    """Upper bound of the distance term for rows at least `radius` degrees away."""
+    return max(0, MAX_DISTANCE_SCORE - radius * DISTANCE_SCORE_FACTOR * weight) * (model or DEFAULT_MODEL).weights[PROXIMITY]
+
+
+def rank_nearby(columns, index, user_context, user_history, top_k=10,
+                candidates=None, crowd=None, ratings=None, model=None):
+    """Rank like rank_bathrooms, but only score rows near the user.
+
+    The search radius around the user doubles until nothing outside of it
+    can beat the current k-th score, so the result matches a full scan.
+    An optional `max_radius_km` in the context caps the search radius and
+    drops everything further away. `candidates` optionally restricts the
+    ranking to sorted rows that passed the request filters; small candidate
+    sets are scored directly without walking the grid. `crowd` and
+    `ratings` are optional CrowdView/RatingsView overlays of live crowd
+    levels and review ratings, `model` the ScoringModel (default weights
+    if None). Returns row indices.
+    """
+    weight = distance_weight(user_context.get("urgency", "normal"))
+    user_lat, user_lng = user_context['location']
+
+    max_radius = user_context.get('max_radius_km')
+    if max_radius is not None:
+        max_radius = float(max_radius) / KM_PER_DEGREE
+    bound = search_bound(columns, user_context, user_history, crowd, ratings, model)
+
+    allowed = None
+    if candidates is not None:
+        if len(candidates) <= DIRECT_SCORE_LIMIT:
+            rows = candidates[~np.isnan(columns.lat[candidates])]
+            if max_radius is not None:
+                dist = np.sqrt((user_lat - columns.lat[rows]) ** 2 + (user_lng - columns.lon[rows]) ** 2)
+                rows = rows[dist <= max_radius]
+            return columns.rank(user_context, user_history, top_k, rows=rows, crowd=crowd, ratings=ratings,
+                                model=model)
+        allowed = np.zeros(len(columns), dtype=bool)
+        allowed[candidates] = True
+
+    found_rows, found_scores = [], []
+    count = 0
+    farthest = index.max_distance(user_lat, user_lng)
+    inner = -1.0
+    radius = index.cell_size
+    while True:
+        outer = radius if max_radius is None else min(radius, max_radius)
+        rows = index.query_ring(user_lat, user_lng, inner, outer)
+        if allowed is not None:
+            rows = rows[allowed[rows]]
+        if len(rows):
+            found_rows.append(rows)
+            found_scores.append(columns.score(user_context, user_history, rows, crowd, ratings, model))
+            count += len(rows)
+        if outer >= farthest or (max_radius is not None and outer >= max_radius):
+            break
+        if count >= top_k:
+            scores = np.concatenate(found_scores)
+            kth = np.partition(scores, len(scores) - top_k)[len(scores) - top_k]
+            outside = bound + distance_bound(outer, weight, model)
+            # strict so that ties are still broken by dataset order
+            if kth > outside + 1e-9:
+                break
+        inner = outer
+        radius *= 2
+
+    if not found_rows:
+        return np.empty(0, dtype=np.int64)
+    return top_k_rows(np.concatenate(found_scores), np.concatenate(found_rows), top_k)
+
+
+def box_distances(lat, lon, box):
+    """(nearest, farthest) distance from each point to the box (lat0, lat1, lon0, lon1)."""
+    lat0, lat1, lon0, lon1 = box
+    dlat = np.maximum(np.maximum(lat0 - lat, lat - lat1), 0)
+    dlon = np.maximum(np.maximum(lon0 - lon, lon - lon1), 0)
+    farthest = np.sqrt(np.maximum(np.abs(lat - lat0), np.abs(lat - lat1)) ** 2
+                       + np.maximum(np.abs(lon - lon0), np.abs(lon - lon1)) ** 2)
+    return np.sqrt(dlat ** 2 + dlon ** 2), farthest
+
+
+def region_bounds(columns, user_context, box, minutes, user_history, rows, crowd=None, ratings=None, model=None):
+    """(lower, upper) bounds of the sorted rows' scores anywhere in box during [minutes).
+
+    Only the open and proximity terms depend on where and when; the
+    others are taken from user_context.
+    """
+    model = model or DEFAULT_MODEL
+    weight = distance_weight(user_context.get("urgency", "normal"))
+    any_open, all_open = columns.open_range(*minutes)
+    nearest, farthest = box_distances(columns.lat[rows], columns.lon[rows], box)
+    upper = columns.features(user_context, user_history, rows, crowd, ratings)
+    lower = upper.copy()
+    schedule = columns.schedule_id[rows]
+    upper[OPEN], lower[OPEN] = any_open[schedule], all_open[schedule]
+    upper[PROXIMITY] = np.maximum(0, MAX_DISTANCE_SCORE - nearest * DISTANCE_SCORE_FACTOR * weight)
+    lower[PROXIMITY] = np.maximum(0, MAX_DISTANCE_SCORE - farthest * DISTANCE_SCORE_FACTOR * weight)
+    return model.apply(lower), model.apply(upper)
+
+
+def region_candidates(columns, index, user_context, box, minutes, user_history, top_k=10, candidates=None,
+                      crowd=None, ratings=None, model=None, reference=None, max_rows=MAX_REGION_CANDIDATES):
+    """(sorted rows or None, tau): every row that can make the top_k anywhere in box during [minutes).
+
+    Like a tile: tau is the k-th largest lower bound of rows that qualify
+    everywhere in the box, and a row is kept if its upper bound reaches
+    it, so ranking the kept rows at any context in the region gives what
+    rank_nearby would. `reference` are rows likely to rank high (default:
+    rank_nearby at user_context) for tau. Rows is None past max_rows.
+    """
+    model = model or DEFAULT_MODEL
+    max_radius = user_context.get('max_radius_km')
+    max_radius = None if max_radius is None else float(max_radius) / KM_PER_DEGREE
+    if reference is None:
+        reference = rank_nearby(columns, index, user_context, user_history, top_k, candidates, crowd, ratings, model)
+    reference = np.sort(np.asarray(reference, dtype=np.int64))
+    tau = -np.inf
+    if len(reference):
+        lower, _ = region_bounds(columns, user_context, box, minutes, user_history, reference, crowd, ratings, model)
+        if max_radius is not None:
+            _, farthest = box_distances(columns.lat[reference], columns.lon[reference], box)
+            lower = lower[farthest <= max_radius]
+        if len(lower) >= top_k:
+            tau = float(np.partition(lower, len(lower) - top_k)[len(lower) - top_k]) - BOUND_EPS
+
+    # past `reach` from the box even the nearest point can't score tau
+    bound = search_bound(columns, user_context, user_history, crowd, ratings, model)
+    weight = distance_weight(user_context.get("urgency", "normal"))
+    proximity = model.weights[PROXIMITY]
+    if bound >= tau:
+        reach = np.inf
+    elif proximity:
+        reach = (MAX_DISTANCE_SCORE - (tau - bound) / proximity) / (DISTANCE_SCORE_FACTOR * weight)
+    else:
+        reach = -1.0
+    if max_radius is not None:
+        reach = min(reach, max_radius)
+    if np.isinf(reach):
+        rows = columns.located if candidates is None else candidates[~np.isnan(columns.lat[candidates])]
+    else:
+        lat0, lat1, lon0, lon1 = box
+        half = np.sqrt((lat1 - lat0) ** 2 + (lon1 - lon0) ** 2) / 2
+        rows = index.query_ring((lat0 + lat1) / 2, (lon0 + lon1) / 2, -1.0, half + reach)
+        if candidates is not None:
+            rows = np.intersect1d(rows, candidates, assume_unique=True)
+        rows = rows[box_distances(columns.lat[rows], columns.lon[rows], box)[0] <= reach]
+    if len(rows) > BATCH_SCAN_LIMIT:
+        return None, tau
+    _, upper = region_bounds(columns, user_context, box, minutes, user_history, rows, crowd, ratings, model)
+    rows = rows[upper >= tau]
+    if len(rows) > max_rows:
+        return None, tau
+    return rows, tau
+
+
+def rank_rows(columns, user_context, user_history, rows, top_k=10, crowd=None, ratings=None, model=None):
+    """rank_nearby restricted to the sorted rows, e.g. a region's candidates."""
+    if user_context.get('max_radius_km') is not None:
+        user_lat, user_lng = user_context['location']
+        dist = np.sqrt((user_lat - columns.lat[rows]) ** 2 + (user_lng - columns.lon[rows]) ** 2)
+        rows = rows[dist <= float(user_context['max_radius_km']) / KM_PER_DEGREE]
+    return columns.rank(user_context, user_history, top_k, rows=rows, crowd=crowd, ratings=ratings, model=model)
+
+
+class RankedStream:
+    """Rows in rank order for one request, taken a page at a time.
+
+    Walks the same growing rings as rank_nearby, but keeps every scored
+    row that hasn't been returned yet. take(n) returns the next n rows
+    once n of the pending rows beat anything outside the searched radius,
+    scoring more rings only when they don't, so the pages concatenate to
+    exactly what rank_nearby returns for a larger top_k.
+    """
+
+    def __init__(self, columns, index, user_context, user_history,
+                 candidates=None, crowd=None, ratings=None, model=None):
+        self.columns = columns
+        self.index = index
+        self.user_context = user_context
+        self.user_history = user_history
+        self.crowd = crowd
+        self.ratings = ratings
+        self.model = model
+        self.weight = distance_weight(user_context.get("urgency", "normal"))
+        self.lat, self.lng = user_context['location']
+        max_radius = user_context.get('max_radius_km')
+        self.max_radius = None if max_radius is None else float(max_radius) / KM_PER_DEGREE
+        self.bound = search_bound(columns, user_context, user_history, crowd, ratings, model)
+        self.scores = np.empty(0)
+        self.rows = np.empty(0, dtype=np.int64)
+        # rows already returned, in rank order
+        self.ranked = np.empty(0, dtype=np.int64)
+        self.allowed = None
+        self.exhausted = False
+        self.inner = -1.0
+        self.outer = 0.0
+        self.radius = index.cell_size
+        self.farthest = index.max_distance(self.lat, self.lng)
+        if candidates is not None:
+            if len(candidates) <= DIRECT_SCORE_LIMIT:
+                rows = candidates[~np.isnan(columns.lat[candidates])]
+                if self.max_radius is not None:
+                    rows = rows[self._distance(rows) <= self.max_radius]
+                self._add(rows)
+                self.exhausted = True
+            else:
+                self.allowed = np.zeros(len(columns), dtype=bool)
+                self.allowed[candidates] = True
+
+    def _distance(self, rows):
+        return np.sqrt((self.lat - self.columns.lat[rows]) ** 2 + (self.lng - self.columns.lon[rows]) ** 2)
+
+    def _add(self, rows):
+        if len(rows):
+            scores = self.columns.score(self.user_context, self.user_history, rows, self.crowd, self.ratings,
+                                        self.model)
+            self.scores = np.concatenate([self.scores, scores])
+            self.rows = np.concatenate([self.rows, rows])
+
+    def _expand(self):
+        self.outer = self.radius if self.max_radius is None else min(self.radius, self.max_radius)
+        rows = self.index.query_ring(self.lat, self.lng, self.inner, self.outer)
+        if self.allowed is not None:
+            rows = rows[self.allowed[rows]]
+        self._add(rows)
+        if self.outer >= self.farthest or (self.max_radius is not None and self.outer >= self.max_radius):
+            self.exhausted = True
+        self.inner = self.outer
+        self.radius *= 2
+
+    def _ready(self):
+        """How many pending rows are certain to rank above every unscored row."""
+        if self.exhausted:
+            return len(self.rows)
+        outside = self.bound + distance_bound(self.outer, self.weight, self.model)
+        # strict so that ties are still broken by dataset order
+        return int(np.count_nonzero(self.scores > outside + 1e-9))
+
+    def take(self, n):
+        while self._ready() < n and not self.exhausted:
+            self._expand()
+        positions = top_k_positions(self.scores, self.rows, n)
+        rows = self.rows[positions]
+        keep = np.ones(len(self.rows), dtype=bool)
+        keep[positions] = False
+        self.scores = self.scores[keep]
+        self.rows = self.rows[keep]
+        self.ranked = np.concatenate([self.ranked, rows])
+        return rows
+
+    def page(self, offset, n):
+        """Ranks offset .. offset + n, taking more rows only if needed."""
+        if offset + n > len(self.ranked):
+            self.take(offset + n - len(self.ranked))
+        return self.ranked[offset:offset + n]
+
+    @property
+    def done(self):
+        return self.exhausted and not len(self.rows)
+
+
+def rank_batch(columns, index, contexts, user_history, top_k=10, candidates=None,
+               crowd=None, ratings=None, model=None):
+    """Rank several contexts that share the same filters.
+
+    The candidate rows are scanned once in blocks, each block scored for
+    every context at the same time. Returns one array of rows per context,
+    the same rows rank_nearby would return for each context on its own.
+    """
+    if not contexts:
+        return []
+    rows = columns.located if candidates is None else candidates[~np.isnan(columns.lat[candidates])]
+    if len(rows) > BATCH_SCAN_LIMIT:
+        return [rank_nearby(columns, index, context, user_history, top_k, candidates, crowd, ratings, model)
+                for context in contexts]
+
+    best = [(np.empty(0), np.empty(0, dtype=np.int64)) for _ in contexts]
+    block = max(1, BATCH_BLOCK_CELLS // len(contexts))
+    for start in range(0, len(rows), block):
+        block_rows = rows[start:start + block]
+        scores = columns.score_batch(contexts, user_history, block_rows, crowd, ratings, model)
+        for i, (best_scores, best_rows) in enumerate(best):
+            keep = np.isfinite(scores[i])
+            merged_scores = np.concatenate([best_scores, scores[i][keep]])
+            merged_rows = np.concatenate([best_rows, block_rows[keep]])
+            chosen = top_k_positions(merged_scores, merged_rows, top_k)
+            best[i] = (merged_scores[chosen], merged_rows[chosen])
+    return [best_rows for _, best_rows in best]
@@ -0,0 +1,346 @@
+import atexit
+import heapq
+import math
+import os
+import sqlite3
+import threading
+import time
+import weakref
+from collections import deque
+
+import numpy as np
+
+from ranking import CROWD_SCORE
+
+CROWD_LEVELS = ('low', 'medium', 'high')
+DEFAULT_HALF_LIFE = 20 * 60.0  # seconds
+# a report weighs 1 and halves every half-life; below this the
+# aggregate is too stale to trust and the static field applies again
+MIN_WEIGHT = 0.5
+RING_SIZE = 16
+# changes kept for patching views; a view further behind is rebuilt
+CHANGE_LOG_SIZE = 4096
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS crowd (
+    bathroom_id TEXT PRIMARY KEY,
+    total REAL NOT NULL,
+    weight REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS crowd_recent (
+    bathroom_id TEXT NOT NULL,
+    at REAL NOT NULL,
+    level TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS crowd_recent_bathroom ON crowd_recent (bathroom_id, at);
+"""
+
+# CrowdReports._merge in SQL
+UPSERT = """
+INSERT INTO crowd (bathroom_id, total, weight, updated_at) VALUES (?, ?, ?, ?)
+ON CONFLICT (bathroom_id) DO UPDATE SET
+    total = total * keep(weight, updated_at, excluded.updated_at)
+        + excluded.total * keep(excluded.weight, excluded.updated_at, updated_at),
+    weight = weight * keep(weight, updated_at, excluded.updated_at)
+        + excluded.weight * keep(excluded.weight, excluded.updated_at, updated_at),
+    updated_at = MAX(updated_at, excluded.updated_at)
+"""
+
+TRIM_RECENT = """
+DELETE FROM crowd_recent WHERE bathroom_id = ? AND rowid NOT IN (
+    SELECT rowid FROM crowd_recent WHERE bathroom_id = ? ORDER BY at DESC LIMIT ?)
+"""
+
+
+class CrowdState:
+    __slots__ = ('total', 'weight', 'updated', 'recent')
+
+    def __init__(self):
+        self.total = 0.0
+        self.weight = 0.0
+        self.updated = 0.0
+        # (timestamp, level) of the latest reports, oldest dropped first
+        self.recent = deque(maxlen=RING_SIZE)
+
+
+class CrowdView:
+    """Live crowd levels for one snapshot's rows at one moment.
+
+    `rows` is sorted; `points` and `levels` line up with it.
+    """
+
+    def __init__(self, rows, points, levels):
+        self.rows = rows
+        self.points = points
+        self.levels = levels
+
+    def __len__(self):
+        return len(self.rows)
+
+    def lookup(self, rows):
+        """(mask over rows that have a live level, their positions in the view)."""
+        if not len(self.rows):
+            return np.zeros(len(rows), dtype=bool), np.zeros(len(rows), dtype=np.int64)
+        pos = np.minimum(np.searchsorted(self.rows, rows), len(self.rows) - 1)
+        return self.rows[pos] == rows, pos
+
+    def level_rows(self, level):
+        return self.rows[self.levels == level]
+
+
+EMPTY_VIEW = CrowdView(np.empty(0, dtype=np.int64), np.empty(0), np.empty(0, dtype=object))
+
+
+class CrowdReports:
+    """Time-decayed crowd level per bathroom from user reports.
+
+    Each bathroom keeps an exponentially decayed sum of reported levels
+    (low=0, medium=1, high=2) and of report weights, so a report is O(1)
+    and memory per bathroom is constant: the two sums plus a ring buffer
+    of the last RING_SIZE reports. The live level is the weighted mean,
+    rounded; once the decayed weight drops below MIN_WEIGHT the bathroom
+    falls back to its static crowd_updates value and its state is dropped.
+
+    Like ReviewStore, reports apply in memory at once and a background
+    checkpoint writes them to SQLite as deltas; other processes' reports
+    (preforked workers) are picked up every `refresh_interval` seconds.
+    """
+
+    def __init__(self, path, half_life=DEFAULT_HALF_LIFE, min_weight=MIN_WEIGHT,
+                 checkpoint_interval=1.0, refresh_interval=5.0):
+        self.path = path
+        self.half_life = half_life
+        self.min_weight = min_weight
+        self.checkpoint_interval = checkpoint_interval
+        self.refresh_interval = refresh_interval
+        self._checkpointer = None
+        self._reset()
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._states = {}
+        # the same, for reports not yet checkpointed
+        self._pending = {}
+        self._pending_recent = []
+        # (expiry, bathroom_id), one per state; a state reported since its
+        # entry was pushed is pushed again with its new expiry
+        self._expiries = []
+        self._generation = 0
+        # (generation, bathroom_id) of every change, one per generation
+        self._changes = deque(maxlen=CHANGE_LOG_SIZE)
+        # one view per snapshot (or shard) in use; dropped with it
+        self._views = weakref.WeakKeyDictionary()
+        self._wake = threading.Event()
+
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.create_function('keep', 3, self._keep, deterministic=True)
+        self._db.executescript(SCHEMA)
+        self._db.commit()
+        self.refresh()
+
+    def _after_fork(self):
+        # like ReviewStore: a worker opens its own connection and
+        # checkpoints its own reports
+        self._reset()
+        if self._checkpointer is not None:
+            self._checkpointer = None
+            self.start(register_exit=False)
+
+    def _decay(self, elapsed):
+        return 0.5 ** (max(elapsed, 0.0) / self.half_life)
+
+    def _keep(self, weight, since, until):
+        # factor for sums last updated at `since` when merged with ones
+        # updated at `until`: their decay, or 0 if they had expired by then
+        factor = self._decay(until - since)
+        return factor if weight * factor >= self.min_weight else 0.0
+
+    def _merge(self, state, total, weight, updated):
+        # add sums updated at `updated` to the state's, so reports from
+        # several processes combine in any order
+        mine, theirs = self._keep(state.weight, state.updated, updated), self._keep(weight, updated, state.updated)
+        state.total = state.total * mine + total * theirs
+        state.weight = state.weight * mine + weight * theirs
+        state.updated = max(state.updated, updated)
+
+    def _changed(self, bathroom_id):
+        self._generation += 1
+        self._changes.append((self._generation, bathroom_id))
+
+    def report(self, bathroom_id, level, now=None):
+        now = time.time() if now is None else now
+        value = CROWD_LEVELS.index(level)
+        with self._lock:
+            self._prune(now)
+            created = bathroom_id not in self._states
+            state = self._states.setdefault(bathroom_id, CrowdState())
+            self._merge(state, value, 1.0, now)
+            state.recent.append((now, level))
+            if created:
+                heapq.heappush(self._expiries, (self._expires(state), bathroom_id))
+            self._merge(self._pending.setdefault(bathroom_id, CrowdState()), value, 1.0, now)
+            self._pending_recent.append((bathroom_id, now, level))
+            self._changed(bathroom_id)
+            return self._summary(state, now)
+
+    def _prune(self, now):
+        # drop the states whose level has expired
+        while self._expiries and self._expiries[0][0] <= now:
+            _, bathroom_id = heapq.heappop(self._expiries)
+            state = self._states.get(bathroom_id)
+            if state is None:
+                continue
+            expires = self._expires(state)
+            if expires <= now:
+                del self._states[bathroom_id]
+                self._changed(bathroom_id)
+            else:
+                heapq.heappush(self._expiries, (expires, bathroom_id))
+
+    def _summary(self, state, now):
+        weight = state.weight * self._decay(now - state.updated)
+        return {
+            'level': self._level(state) if weight >= self.min_weight else None,
+            'mean': state.total / state.weight if state.weight else None,
+            'weight': weight,
+            'reports': len(state.recent),
+            'recent': [{'at': at, 'level': lvl} for at, lvl in state.recent],
+        }
+
+    def _level(self, state):
+        return CROWD_LEVELS[int(round(state.total / state.weight))] if state.weight else None
+
+    def current(self, bathroom_id, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            self._prune(now)
+            state = self._states.get(bathroom_id)
+            return None if state is None else self._summary(state, now)
+
+    def _expires(self, state):
+        # when the decayed weight reaches min_weight
+        if state.weight < self.min_weight:
+            return state.updated
+        return state.updated + self.half_life * math.log2(state.weight / self.min_weight)
+
+    def checkpoint(self):
+        with self._db_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+                recent, self._pending_recent = self._pending_recent, []
+            if not batch:
+                return 0
+            with self._db:
+                self._db.executemany(UPSERT, [
+                    (bathroom_id, state.total, state.weight, state.updated)
+                    for bathroom_id, state in batch.items()
+                ])
+                self._db.executemany('INSERT INTO crowd_recent (bathroom_id, at, level) VALUES (?, ?, ?)', recent)
+                self._db.executemany(TRIM_RECENT, [(bathroom_id, bathroom_id, RING_SIZE) for bathroom_id in batch])
+        return len(batch)
+
+    def refresh(self, now=None):
+        """Reload the states from disk, keeping reports not yet checkpointed.
+
+        Expired states are deleted from disk unless reported since they
+        were read.
+        """
+        now = time.time() if now is None else now
+        with self._db_lock:
+            states = {}
+            for bathroom_id, total, weight, updated in self._db.execute(
+                    'SELECT bathroom_id, total, weight, updated_at FROM crowd'):
+                state = states[bathroom_id] = CrowdState()
+                state.total, state.weight, state.updated = total, weight, updated
+            for bathroom_id, at, level in self._db.execute(
+                    'SELECT bathroom_id, at, level FROM crowd_recent ORDER BY bathroom_id, at'):
+                if bathroom_id in states:
+                    states[bathroom_id].recent.append((at, level))
+            with self._lock:
+                expired = [(bathroom_id, state.updated) for bathroom_id, state in states.items()
+                           if self._expires(state) <= now and bathroom_id not in self._pending]
+            for bathroom_id, _ in expired:
+                del states[bathroom_id]
+            if expired:
+                with self._db:
+                    self._db.executemany('DELETE FROM crowd WHERE bathroom_id = ? AND updated_at <= ?', expired)
+                    self._db.executemany('DELETE FROM crowd_recent WHERE bathroom_id = ? AND at <= ?', expired)
+            with self._lock:
+                for bathroom_id, delta in self._pending.items():
+                    state = states.get(bathroom_id)
+                    if state is None:
+                        state = states[bathroom_id] = CrowdState()
+                    self._merge(state, delta.total, delta.weight, delta.updated)
+                for bathroom_id, at, level in self._pending_recent:
+                    states[bathroom_id].recent.append((at, level))
+                old = self._states
+                for bathroom_id in old.keys() | states.keys():
+                    a, b = old.get(bathroom_id), states.get(bathroom_id)
+                    if a is None or b is None or (a.total, a.weight, a.updated) != (b.total, b.weight, b.updated):
+                        self._changed(bathroom_id)
+                self._states = states
+                self._expiries = [(self._expires(state), bathroom_id) for bathroom_id, state in states.items()]
+                heapq.heapify(self._expiries)
+                self._loaded_at = time.monotonic()
+
+    def view(self, columns, now=None):
+        """CrowdView of the live levels for `columns`' rows.
+
+        Requests share one view until a report arrives or a level
+        expires; then the view is patched for the bathrooms that changed.
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            self._prune(now)
+            cached = self._views.get(columns)
+            if cached is not None and cached[0] == self._generation:
+                return cached[1]
+            if cached is not None and self._changes and self._changes[0][0] <= cached[0] + 1:
+                changed = {bathroom_id for generation, bathroom_id in self._changes if generation > cached[0]}
+                view = self._patched(cached[1], columns, changed)
+            else:
+                view = self._patched(EMPTY_VIEW, columns, self._states)
+            self._views[columns] = (self._generation, view)
+            return view
+
+    def _patched(self, view, columns, changed):
+        # `view` with the rows of the changed bathrooms replaced by their live levels
+        drop, rows, levels = [], [], []
+        for bathroom_id in changed:
+            state = self._states.get(bathroom_id)
+            level = None if state is None else self._level(state)
+            for row in columns.id_rows.get(bathroom_id, ()):
+                drop.append(row)
+                if level is not None:
+                    rows.append(row)
+                    levels.append(level)
+        keep = ~np.isin(view.rows, drop)
+        rows = np.concatenate([view.rows[keep], np.array(rows, dtype=np.int64)])
+        if not len(rows):
+            return EMPTY_VIEW
+        points = np.concatenate([view.points[keep], np.array([CROWD_SCORE[level] for level in levels], dtype=np.float64)])
+        levels = np.concatenate([view.levels[keep], np.array(levels, dtype=object)])
+        order = np.argsort(rows, kind='stable')
+        return CrowdView(rows[order], points[order], levels[order])
+
+    def start(self, register_exit=True):
+        if self._checkpointer is not None:
+            return
+
+        def run():
+            while True:
+                self._wake.wait(min(self.checkpoint_interval, self.refresh_interval))
+                self._wake.clear()
+                self.checkpoint()
+                if time.monotonic() - self._loaded_at >= self.refresh_interval:
+                    self.refresh()
+
+        self._checkpointer = threading.Thread(target=run, name='crowd-checkpointer', daemon=True)
+        self._checkpointer.start()
+        if register_exit:
+            atexit.register(self.checkpoint)
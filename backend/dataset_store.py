@@ -0,0 +1,247 @@
+import json
+import mmap
+import os
+from collections.abc import Mapping
+
+import numpy as np
+
+from columnar import BathroomColumns
+
+MAGIC = b'BATHRMS1'
+ALIGN = 64
+JSON_NAME = 'bathrooms.json'
+STORE_NAME = 'bathrooms.bin'
+# BathroomColumns arrays written as-is
+STORE_COLUMNS = ('lat', 'lon', 'cleanliness', 'safety', 'crowd_code', 'amenity_mask', 'schedule_id')
+
+
+def _plain(value):
+    # compact records (records.BathroomRecord) are mappings, not dicts
+    if isinstance(value, Mapping):
+        return dict(value)
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def encode_record(bathroom):
+    return json.dumps(bathroom, ensure_ascii=False, separators=(',', ':'), default=_plain).encode('utf-8')
+
+
+def _string_table(blobs):
+    # offsets[i]:offsets[i + 1] is the i-th entry of the joined blob
+    offsets = np.zeros(len(blobs) + 1, dtype=np.uint64)
+    offsets[1:] = np.cumsum([len(b) for b in blobs], dtype=np.uint64)
+    return offsets, np.frombuffer(b''.join(blobs), dtype=np.uint8)
+
+
+def write_store(path, bathrooms):
+    """Write bathrooms in the binary store format, atomically.
+
+    Layout: magic, header length, JSON header, then 64-byte aligned arrays.
+    The header lists every array's dtype/offset/length plus the lookup tables
+    (amenity tags, crowd levels, opening schedules) the scoring columns
+    refer to. Full records are kept as compact JSON in a string table so
+    they can be parsed one at a time.
+    """
+    columns = BathroomColumns(bathrooms)
+    arrays = {name: np.ascontiguousarray(getattr(columns, name)) for name in STORE_COLUMNS}
+    arrays['id_offsets'], arrays['id_blob'] = _string_table(
+        [('' if i is None else str(i)).encode('utf-8') for i in columns.ids])
+    arrays['record_offsets'], arrays['record_blob'] = _string_table(
+        [encode_record(b) for b in bathrooms])
+
+    tags = sorted(columns.amenity_bits, key=columns.amenity_bits.get)
+    layout = {}
+    offset = 0
+    for name, array in arrays.items():
+        layout[name] = {'dtype': array.dtype.str, 'offset': offset, 'length': int(array.size)}
+        offset += -(-array.nbytes // ALIGN) * ALIGN
+    header = json.dumps({
+        'count': len(bathrooms),
+        'arrays': layout,
+        'amenity_tags': tags,
+        'crowd_levels': columns.crowd_levels,
+        'schedules': [[list(i) for i in s] for s in columns.schedules],
+    }).encode('utf-8')
+    data_start = -(-(len(MAGIC) + 8 + len(header)) // ALIGN) * ALIGN
+
+    tmp = f'{path}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(MAGIC)
+        f.write(len(header).to_bytes(8, 'little'))
+        f.write(header)
+        for name, array in arrays.items():
+            f.seek(data_start + layout[name]['offset'])
+            f.write(array.tobytes())
+        f.truncate(data_start + offset)
+    # replace rather than overwrite so readers keep their mapping of the old file
+    os.replace(tmp, path)
+
+
+class BathroomStore:
+    """Read-only, memory-mapped view of a binary store file.
+
+    Behaves like a list of bathroom dicts; each record is decoded from the
+    string table on access, and the scoring columns are zero-copy arrays.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[:len(MAGIC)] != MAGIC:
+            raise ValueError(f'{path} is not a bathroom store')
+        size = int.from_bytes(self._mmap[len(MAGIC):len(MAGIC) + 8], 'little')
+        start = len(MAGIC) + 8
+        self.header = json.loads(self._mmap[start:start + size])
+        self._data_start = -(-(start + size) // ALIGN) * ALIGN
+        self._record_offsets = self.column('record_offsets')
+        self._record_blob = self.column('record_blob')
+        self.ids = StringTable(self.column('id_offsets'), self.column('id_blob'))
+        # every record's compact JSON, ready to be sent as is
+        self.fragments = StringTable(self._record_offsets, self._record_blob)
+
+    def column(self, name):
+        spec = self.header['arrays'][name]
+        return np.frombuffer(self._mmap, dtype=np.dtype(spec['dtype']), count=spec['length'],
+                             offset=self._data_start + spec['offset'])
+
+    def __len__(self):
+        return self.header['count']
+
+    def __getitem__(self, row):
+        if row < 0:
+            row += len(self)
+        if not 0 <= row < len(self):
+            raise IndexError(row)
+        start, end = int(self._record_offsets[row]), int(self._record_offsets[row + 1])
+        return json.loads(self._record_blob[start:end].tobytes())
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield self[row]
+
+
+class StringTable:
+    """Sequence of strings stored as offsets into one utf-8 blob."""
+
+    @classmethod
+    def from_bytes(cls, blobs):
+        return cls(*_string_table(blobs))
+
+    def __init__(self, offsets, blob):
+        self._offsets = offsets
+        self._blob = blob
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, row):
+        return self.bytes_at(row).decode('utf-8')
+
+    def bytes_at(self, row):
+        start, end = int(self._offsets[row]), int(self._offsets[row + 1])
+        return self._blob[start:end].tobytes()
+
+    def __iter__(self):
+        data = self._blob.tobytes()
+        offsets = self._offsets.tolist()
+        for start, end in zip(offsets, offsets[1:]):
+            yield data[start:end].decode('utf-8')
+
+
+def is_store(path):
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def default_data_path(data_dir):
+    # the binary store wins once it has been generated
+    store = os.path.join(data_dir, STORE_NAME)
+    return store if os.path.exists(store) else os.path.join(data_dir, JSON_NAME)
+
+
+def open_dataset(path):
+    """Bathrooms at `path`: a lazy BathroomStore, or a list for JSON files."""
+    if is_store(path):
+        return BathroomStore(path)
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def iter_dataset(path, chunk_size=1 << 16):
+    """Yield bathrooms one at a time without loading the whole file.
+
+    JSON arrays are decoded record by record from a buffer of one or
+    a few chunks.
+    """
+    if is_store(path):
+        yield from BathroomStore(path)
+        return
+    decoder = json.JSONDecoder()
+    with open(path, 'r', encoding='utf-8') as f:
+        buf = ''
+        pos = 0
+        started = False
+        while True:
+            # skip whitespace, the opening bracket and separators
+            while True:
+                while pos < len(buf) and buf[pos] in ' \t\r\n,':
+                    pos += 1
+                if pos < len(buf):
+                    break
+                more = f.read(chunk_size)
+                if not more:
+                    return
+                buf, pos = buf[pos:] + more, 0
+            if not started:
+                if buf[pos] != '[':
+                    raise ValueError(f'{path} is not a JSON array')
+                started = True
+                pos += 1
+                continue
+            if buf[pos] == ']':
+                return
+            try:
+                record, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                more = f.read(chunk_size)
+                if not more:
+                    raise
+                buf, pos = buf[pos:] + more, 0
+                continue
+            yield record
+            # the buffer is only trimmed when the next chunk is read
+            pos = end
+
+
+class JsonArrayWriter:
+    """Write records to a JSON array one at a time, laid out like json.dump(indent=2)."""
+
+    def __init__(self, f):
+        self.f = f
+        self.count = 0
+
+    def write(self, record):
+        self.f.write('[\n  ' if self.count == 0 else ',\n  ')
+        self.f.write(json.dumps(record, ensure_ascii=False, indent=2).replace('\n', '\n  '))
+        self.count += 1
+
+    def close(self):
+        self.f.write('\n]' if self.count else '[]')
+
+
+def load_dataset(path):
+    """Bathrooms at `path` as a list of dicts, whatever the format."""
+    data = open_dataset(path)
+    return data if isinstance(data, list) else list(data)
+
+
+def save_dataset(path, data, indent=2):
+    """Write bathrooms in the format `path` names (.bin = store, else JSON)."""
+    if path.endswith('.bin'):
+        write_store(path, data)
+        return
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=indent)
+    os.replace(tmp, path)
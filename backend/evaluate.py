@@ -0,0 +1,184 @@
+import argparse
+import ast
+import json
+import os
+import time
+
+import numpy as np
+
+from benchmark import query_contexts, summarize
+from columnar import rank_nearby, top_k_positions
+from dataset_store import default_data_path, open_dataset
+from ranking import KM_PER_DEGREE
+from scoring import DEFAULT_MODEL, FEATURES, OPEN, ScoringModels
+from snapshot import DatasetSnapshot
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+LOG_MARKER = 'top-bathrooms '
+
+
+def precision_at_k(results, required_feature):
+    relevant = 0
+
+    for b in results:
+        if required_feature in b.get("amenities", []):
+            relevant += 1
+
+    return relevant / len(results) if results else 0
+
+
+def ndcg_at_k(gains, ideal_gains, k):
+    """NDCG of ranked gains against the best possible order of ideal_gains."""
+    discounts = 1.0 / np.log2(np.arange(2, k + 2))
+    ideal = np.sort(np.asarray(ideal_gains, dtype=np.float64))[::-1][:k]
+    best = float((ideal * discounts[:len(ideal)]).sum())
+    if best == 0:
+        return None
+    gains = np.asarray(gains, dtype=np.float64)[:k]
+    return float((gains * discounts[:len(gains)]).sum()) / best
+
+
+def wanted_amenities(context):
+    # the app filters on filters.amenities; older contexts say preferences
+    return sorted(set(context.get('filters', {}).get('amenities', [])) | set(context.get('preferences', [])))
+
+
+def judged_gains(snapshot, context, rows):
+    """Graded relevance of rows for a logged context.
+
+    Contexts logged with the bathrooms the user went on to use
+    ("relevant": [ids]) are judged by those. Otherwise a row gains one per
+    wanted amenity it has, plus one if it's open at the context's time.
+    """
+    columns = snapshot.columns
+    relevant = context.get('relevant')
+    if relevant is not None:
+        relevant = set(relevant)
+        return np.array([columns.ids[row] in relevant for row in rows], dtype=np.float64)
+    gains = columns.features(context, {}, rows)[OPEN].copy()
+    mask = columns.amenity_query_mask(wanted_amenities(context))
+    if mask:
+        gains += columns.amenity_matches(mask, rows)
+    return gains
+
+
+def load_contexts(path):
+    """Contexts from a JSON-lines file or from the app's debug log."""
+    contexts = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if LOG_MARKER in line:
+                # app.logger.debug('top-bathrooms %s', user_context)
+                contexts.append(ast.literal_eval(line.split(LOG_MARKER, 1)[1]))
+            elif line.startswith('{'):
+                contexts.append(json.loads(line))
+    return [c for c in contexts if isinstance(c, dict) and c.get('location')]
+
+
+def candidate_rows(snapshot, context):
+    columns = snapshot.columns
+    candidates = snapshot.filter_index.resolve(context.get('filters', {}))
+    rows = columns.located if candidates is None else candidates[~np.isnan(columns.lat[candidates])]
+    if context.get('max_radius_km') is not None:
+        lat, lng = context['location']
+        dist = np.sqrt((lat - columns.lat[rows]) ** 2 + (lng - columns.lon[rows]) ** 2)
+        rows = rows[dist <= float(context['max_radius_km']) / KM_PER_DEGREE]
+    return candidates, rows
+
+
+def evaluate(snapshot, contexts, models, top_k=10):
+    """Per model precision@k, NDCG@k and ranking latency over the contexts.
+
+    Every model ranks a context from the same feature matrix in one
+    matrix product; the latency is rank_nearby's, which is what a request
+    with that model costs (bigger proximity weights stop the spatial
+    search sooner).
+    """
+    weights = np.stack([model.weights for model in models])
+    precision = {model.name: [] for model in models}
+    ndcg = {model.name: [] for model in models}
+    batch_seconds = []
+    for context in contexts:
+        _, rows = candidate_rows(snapshot, context)
+        if not len(rows):
+            continue
+        start = time.perf_counter()
+        scores = weights @ snapshot.columns.features(context, {}, rows)
+        ranked = [rows[top_k_positions(model_scores, rows, top_k)] for model_scores in scores]
+        batch_seconds.append(time.perf_counter() - start)
+
+        gains = judged_gains(snapshot, context, rows)
+        gain_of = dict(zip(rows.tolist(), gains.tolist()))
+        wanted = wanted_amenities(context)
+        for model, top in zip(models, ranked):
+            top_gains = [gain_of[row] for row in top.tolist()]
+            value = ndcg_at_k(top_gains, gains, top_k)
+            if value is not None:
+                ndcg[model.name].append(value)
+            if context.get('relevant') is not None:
+                precision[model.name].append(sum(g > 0 for g in top_gains) / len(top_gains))
+            elif wanted:
+                results = [snapshot.bathrooms[row] for row in top.tolist()]
+                precision[model.name].append(float(np.mean([precision_at_k(results, f) for f in wanted])))
+
+    report = {}
+    for model in models:
+        latencies = []
+        for context in contexts:
+            candidates, _ = candidate_rows(snapshot, context)
+            start = time.perf_counter()
+            rank_nearby(snapshot.columns, snapshot.index, context, {}, top_k, candidates, model=model)
+            latencies.append(time.perf_counter() - start)
+        report[model.name] = {
+            'weights': dict(zip(FEATURES, model.key)),
+            f'precision_at_{top_k}': round(float(np.mean(precision[model.name])), 4) if precision[model.name] else None,
+            f'ndcg_at_{top_k}': round(float(np.mean(ndcg[model.name])), 4) if ndcg[model.name] else None,
+            'judged': len(ndcg[model.name]),
+            'latency': summarize(latencies, sum(latencies)),
+        }
+    return report, summarize(batch_seconds, sum(batch_seconds)) if batch_seconds else None
+
+
+def main(args):
+    start = time.perf_counter()
+    snapshot = DatasetSnapshot(open_dataset(args.input), 0)
+    if args.contexts:
+        contexts = load_contexts(args.contexts)
+        source = args.contexts
+    else:
+        contexts = query_contexts(snapshot.columns, args.queries, args.seed)
+        source = f'{args.queries} generated contexts'
+    models = list(ScoringModels.load(args.models)) if os.path.exists(args.models) else [DEFAULT_MODEL]
+    print(f'Loaded {len(snapshot.bathrooms)} bathrooms, {len(contexts)} contexts ({source}) '
+          f'and {len(models)} scoring models in {time.perf_counter() - start:.2f}s')
+
+    report, batch = evaluate(snapshot, contexts, models, args.top_k)
+    print(f"{'model':<16} {f'P@{args.top_k}':>7} {f'NDCG@{args.top_k}':>8} {'judged':>7} {'p50 ms':>8} {'p95 ms':>8}")
+    for name, result in report.items():
+        p = result[f'precision_at_{args.top_k}']
+        n = result[f'ndcg_at_{args.top_k}']
+        print(f"{name:<16} {'-' if p is None else f'{p:.4f}':>7} {'-' if n is None else f'{n:.4f}':>8} "
+              f"{result['judged']:>7} {result['latency']['p50_ms']:>8.3f} {result['latency']['p95_ms']:>8.3f}")
+    if batch:
+        print(f"All {len(models)} models in one pass: p50 {batch['p50_ms']:.3f} ms, "
+              f"p95 {batch['p95_ms']:.3f} ms per context")
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'contexts': source, 'top_k': args.top_k, 'models': report, 'batch': batch}, f, indent=2)
+        print(f'Wrote {args.output}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare scoring models offline on logged or generated contexts')
+    parser.add_argument('--input', default=default_data_path(os.path.join(BASE_DIR, 'data')))
+    parser.add_argument('--models', default=os.path.join(BASE_DIR, 'scoring_models.json'))
+    parser.add_argument('--contexts', help='JSON-lines contexts or an app debug log; generated if omitted')
+    parser.add_argument('--queries', type=int, default=500, help='Contexts to generate without --contexts')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--top-k', type=int, default=10)
+    parser.add_argument('--output', help='Also write the report as JSON')
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,61 @@
+import numpy as np
+
+
+class FilterIndex:
+    """Inverted index from amenity tag and crowd level to sorted row ids.
+
+    Built once at load time so request filters resolve by intersecting
+    posting lists instead of checking every bathroom.
+    """
+
+    def __init__(self, columns):
+        self.amenities = {}
+        for tag, bit in columns.amenity_bits.items():
+            hit = (columns.amenity_mask >> np.uint64(bit)) & np.uint64(1)
+            self.amenities[tag] = np.flatnonzero(hit).astype(np.int64)
+        order = np.argsort(columns.crowd_code, kind='stable')
+        bounds = np.searchsorted(columns.crowd_code[order], np.arange(len(columns.crowd_levels) + 1))
+        self.crowd = {level: np.sort(order[bounds[code]:bounds[code + 1]]).astype(np.int64)
+                      for code, level in enumerate(columns.crowd_levels)}
+
+    def crowd_rows(self, level, crowd=None):
+        # a live reported level (CrowdView) replaces the static one
+        rows = self.crowd.get(level, np.empty(0, dtype=np.int64))
+        if crowd is not None and len(crowd):
+            rows = np.setdiff1d(rows, crowd.rows, assume_unique=True)
+            rows = np.union1d(rows, crowd.level_rows(level))
+        return rows
+
+    def resolve(self, filters, crowd=None):
+        """Sorted rows matching `filters`, or None when nothing is filtered."""
+        postings = []
+        if 'amenities' in filters:
+            for tag in set(filters['amenities']):
+                postings.append(self.amenities.get(tag, np.empty(0, dtype=np.int64)))
+        if 'crowd' in filters:
+            postings.append(self.crowd_rows(filters['crowd'], crowd))
+        if not postings:
+            return None
+        # smallest list first keeps every intersection small
+        postings.sort(key=len)
+        rows = postings[0]
+        for other in postings[1:]:
+            if not len(rows):
+                break
+            rows = np.intersect1d(rows, other, assume_unique=True)
+        return rows
+
+    def matches(self, row, filters, crowd=None):
+        """Whether a single row passes `filters`."""
+        postings = []
+        if 'amenities' in filters:
+            postings.extend(self.amenities.get(tag) for tag in set(filters['amenities']))
+        if 'crowd' in filters:
+            postings.append(self.crowd_rows(filters['crowd'], crowd))
+        for rows in postings:
+            if rows is None:
+                return False
+            pos = np.searchsorted(rows, row)
+            if pos >= len(rows) or rows[pos] != row:
+                return False
+        return True
@@ -0,0 +1,182 @@
+import atexit
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS visits (
+    user_id TEXT NOT NULL,
+    bathroom_id TEXT NOT NULL,
+    score REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (user_id, bathroom_id)
+);
+CREATE INDEX IF NOT EXISTS visits_updated ON visits (updated_at);
+"""
+
+UPSERT = """
+INSERT INTO visits (user_id, bathroom_id, score, updated_at) VALUES (?, ?, ?, ?)
+ON CONFLICT (user_id, bathroom_id) DO UPDATE SET
+    score = decay(score, updated_at, excluded.updated_at) + excluded.score,
+    updated_at = MAX(updated_at, excluded.updated_at)
+"""
+
+# with a half-life, visits are dropped once decayed below this score
+MIN_SCORE = 0.001
+PRUNE_INTERVAL = 3600.0  # seconds
+
+
+class HistoryStore:
+    """Per-user visit history persisted in SQLite (WAL mode).
+
+    Each (user, bathroom) pair keeps a score and the time it was last
+    updated. With a half-life the score decays exponentially, so a visit
+    is O(1) to apply and old visits fade out; without one the score is a
+    plain visit count. Visits go to an in-memory buffer that a background
+    thread flushes in batches, so recording a visit never waits on disk.
+    Flushes also delete pairs not visited for `horizon` seconds: the
+    max age, or how long one visit takes to decay below MIN_SCORE if
+    that is sooner.
+    """
+
+    def __init__(self, path, half_life_days=None, max_age_days=None, flush_interval=1.0,
+                 max_buffer=500, max_cached_users=10000, cache_ttl=30.0):
+        self.path = path
+        self.half_life = half_life_days * 86400.0 if half_life_days else None
+        self.horizon = min(max_age_days * 86400.0 if max_age_days else math.inf,
+                           self.half_life * math.log2(1 / MIN_SCORE) if self.half_life else math.inf)
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.max_cached_users = max_cached_users
+        self.cache_ttl = cache_ttl
+        self._flusher = None
+        self._reset()
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        # (user_id, bathroom_id) -> [score, updated_at] not yet on disk
+        self._buffer = {}
+        # user_id -> (loaded_at, {bathroom_id: [score, updated_at]})
+        self._users = OrderedDict()
+        self._wake = threading.Event()
+        self._pruned_at = 0.0
+
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.create_function('decay', 3, self._decay_to, deterministic=True)
+        self._db.executescript(SCHEMA)
+        self._db.commit()
+
+    def _after_fork(self):
+        # a forked worker can't share the parent's connection or threads;
+        # it starts with an empty buffer (the parent flushes before forking)
+        # and its own flusher. Other workers' visits reach it through the
+        # database once its cached view of a user expires.
+        self._reset()
+        if self._flusher is not None:
+            self._flusher = None
+            self.start(register_exit=False)
+
+    def decay(self, score, elapsed):
+        if self.half_life is None or elapsed <= 0:
+            return score
+        return score * 0.5 ** (elapsed / self.half_life)
+
+    def _decay_to(self, score, since, until):
+        return self.decay(score, until - since)
+
+    def _add(self, entry, now):
+        # entry is [score, updated_at]; returns the updated pair
+        if entry is None:
+            return [1.0, now]
+        return [self.decay(entry[0], now - entry[1]) + 1.0, max(now, entry[1])]
+
+    def record(self, user_id, bathroom_id, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            key = (user_id, bathroom_id)
+            self._buffer[key] = self._add(self._buffer.get(key), now)
+            cached = self._users.get(user_id)
+            if cached is not None:
+                scores = cached[1]
+                scores[bathroom_id] = self._add(scores.get(bathroom_id), now)
+            full = len(self._buffer) >= self.max_buffer
+        if full:
+            self._wake.set()
+
+    def view(self, user_id, now=None):
+        """{bathroom_id: score} for one user, decayed to `now`."""
+        now = time.time() if now is None else now
+        with self._lock:
+            cached = self._users.get(user_id)
+            if cached is not None and now - cached[0] <= self.cache_ttl:
+                self._users.move_to_end(user_id)
+                scores = cached[1]
+            else:
+                scores = None
+        if scores is None:
+            scores = self._load(user_id, now)
+        return {bathroom_id: self.decay(score, now - updated_at)
+                for bathroom_id, (score, updated_at) in list(scores.items())}
+
+    def _load(self, user_id, now):
+        # holding the db lock keeps a flush from moving visits out of the
+        # buffer between the read and the merge below
+        with self._db_lock:
+            rows = self._db.execute(
+                'SELECT bathroom_id, score, updated_at FROM visits WHERE user_id = ?',
+                (user_id,)).fetchall()
+            scores = {bathroom_id: [score, updated_at] for bathroom_id, score, updated_at in rows}
+            with self._lock:
+                # visits still waiting in the buffer aren't on disk yet
+                for (buffered_user, bathroom_id), (score, updated_at) in self._buffer.items():
+                    if buffered_user != user_id:
+                        continue
+                    old = scores.get(bathroom_id)
+                    if old is not None:
+                        score += self.decay(old[0], updated_at - old[1])
+                    scores[bathroom_id] = [score, updated_at]
+                self._users[user_id] = (now, scores)
+                self._users.move_to_end(user_id)
+                while len(self._users) > self.max_cached_users:
+                    self._users.popitem(last=False)
+        return scores
+
+    def flush(self):
+        with self._db_lock:
+            with self._lock:
+                batch, self._buffer = self._buffer, {}
+            now = time.time()
+            prune = self.horizon < math.inf and now - self._pruned_at >= PRUNE_INTERVAL
+            if not batch and not prune:
+                return 0
+            with self._db:
+                self._db.executemany(UPSERT, [
+                    (user_id, bathroom_id, score, updated_at)
+                    for (user_id, bathroom_id), (score, updated_at) in batch.items()
+                ])
+                if prune:
+                    self._db.execute('DELETE FROM visits WHERE updated_at < ?', (now - self.horizon,))
+                    self._pruned_at = now
+        return len(batch)
+
+    def start(self, register_exit=True):
+        if self._flusher is not None:
+            return
+
+        def run():
+            while True:
+                self._wake.wait(self.flush_interval)
+                self._wake.clear()
+                self.flush()
+
+        self._flusher = threading.Thread(target=run, name='history-flusher', daemon=True)
+        self._flusher.start()
+        if register_exit:
+            atexit.register(self.flush)
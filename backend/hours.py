@@ -0,0 +1,160 @@
+import re
+from datetime import datetime
+
+MINUTES_PER_DAY = 24 * 60
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+DAYS = ['mo', 'tu', 'we', 'th', 'fr', 'sa', 'su']
+# public and school holidays; a weekly schedule can't say when they are
+HOLIDAYS = ('ph', 'sh')
+ALWAYS_OPEN = [[0, MINUTES_PER_WEEK]]
+
+TIME_RANGE_RE = re.compile(r'(\d{1,2}):(\d\d)\s*-\s*(\d{1,2}):(\d\d)')
+DAY_RANGE_RE = re.compile(r'([a-z]{2})[a-z]*(?:\s*-\s*([a-z]{2})[a-z]*)?')
+
+
+def parse_day(value):
+    # 0 = Monday like datetime.weekday(); accepts ints and day names
+    if isinstance(value, int) and 0 <= value < 7:
+        return value
+    key = str(value).strip().lower()[:2]
+    if key.isdigit() and 0 <= int(key) < 7:
+        return int(key)
+    if key in DAYS:
+        return DAYS.index(key)
+    return None
+
+
+def _parse_days(spec):
+    days = []
+    for part in spec.split(','):
+        if part.strip() in HOLIDAYS:
+            continue
+        match = DAY_RANGE_RE.fullmatch(part.strip())
+        if not match or match.group(1) not in DAYS:
+            return None
+        first = DAYS.index(match.group(1))
+        if match.group(2) is None:
+            days.append(first)
+            continue
+        if match.group(2) not in DAYS:
+            return None
+        last = DAYS.index(match.group(2))
+        # ranges like "Sa-Mo" wrap around the week
+        days.extend((first + i) % 7 for i in range((last - first) % 7 + 1))
+    return days
+
+
+def _parse_times(spec):
+    ranges = []
+    for part in spec.split(','):
+        match = TIME_RANGE_RE.fullmatch(part.strip())
+        if not match:
+            return None
+        h1, m1, h2, m2 = (int(g) for g in match.groups())
+        # 24:00 only closes a range
+        if h1 > 23 or h2 > 24 or m1 > 59 or m2 > 59:
+            return None
+        start = h1 * 60 + m1
+        # the closing minute itself counts as open, like the old
+        # "start <= time <= end" check
+        end = min(h2 * 60 + m2 + 1, MINUTES_PER_DAY) if h2 * 60 + m2 >= start \
+            else h2 * 60 + m2 + 1 + MINUTES_PER_DAY
+        ranges.append((start, end))
+    return ranges
+
+
+def _merge(intervals):
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def compile_opening_hours(text):
+    """Compile an opening_hours string into minute-of-week intervals.
+
+    Returns a sorted list of [start, end) pairs where minute 0 is Monday
+    00:00, or None if the string can't be parsed. Understands plain daily
+    ranges ("08:00-22:00"), overnight ranges ("22:00-02:00"), "24/7" and
+    rules with days ("Mo-Fr 08:00-20:00; Sa 10:00-14:00; Su off"), where
+    a later rule overrides earlier ones for its days. Holiday rules
+    ("PH off") are left out, the schedule is the regular week.
+    """
+    if not isinstance(text, str) or not text.strip():
+        return None
+    text = text.strip().lower()
+    if text == '24/7':
+        return [list(i) for i in ALWAYS_OPEN]
+    # times per weekday; a rule replaces whatever earlier rules said
+    # about the days it names, "off" included
+    week = [[] for _ in DAYS]
+    weekly = False
+    for rule in text.split(';'):
+        rule = rule.strip()
+        if not rule:
+            continue
+        match = re.match(r'([a-z][a-z,\s-]*?)\s+(?=\d|off|closed)', rule)
+        days = list(range(7))
+        if match:
+            days = _parse_days(match.group(1))
+            if days is None:
+                return None
+            if not days:
+                # holidays only
+                continue
+            rule = rule[match.end():]
+        weekly = True
+        if rule in ('off', 'closed'):
+            times = []
+        else:
+            times = _parse_times(rule)
+            if times is None:
+                return None
+        for day in days:
+            week[day] = times
+    if not weekly:
+        return None
+    intervals = [(day * MINUTES_PER_DAY + start, day * MINUTES_PER_DAY + end)
+                 for day, times in enumerate(week) for start, end in times]
+    # overnight ranges on Sunday wrap into Monday morning
+    wrapped = []
+    for start, end in intervals:
+        if end > MINUTES_PER_WEEK:
+            wrapped.append((start, MINUTES_PER_WEEK))
+            wrapped.append((0, end - MINUTES_PER_WEEK))
+        else:
+            wrapped.append((start, end))
+    return _merge(wrapped)
+
+
+def bathroom_schedule(bathroom):
+    # precompiled form from normalize_data.py, else compile on the fly;
+    # unparsable hours count as always open
+    schedule = bathroom.get('opening_schedule')
+    if schedule is None:
+        schedule = compile_opening_hours(bathroom.get('opening_hours') or '00:00-23:59')
+    return schedule if schedule is not None else ALWAYS_OPEN
+
+
+def minute_of_week(current_time=None, day=None):
+    """Minute of the week for an "HH:MM" time and a weekday (default now)."""
+    now = datetime.now()
+    day = parse_day(day) if day is not None else None
+    if day is None:
+        day = now.weekday()
+    match = re.fullmatch(r'(\d{1,2}):(\d\d)', str(current_time or ''))
+    if match and int(match.group(1)) < 24 and int(match.group(2)) < 60:
+        minute = int(match.group(1)) * 60 + int(match.group(2))
+    else:
+        minute = now.hour * 60 + now.minute
+    return day * MINUTES_PER_DAY + minute
+
+
+def schedule_open(schedule, minute):
+    for start, end in schedule:
+        if start <= minute < end:
+            return True
+    return False
@@ -0,0 +1,87 @@
+import base64
+import hashlib
+import json
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+
+def query_hash(key):
+    """Short digest of a result cache key, minus the dataset version."""
+    return hashlib.sha1(json.dumps(key[:-1]).encode()).hexdigest()[:16]
+
+
+def encode_cursor(session_id, offset, query):
+    payload = json.dumps({'s': session_id, 'o': offset, 'q': query}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """(session_id, offset, query hash); ValueError if it isn't one of ours."""
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        session_id, offset, query = payload['s'], payload['o'], payload['q']
+    except (TypeError, ValueError, KeyError, AttributeError):
+        raise ValueError('malformed cursor')
+    if not isinstance(offset, int) or offset < 0:
+        raise ValueError('malformed cursor')
+    return session_id, offset, query
+
+
+class StreamSession:
+    __slots__ = ('stream', 'version', 'lock', 'expires')
+
+    def __init__(self, stream, version, expires):
+        self.stream = stream
+        self.version = version
+        self.lock = threading.Lock()
+        self.expires = expires
+
+
+class StreamSessions:
+    """Short-lived RankedStreams kept between page requests.
+
+    A stream holds every row it scored but hasn't returned yet, so the
+    next page usually needs no new scoring. Sessions expire after `ttl`
+    seconds without use and the least recently used go first past
+    `max_entries`; a cursor outliving its session restarts the ranking.
+    """
+
+    def __init__(self, max_entries=256, ttl=60.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self.resumed = 0
+        self.restarted = 0
+
+    def get(self, session_id, version):
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is not None and (session.expires < time.monotonic() or session.version != version):
+                del self._sessions[session_id]
+                session = None
+            if session is None:
+                self.restarted += 1
+                return None
+            session.expires = time.monotonic() + self.ttl
+            self._sessions.move_to_end(session_id)
+            self.resumed += 1
+            return session
+
+    def start(self, stream, version):
+        session_id = secrets.token_urlsafe(9)
+        session = StreamSession(stream, version, time.monotonic() + self.ttl)
+        with self._lock:
+            self._sessions[session_id] = session
+            while len(self._sessions) > self.max_entries:
+                self._sessions.popitem(last=False)
+        return session_id, session
+
+    def clear(self):
+        with self._lock:
+            self._sessions.clear()
+
+    def __len__(self):
+        return len(self._sessions)
@@ -1,66 +1,70 @@
-from datetime import datetime
+import heapq
+import math
+from hours import bathroom_schedule, minute_of_week, schedule_open
 AMENITIES_SCORE = 3
 CLEANLINESS_SCORE = 2
 DISTANCE_SCORE_FACTOR = 100
 MAX_DISTANCE_SCORE = 10
 SAFETY_SCORE = 2
+OPEN_SCORE = 5
 CROWD_SCORE = {
     'low': 3,
     'medium': 1,
     'high': 0
 }
+KM_PER_DEGREE = 111.32
 
 def simple_distance(lat1, lon1, lat2, lon2):
     # euclidean distance for simplicity
-    return ((lat1 - lat2) ** 2 + (lon1 - lon2) ** 2) ** 0.5
+    return math.sqrt((lat1 - lat2) ** 2 + (lon1 - lon2) ** 2)
 
-def is_open(bathroom, current_time):
-    oh = bathroom.get('opening_hours') or '00:00-23:59'
-    try:
-        start, end = str(oh).split('-')
-    except Exception:
-        # if opening hours aren't parsable, assume open
-        return True
-    return start <= current_time <= end
+def is_open(bathroom, current_time, day=None):
+    return schedule_open(bathroom_schedule(bathroom), minute_of_week(current_time, day))
 
-def rank_bathrooms(bathrooms, user_context, user_history, top_k=10):
-    urgency = user_context.get("urgency", "normal")
-    ranked = []
-    user_lat, user_lng = user_context['location']
-    current_time = user_context.get('time', datetime.now().strftime("%H:%M"))
-    for bathroom in bathrooms:
-        score = 0
-
-        if is_open(bathroom, current_time):
-            score += 5
+def distance_weight(urgency):
+    # reward closer bathrooms
+    if urgency == "high":
+        return 2      # prioritize closer bathrooms
+    if urgency == "low":
+        return 0.5
+    return 1
 
-        # intersect amenities with user preferences
-        score += len(
-            set(bathroom.get('amenities', [])) &
-            set(user_context.get('filters', {}).get('amenities', []))
-        ) * AMENITIES_SCORE
+def score_bathroom(bathroom, user_context, user_history, minute, weight, live_ratings=None):
+    score = 0
 
-        ratings = bathroom.get('ratings') or {}
-        score += ratings.get('cleanliness', 0.0) * CLEANLINESS_SCORE
-        score += ratings.get('safety', 0.0) * SAFETY_SCORE
-        crowd = bathroom.get('crowd_updates', 'medium').lower()
-        score += CROWD_SCORE.get(crowd, 1)
+    if schedule_open(bathroom_schedule(bathroom), minute):
+        score += OPEN_SCORE
 
-        dist = simple_distance(
-            user_lat, user_lng,
-            bathroom['location'][0], bathroom['location'][1]
-        )
-        # reward closer bathrooms
-        distance_weight = 1
-        if urgency == "high":
-            distance_weight = 2      # prioritize closer bathrooms
-        elif urgency == "low":
-            distance_weight = 0.5
+    # intersect amenities with user preferences
+    score += len(
+        set(bathroom.get('amenities', [])) &
+        set(user_context.get('filters', {}).get('amenities', []))
+    ) * AMENITIES_SCORE
 
-        score += max(0, MAX_DISTANCE_SCORE - dist * DISTANCE_SCORE_FACTOR * distance_weight)
-        score += user_history.get(bathroom.get("id"), 0)
+    ratings = (live_ratings or {}).get(bathroom.get('id')) or bathroom.get('ratings') or {}
+    score += ratings.get('cleanliness', 0.0) * CLEANLINESS_SCORE
+    score += ratings.get('safety', 0.0) * SAFETY_SCORE
+    crowd = bathroom.get('crowd_updates', 'medium').lower()
+    score += CROWD_SCORE.get(crowd, 1)
 
-        ranked.append((bathroom, score))
+    user_lat, user_lng = user_context['location']
+    dist = simple_distance(
+        user_lat, user_lng,
+        bathroom['location'][0], bathroom['location'][1]
+    )
+    score += max(0, MAX_DISTANCE_SCORE - dist * DISTANCE_SCORE_FACTOR * weight)
+    score += user_history.get(bathroom.get("id"), 0)
+    return score
 
-    ranked.sort(key=lambda x: x[1], reverse=True)
-    return [bathroom for bathroom, score in ranked[:top_k]]
+def rank_bathrooms(bathrooms, user_context, user_history, top_k=10, live_ratings=None):
+    # live_ratings: optional {bathroom_id: ratings} replacing the dataset's,
+    # see ReviewStore.live_ratings
+    urgency = user_context.get("urgency", "normal")
+    minute = minute_of_week(user_context.get('time'), user_context.get('day'))
+    weight = distance_weight(urgency)
+    scored = ((bathroom, score_bathroom(bathroom, user_context, user_history, minute, weight, live_ratings))
+              for bathroom in bathrooms)
+    # a heap of top_k instead of sorting everything; nlargest keeps the
+    # stable sort's order, so ties still go to the earlier bathroom
+    ranked = heapq.nlargest(top_k, scored, key=lambda x: x[1])
+    return [bathroom for bathroom, score in ranked]
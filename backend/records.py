@@ -0,0 +1,156 @@
+import sys
+import threading
+from collections.abc import Mapping
+
+from dataset_store import StringTable, encode_record
+
+# fields every record from normalize_data.py/ingest has; anything else
+# (merged_sources, ...) goes to a per-record dict
+RECORD_FIELDS = ('id', 'name', 'amenities', 'location', 'ratings', 'opening_hours',
+                 'opening_schedule', 'crowd_updates', 'source', 'fetched_at')
+_FIELD_SET = frozenset(RECORD_FIELDS)
+# what the app's list and detail screens read; "fields": "lean" selects it
+LEAN_FIELDS = ('id', 'name', 'location', 'amenities', 'ratings', 'opening_hours', 'crowd_updates')
+PROJECTIONS = {'full': None, 'lean': LEAN_FIELDS}
+# projected fragments are encoded on first use; past this many per
+# projection the cache starts over
+MAX_PROJECTED = 200000
+
+
+class BathroomRecord(Mapping):
+    """Read-only bathroom record with slots instead of a dict.
+
+    Reads like the dict it was built from. Values that repeat across
+    records (tags, hours, crowd levels, schedules, equal ratings) are
+    shared, lists become tuples, and the key order is one shared tuple.
+    """
+
+    __slots__ = ('_keys', '_extra') + RECORD_FIELDS
+
+    def __getitem__(self, key):
+        if key in _FIELD_SET:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        if self._extra is None:
+            raise KeyError(key)
+        return self._extra[key]
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def __repr__(self):
+        return f'BathroomRecord({dict(self)!r})'
+
+
+class Interner:
+    """Hands out one shared copy of each distinct value."""
+
+    def __init__(self):
+        self._values = {}
+
+    def share(self, value):
+        if isinstance(value, str):
+            return sys.intern(value)
+        frozen = _freeze(value)
+        if frozen is None:
+            return value
+        return self._values.setdefault(frozen, _shared(value, self))
+
+
+def _freeze(value):
+    # hashable stand-in for a JSON value, None if part of it isn't hashable
+    if isinstance(value, (list, tuple)):
+        items = tuple(_freeze(v) for v in value)
+        return None if None in items else ('list', items)
+    if isinstance(value, dict):
+        items = tuple((k, _freeze(v)) for k, v in value.items())
+        return None if any(f is None for _, f in items) else ('dict', items)
+    try:
+        hash(value)
+    except TypeError:
+        return None
+    return (type(value).__name__, value)
+
+
+def _shared(value, interner):
+    if isinstance(value, (list, tuple)):
+        return tuple(interner.share(v) for v in value)
+    if isinstance(value, dict):
+        return {sys.intern(k): interner.share(v) for k, v in value.items()}
+    return value
+
+
+def compact_record(bathroom, interner):
+    record = BathroomRecord.__new__(BathroomRecord)
+    record._keys = interner.share(tuple(bathroom))
+    extra = None
+    for key, value in bathroom.items():
+        if key == 'location' and isinstance(value, list):
+            # unique per bathroom, not worth a lookup
+            value = tuple(value)
+        elif key not in ('id', 'fetched_at'):
+            value = interner.share(value)
+        if key in _FIELD_SET:
+            setattr(record, key, value)
+        else:
+            if extra is None:
+                extra = {}
+            extra[key] = value
+    record._extra = extra
+    return record
+
+
+def compact_records(bathrooms):
+    """BathroomRecords for a list of bathroom dicts."""
+    interner = Interner()
+    return [compact_record(b, interner) for b in bathrooms]
+
+
+def project(record, fields):
+    return {key: record[key] for key in fields if key in record}
+
+
+class RecordFragments:
+    """Each row's JSON encoded once, so a response is a join of bytes.
+
+    The full record comes from the store's own string table, or is encoded
+    for every row up front for in-memory datasets. Projections are encoded
+    the first time a row is served with them.
+    """
+
+    def __init__(self, bathrooms):
+        self.bathrooms = bathrooms
+        self.full = getattr(bathrooms, 'fragments', None)
+        if self.full is None and isinstance(bathrooms, list):
+            self.full = StringTable.from_bytes([encode_record(b) for b in bathrooms])
+        self._projected = {name: {} for name in PROJECTIONS if PROJECTIONS[name] is not None}
+        self._lock = threading.Lock()
+
+    def get(self, row, projection='full'):
+        fields = PROJECTIONS[projection]
+        if fields is None:
+            if self.full is not None:
+                return self.full.bytes_at(row)
+            return encode_record(self.bathrooms[row])
+        cache = self._projected[projection]
+        fragment = cache.get(row)
+        if fragment is None:
+            fragment = encode_record(project(self.bathrooms[row], fields))
+            with self._lock:
+                if len(cache) >= MAX_PROJECTED:
+                    cache.clear()
+                cache[row] = fragment
+        return fragment
+
+    def encode(self, record, projection='full'):
+        """Fragment for a record that differs from the stored one."""
+        fields = PROJECTIONS[projection]
+        return encode_record(record if fields is None else project(record, fields))
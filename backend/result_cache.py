@@ -0,0 +1,126 @@
+import threading
+import time
+from collections import OrderedDict
+
+from hours import MINUTES_PER_DAY, minute_of_week
+
+
+class CacheEntry:
+    __slots__ = ('key', 'rows', 'context', 'tau', 'expires')
+
+    def __init__(self, key, rows, context, tau, expires):
+        self.key = key
+        self.rows = rows
+        self.context = context
+        self.tau = tau
+        self.expires = expires
+
+
+class ResultCache:
+    """Bounded LRU + TTL cache of candidate rows per request region.
+
+    Requests are keyed on a location snapped to a grid cell, a time bucket,
+    urgency, the normalized filters, the user and the dataset version. An
+    entry holds every row that can make the top k anywhere in the cell
+    during the bucket (see columnar.region_candidates), found once for a
+    representative context (cell center, bucket start); each request then
+    ranks just those rows at its own location and time, so a hit returns
+    exactly what a full ranking would.
+    """
+
+    def __init__(self, max_entries=1024, ttl=60.0, cell_size=0.002, time_bucket=15):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.cell_size = cell_size
+        self.time_bucket = time_bucket
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def key(self, user_context, version=0):
+        lat, lng = user_context['location']
+        filters = user_context.get('filters', {})
+        minute = minute_of_week(user_context.get('time'), user_context.get('day'))
+        return (
+            int(lat // self.cell_size), int(lng // self.cell_size),
+            minute // self.time_bucket,
+            user_context.get('urgency', 'normal'),
+            tuple(sorted(set(filters.get('amenities', [])))) if 'amenities' in filters else None,
+            filters.get('crowd'),
+            user_context.get('max_radius_km'),
+            user_context.get('user_id'),
+            user_context.get('model'),
+            version,
+        )
+
+    def exact(self, user_context):
+        """The context with its minute of the week pinned, so the key and the
+        ranking can't see different times when the request has none."""
+        minute = minute_of_week(user_context.get('time'), user_context.get('day'))
+        context = dict(user_context)
+        context['day'] = minute // MINUTES_PER_DAY
+        context['time'] = '%02d:%02d' % divmod(minute % MINUTES_PER_DAY, 60)
+        return context
+
+    def region(self, key):
+        """(box, minutes) the key covers: (lat0, lat1, lon0, lon1) and [start, end)."""
+        size = self.cell_size
+        box = (key[0] * size, (key[0] + 1) * size, key[1] * size, (key[1] + 1) * size)
+        return box, (key[2] * self.time_bucket, (key[2] + 1) * self.time_bucket)
+
+    def representative(self, user_context, key):
+        """The context every request with this key gets ranked as."""
+        minute = key[2] * self.time_bucket
+        context = dict(user_context)
+        context['location'] = [(key[0] + 0.5) * self.cell_size, (key[1] + 0.5) * self.cell_size]
+        context['day'] = minute // MINUTES_PER_DAY
+        context['time'] = '%02d:%02d' % divmod(minute % MINUTES_PER_DAY, 60)
+        return context
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires < time.monotonic():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry.rows
+
+    def put(self, key, rows, context, tau):
+        with self._lock:
+            self._entries[key] = CacheEntry(key, rows, context, tau, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate_where(self, predicate):
+        """Drop entries for which predicate(entry) is true."""
+        with self._lock:
+            stale = [key for key, entry in self._entries.items() if predicate(entry)]
+            for key in stale:
+                del self._entries[key]
+            self.invalidations += len(stale)
+        return len(stale)
+
+    def clear(self):
+        with self._lock:
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "entries": len(self._entries),
+            }
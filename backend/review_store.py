@@ -0,0 +1,298 @@
+import atexit
+import os
+import sqlite3
+import threading
+import time
+import weakref
+from collections import deque
+
+import numpy as np
+
+from ranking import CLEANLINESS_SCORE, SAFETY_SCORE
+
+REVIEW_FIELDS = ('cleanliness', 'safety', 'overall')
+MIN_RATING = 1.0
+MAX_RATING = 5.0
+DEFAULT_HALF_LIFE_DAYS = 180
+# the dataset's own rating counts as this many reviews; unrated (0.0)
+# fields take the reviews as they are
+PRIOR_WEIGHT = 3.0
+# changed bathrooms kept for patching views; a view further behind is rebuilt
+CHANGE_LOG_SIZE = 4096
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS reviews (
+    bathroom_id TEXT NOT NULL,
+    field TEXT NOT NULL,
+    total REAL NOT NULL,
+    count INTEGER NOT NULL,
+    recent_total REAL NOT NULL,
+    recent_weight REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (bathroom_id, field)
+)
+"""
+
+UPSERT = """
+INSERT INTO reviews (bathroom_id, field, total, count, recent_total, recent_weight, updated_at)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (bathroom_id, field) DO UPDATE SET
+    total = total + excluded.total,
+    count = count + excluded.count,
+    recent_total = decay(recent_total, updated_at, excluded.updated_at) + excluded.recent_total,
+    recent_weight = decay(recent_weight, updated_at, excluded.updated_at) + excluded.recent_weight,
+    updated_at = MAX(updated_at, excluded.updated_at)
+"""
+
+
+class RatingsView:
+    """Live cleanliness/safety for one snapshot's reviewed rows.
+
+    `rows` is sorted and `cleanliness`/`safety` line up with it. `raised`
+    holds the rows whose live ratings score above their dataset ones.
+    """
+
+    def __init__(self, rows, cleanliness, safety, raised):
+        self.rows = rows
+        self.cleanliness = cleanliness
+        self.safety = safety
+        self.raised = raised
+
+    def __len__(self):
+        return len(self.rows)
+
+    def lookup(self, rows):
+        """(mask over rows that have live ratings, their positions in the view)."""
+        if not len(self.rows):
+            return np.zeros(len(rows), dtype=bool), np.zeros(len(rows), dtype=np.int64)
+        pos = np.minimum(np.searchsorted(self.rows, rows), len(self.rows) - 1)
+        return self.rows[pos] == rows, pos
+
+
+EMPTY_RATINGS = RatingsView(np.empty(0, dtype=np.int64), np.empty(0), np.empty(0),
+                            np.empty(0, dtype=np.int64))
+
+
+class ReviewStore:
+    """Running review aggregates per bathroom, checkpointed to SQLite.
+
+    Each (bathroom, field) keeps a plain sum and count of the ratings and
+    a recency-weighted sum and weight that halve every half-life, so a
+    review is O(1) to apply. Reviews update the in-memory aggregates at
+    once and are written as deltas by a background checkpoint; other
+    processes' reviews are picked up when the same thread reloads the
+    aggregates every `refresh_interval` seconds.
+    """
+
+    def __init__(self, path, half_life_days=DEFAULT_HALF_LIFE_DAYS, prior_weight=PRIOR_WEIGHT,
+                 checkpoint_interval=5.0, refresh_interval=30.0):
+        self.path = path
+        self.half_life = half_life_days * 86400.0 if half_life_days else None
+        self.prior_weight = prior_weight
+        self.checkpoint_interval = checkpoint_interval
+        self.refresh_interval = refresh_interval
+        self._checkpointer = None
+        self._reset()
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        # (bathroom_id, field) -> [total, count, recent_total, recent_weight, updated_at]
+        self._aggregates = {}
+        # the same, for reviews not yet checkpointed
+        self._pending = {}
+        self._generation = 0
+        # (generation, bathroom_id) of every change, one per generation
+        self._changes = deque(maxlen=CHANGE_LOG_SIZE)
+        # one view per snapshot (or shard) in use; dropped with it
+        self._views = weakref.WeakKeyDictionary()
+        self._wake = threading.Event()
+
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.create_function('decay', 3, self._decay_to, deterministic=True)
+        self._db.execute(SCHEMA)
+        self._db.commit()
+        self.refresh()
+
+    def _after_fork(self):
+        # like HistoryStore: a worker opens its own connection and
+        # checkpoints its own reviews
+        self._reset()
+        if self._checkpointer is not None:
+            self._checkpointer = None
+            self.start(register_exit=False)
+
+    def decay(self, value, elapsed):
+        if self.half_life is None or elapsed <= 0:
+            return value
+        return value * 0.5 ** (elapsed / self.half_life)
+
+    def _decay_to(self, value, since, until):
+        return self.decay(value, until - since)
+
+    def _add(self, entry, value, now):
+        if entry is None:
+            return [value, 1, value, 1.0, now]
+        factor = self.decay(1.0, now - entry[4])
+        return [entry[0] + value, entry[1] + 1, entry[2] * factor + value,
+                entry[3] * factor + 1.0, max(now, entry[4])]
+
+    def record(self, bathroom_id, ratings, now=None):
+        """Apply one review, {field: rating}, and return the new summary."""
+        now = time.time() if now is None else now
+        with self._lock:
+            for field, value in ratings.items():
+                key = (bathroom_id, field)
+                self._aggregates[key] = self._add(self._aggregates.get(key), float(value), now)
+                self._pending[key] = self._add(self._pending.get(key), float(value), now)
+            self._changed(bathroom_id)
+            return self._summary(bathroom_id)
+
+    def _changed(self, bathroom_id):
+        self._generation += 1
+        self._changes.append((self._generation, bathroom_id))
+
+    def summary(self, bathroom_id):
+        with self._lock:
+            return self._summary(bathroom_id)
+
+    def _summary(self, bathroom_id):
+        summary = {}
+        for field in REVIEW_FIELDS:
+            entry = self._aggregates.get((bathroom_id, field))
+            if entry is not None:
+                summary[field] = {'average': entry[0] / entry[1], 'recent': entry[2] / entry[3],
+                                  'count': entry[1]}
+        return summary
+
+    def live_rating(self, dataset_value, entry):
+        # recency-weighted mean of the reviews, with the dataset value as a prior
+        prior = self.prior_weight if dataset_value else 0.0
+        return (dataset_value * prior + entry[2]) / (prior + entry[3])
+
+    def live_ratings(self, bathrooms):
+        """{bathroom_id: ratings} with live values, for ranking.rank_bathrooms."""
+        live = {}
+        with self._lock:
+            for bathroom in bathrooms:
+                bathroom_id = bathroom.get('id')
+                if bathroom_id in live:
+                    continue
+                ratings = dict(bathroom.get('ratings') or {})
+                changed = False
+                for field in REVIEW_FIELDS:
+                    entry = self._aggregates.get((bathroom_id, field))
+                    if entry is not None:
+                        ratings[field] = self.live_rating(ratings.get(field) or 0.0, entry)
+                        changed = True
+                if changed:
+                    live[bathroom_id] = ratings
+        return live
+
+    def checkpoint(self):
+        with self._db_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+            if not batch:
+                return 0
+            with self._db:
+                self._db.executemany(UPSERT, [
+                    (bathroom_id, field, *entry)
+                    for (bathroom_id, field), entry in batch.items()
+                ])
+        return len(batch)
+
+    def refresh(self):
+        """Reload the aggregates from disk, keeping reviews not yet checkpointed."""
+        with self._db_lock:
+            rows = self._db.execute(
+                'SELECT bathroom_id, field, total, count, recent_total, recent_weight, updated_at '
+                'FROM reviews').fetchall()
+            aggregates = {(bathroom_id, field): list(entry) for bathroom_id, field, *entry in rows}
+            with self._lock:
+                for key, (total, count, recent_total, recent_weight, updated_at) in self._pending.items():
+                    old = aggregates.get(key)
+                    if old is not None:
+                        factor = self.decay(1.0, updated_at - old[4])
+                        total += old[0]
+                        count += old[1]
+                        recent_total += old[2] * factor
+                        recent_weight += old[3] * factor
+                        updated_at = max(updated_at, old[4])
+                    aggregates[key] = [total, count, recent_total, recent_weight, updated_at]
+                old = self._aggregates
+                changed = {bathroom_id for bathroom_id, field in old.keys() | aggregates.keys()
+                           if old.get((bathroom_id, field)) != aggregates.get((bathroom_id, field))}
+                self._aggregates = aggregates
+                self._loaded_at = time.monotonic()
+                for bathroom_id in changed:
+                    self._changed(bathroom_id)
+
+    def view(self, columns):
+        """RatingsView of the live ratings for `columns`' rows.
+
+        Requests share one view until a review arrives or a refresh
+        changes some aggregates; then the view is patched for the
+        bathrooms that changed.
+        """
+        with self._lock:
+            cached = self._views.get(columns)
+            if cached is not None and cached[0] == self._generation:
+                return cached[1]
+            if cached is not None and self._changes and self._changes[0][0] <= cached[0] + 1:
+                changed = {bathroom_id for generation, bathroom_id in self._changes if generation > cached[0]}
+                view = self._patched(cached[1], columns, changed)
+            else:
+                view = self._patched(EMPTY_RATINGS, columns, {bathroom_id for bathroom_id, _ in self._aggregates})
+            self._views[columns] = (self._generation, view)
+            return view
+
+    def _patched(self, view, columns, changed):
+        # `view` with the rows of the changed bathrooms replaced by their live ratings
+        drop, rows, cleanliness, safety = [], [], [], []
+        for bathroom_id in changed:
+            fields = {field: self._aggregates.get((bathroom_id, field)) for field in REVIEW_FIELDS}
+            reviewed = any(entry is not None for entry in fields.values())
+            for row in columns.id_rows.get(bathroom_id, ()):
+                drop.append(row)
+                if not reviewed:
+                    continue
+                # overall-only reviews keep the dataset's values but still
+                # mark the row, so responses show the live overall
+                rows.append(row)
+                clean, safe = columns.cleanliness[row], columns.safety[row]
+                entry = fields['cleanliness']
+                cleanliness.append(clean if entry is None else self.live_rating(clean, entry))
+                entry = fields['safety']
+                safety.append(safe if entry is None else self.live_rating(safe, entry))
+        keep = ~np.isin(view.rows, drop)
+        rows = np.concatenate([view.rows[keep], np.array(rows, dtype=np.int64)])
+        if not len(rows):
+            return EMPTY_RATINGS
+        cleanliness = np.concatenate([view.cleanliness[keep], np.array(cleanliness, dtype=np.float64)])
+        safety = np.concatenate([view.safety[keep], np.array(safety, dtype=np.float64)])
+        order = np.argsort(rows, kind='stable')
+        rows, cleanliness, safety = rows[order], cleanliness[order], safety[order]
+        live = cleanliness * CLEANLINESS_SCORE + safety * SAFETY_SCORE
+        dataset = columns.cleanliness[rows] * CLEANLINESS_SCORE + columns.safety[rows] * SAFETY_SCORE
+        return RatingsView(rows, cleanliness, safety, rows[live > dataset])
+
+    def start(self, register_exit=True):
+        if self._checkpointer is not None:
+            return
+
+        def run():
+            while True:
+                self._wake.wait(min(self.checkpoint_interval, self.refresh_interval))
+                self._wake.clear()
+                self.checkpoint()
+                if time.monotonic() - self._loaded_at >= self.refresh_interval:
+                    self.refresh()
+
+        self._checkpointer = threading.Thread(target=run, name='review-checkpointer', daemon=True)
+        self._checkpointer.start()
+        if register_exit:
+            atexit.register(self.checkpoint)
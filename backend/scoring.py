@@ -0,0 +1,141 @@
+import hashlib
+import json
+import math
+
+import numpy as np
+
+from ranking import AMENITIES_SCORE, CLEANLINESS_SCORE, OPEN_SCORE, SAFETY_SCORE
+
+# rows of the feature matrix, in the order rank_bathrooms adds its terms;
+# crowd, proximity and history are already points (CROWD_SCORE, the
+# distance falloff, visit boosts), so their default weight is 1
+FEATURES = ('open', 'amenities', 'cleanliness', 'safety', 'crowd', 'proximity', 'history')
+OPEN, AMENITIES, CLEANLINESS, SAFETY, CROWD, PROXIMITY, HISTORY = range(len(FEATURES))
+DEFAULT_WEIGHTS = {
+    'open': OPEN_SCORE,
+    'amenities': AMENITIES_SCORE,
+    'cleanliness': CLEANLINESS_SCORE,
+    'safety': SAFETY_SCORE,
+    'crowd': 1,
+    'proximity': 1,
+    'history': 1,
+}
+DEFAULT_MODEL_NAME = 'default'
+
+
+class ScoringModel:
+    """A weight per feature; a row's score is its feature column times the weights.
+
+    Features left out of `weights` keep their default weight. Weights
+    must be non-negative: the spatial search bounds what unscored rows
+    could reach, which only holds if no feature lowers the score.
+    """
+
+    def __init__(self, name, weights=None):
+        weights = dict(weights or {})
+        unknown = set(weights) - set(FEATURES)
+        if unknown:
+            raise ValueError(f'scoring model {name!r} has unknown features: {", ".join(sorted(unknown))}')
+        values = [float(weights.get(feature, DEFAULT_WEIGHTS[feature])) for feature in FEATURES]
+        if any(not math.isfinite(v) or v < 0 for v in values):
+            raise ValueError(f'scoring model {name!r} needs finite, non-negative weights')
+        self.name = name
+        self.weights = np.array(values)
+        self.key = tuple(values)
+        self._terms = [(i, weight) for i, weight in enumerate(values) if i and weight]
+
+    @property
+    def is_default(self):
+        return self.key == DEFAULT_MODEL.key
+
+    def __getitem__(self, feature):
+        return float(self.weights[FEATURES.index(feature)])
+
+    def apply(self, features):
+        """Scores for a (len(FEATURES), rows) feature matrix, weights @ features.
+
+        Summed term by term in FEATURES order, so the default weights give
+        exactly rank_bathrooms' floats. Zero weights are skipped and unit
+        weights aren't multiplied, neither of which changes a float.
+        """
+        score = features[0] * self.weights[0]
+        for i, weight in self._terms:
+            add_weighted(score, features[i], weight)
+        return score
+
+    def __repr__(self):
+        return f'ScoringModel({self.name!r}, {dict(zip(FEATURES, self.key))!r})'
+
+
+def add_weighted(score, values, weight):
+    """score += values * weight, in place."""
+    if weight == 1.0:
+        score += values
+    elif weight:
+        score += values * weight
+
+
+DEFAULT_MODEL = ScoringModel(DEFAULT_MODEL_NAME)
+
+
+class ScoringModels:
+    """The weight sets a request can be scored with.
+
+    Loaded from JSON like
+    {"default": "default",
+     "models": {"default": {}, "near_first": {"proximity": 2}},
+     "split": {"default": 0.9, "near_first": 0.1}}
+    A request names its model with "model"; otherwise `split` assigns
+    each user a model by a hash of their id (the shares are normalized),
+    and without a split everyone gets the default.
+    """
+
+    def __init__(self, models=None, default=DEFAULT_MODEL_NAME, split=None):
+        self.models = {DEFAULT_MODEL_NAME: DEFAULT_MODEL}
+        self.models.update(models or {})
+        if default not in self.models:
+            raise ValueError(f'default scoring model {default!r} is not defined')
+        self.default = self.models[default]
+        self.split = []
+        split = {name: float(share) for name, share in (split or {}).items() if float(share) > 0}
+        for name in split:
+            if name not in self.models:
+                raise ValueError(f'split names undefined scoring model {name!r}')
+        total = sum(split.values())
+        cumulative = 0.0
+        for name, share in sorted(split.items()):
+            cumulative += share / total
+            self.split.append((cumulative, self.models[name]))
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+        models = {name: ScoringModel(name, weights) for name, weights in config.get('models', {}).items()}
+        return cls(models, config.get('default', DEFAULT_MODEL_NAME), config.get('split'))
+
+    def get(self, name=None):
+        """The named model, the default for None; KeyError if unknown."""
+        if name is None:
+            return self.default
+        return self.models[name]
+
+    def choose(self, user_context, user_id):
+        """The model for a request: named in it, else by the user's split bucket."""
+        name = user_context.get('model')
+        if name is not None:
+            return self.get(str(name))
+        if not self.split:
+            return self.default
+        digest = hashlib.sha1(user_id.encode()).digest()
+        bucket = int.from_bytes(digest[:8], 'big') / 2.0 ** 64
+        for cumulative, model in self.split:
+            if bucket < cumulative:
+                return model
+        return self.split[-1][1]
+
+    def __iter__(self):
+        return iter(self.models.values())
+
+    def __len__(self):
+        return len(self.models)
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from dataset_store import default_data_path, open_dataset  # noqa: E402
+from snapshot import DatasetSnapshot  # noqa: E402
+from tiles import HOURS_PER_WEEK, MAX_TILE_CANDIDATES, TILE_CELL_SIZE, TileSet  # noqa: E402
+
+
+DATA_DIR = os.path.normpath(os.path.join(os.path.dirname(__file__), "..", "data"))
+DATA_FILE = default_data_path(DATA_DIR)
+TILES_FILE = os.path.join(DATA_DIR, "tiles.npz")
+
+
+def main(args):
+    start = time.perf_counter()
+    snapshot = DatasetSnapshot(open_dataset(args.input), 0)
+    print(f"Loaded {len(snapshot.bathrooms)} bathrooms in {time.perf_counter() - start:.2f}s")
+
+    options = dict(top_k=args.top_k, cell_size=args.cell_size, max_candidates=args.max_candidates,
+                   max_tiles=args.max_tiles)
+    if os.path.exists(args.output) and not args.full:
+        # keep every tile the dataset change didn't touch
+        tiles = TileSet.load(args.output, snapshot.columns, snapshot.index, **options)
+        print(f"Kept {len(tiles)} tiles from {args.output}")
+    else:
+        tiles = TileSet(snapshot.columns, snapshot.index, **options)
+
+    cells = tiles.populated_cells()
+    step = max(1, len(cells) // 20)
+
+    def progress(done, total):
+        if done % step == 0 or done == total:
+            print(f"  {done}/{total} cells, {len(tiles)} tiles, {time.perf_counter() - start:.1f}s", flush=True)
+
+    built = tiles.build_all(cells, skip_existing=not args.full, progress=progress)
+    empty = sum(1 for rows, _ in tiles.tiles.values() if rows is None)
+    print(f"Built {built} tiles over {len(cells)} cells x {HOURS_PER_WEEK} hours x 3 urgencies "
+          f"({empty} too wide to store)")
+    if args.dry_run:
+        print("Dry run — tiles not written.")
+        return
+    tmp = args.output + ".tmp.npz"
+    tiles.save(tmp)
+    os.replace(tmp, args.output)
+    print(f"Wrote {len(tiles) - empty} tiles to {args.output} in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Precompute top-k candidate tiles for unfiltered requests")
+    parser.add_argument("--input", default=DATA_FILE)
+    parser.add_argument("--output", default=TILES_FILE)
+    parser.add_argument("--full", action="store_true", help="Rebuild every tile instead of only changed ones")
+    parser.add_argument("--dry-run", action="store_true")
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--cell-size", type=float, default=TILE_CELL_SIZE, help="Tile size in degrees")
+    parser.add_argument("--max-candidates", type=int, default=MAX_TILE_CANDIDATES)
+    parser.add_argument("--max-tiles", type=int, default=2000000, help="Tiles kept in memory while building")
+    args = parser.parse_args()
+    main(args)
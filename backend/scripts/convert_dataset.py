@@ -0,0 +1,40 @@
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from changelog import save_versioned  # noqa: E402
+from dataset_store import JSON_NAME, STORE_NAME, load_dataset  # noqa: E402
+
+
+DATA_DIR = os.path.normpath(os.path.join(os.path.dirname(__file__), "..", "data"))
+
+
+def main(args):
+    if args.to_json:
+        src = args.input or os.path.join(DATA_DIR, STORE_NAME)
+        dst = args.output or os.path.join(DATA_DIR, JSON_NAME)
+    else:
+        src = args.input or os.path.join(DATA_DIR, JSON_NAME)
+        dst = args.output or os.path.join(DATA_DIR, STORE_NAME)
+    if args.to_json and dst.endswith(".bin"):
+        sys.exit("--to-json output must not end in .bin")
+    if not args.to_json and not dst.endswith(".bin"):
+        sys.exit("binary store output must end in .bin")
+
+    start = time.time()
+    data = load_dataset(src)
+    version = save_versioned(dst, data, "convert_dataset")
+    print(f"Converted {len(data)} entries {src} -> {dst} "
+          f"({os.path.getsize(src)} -> {os.path.getsize(dst)} bytes, {time.time() - start:.2f}s); "
+          f"changelog version {version}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert the bathrooms dataset between JSON and the binary store")
+    parser.add_argument("--to-json", action="store_true", help="Convert the binary store back to JSON (default: JSON -> binary)")
+    parser.add_argument("--input", help="Source file (default: data/bathrooms.json or data/bathrooms.bin)")
+    parser.add_argument("--output", help="Destination file")
+    args = parser.parse_args()
+    main(args)
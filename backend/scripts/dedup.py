@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+import argparse
+import math
+import os
+import re
+import shutil
+import sys
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from changelog import save_versioned  # noqa: E402
+from dataset_store import default_data_path, load_dataset  # noqa: E402
+
+
+DATA_FILE = default_data_path(os.path.normpath(os.path.join(os.path.dirname(__file__), "..", "data")))
+METERS_PER_DEGREE = 111320.0
+DEFAULT_RADIUS_M = 75.0
+DEFAULT_THRESHOLD = 0.8
+# words that say what a place is, not which place it is
+GENERIC_TOKENS = {
+    "the", "a", "an", "of", "at", "and", "&", "public", "restroom", "restrooms", "bathroom",
+    "bathrooms", "toilet", "toilets", "wc", "washroom", "men", "mens", "women", "womens",
+    "unisex", "all", "gender", "family",
+}
+TOKEN_RE = re.compile(r"[a-z0-9&]+")
+
+
+def name_tokens(name):
+    """Lowercased name words, possessives folded and generic words dropped."""
+    text = (name or "").lower().replace("'s", "s").replace("’s", "s")
+    return frozenset(t for t in TOKEN_RE.findall(text) if t not in GENERIC_TOKENS)
+
+
+def name_similarity(a, b):
+    """Overlap of two token sets relative to the smaller one.
+
+    "Starbucks" and "Starbucks - Main St" score 1.0. Two purely generic
+    names ("Public Restroom", "Restroom") both reduce to no tokens and also
+    score 1.0, so nearby ones still merge; location decides the rest.
+    """
+    if not a or not b:
+        return 1.0 if a == b else 0.0
+    return len(a & b) / min(len(a), len(b))
+
+
+def _location(record):
+    loc = record.get("location")
+    if not isinstance(loc, (list, tuple)) or len(loc) < 2:
+        return None
+    try:
+        return float(loc[0]), float(loc[1])
+    except (TypeError, ValueError):
+        return None
+
+
+def merge_records(target, other):
+    """Fold what `other` knows into `target`, keeping target's id and name.
+
+    Returns True if target changed.
+    """
+    changed = False
+    amenities = list(target.get("amenities") or [])
+    for tag in other.get("amenities") or []:
+        if tag not in amenities:
+            amenities.append(tag)
+    if amenities != (target.get("amenities") or []):
+        target["amenities"] = amenities
+        changed = True
+
+    ratings = dict(target.get("ratings") or {})
+    for key, value in (other.get("ratings") or {}).items():
+        if value and not ratings.get(key):
+            ratings[key] = value
+    if ratings != (target.get("ratings") or {}):
+        target["ratings"] = ratings
+        changed = True
+
+    # real hours beat the always-open default ingest fills in
+    hours = other.get("opening_hours")
+    if hours and hours != "00:00-23:59" and target.get("opening_hours") in (None, "", "00:00-23:59"):
+        target["opening_hours"] = hours
+        target.pop("opening_schedule", None)
+        changed = True
+
+    if target.get("crowd_updates") in (None, "", "unknown") and other.get("crowd_updates") not in (None, "", "unknown"):
+        target["crowd_updates"] = other["crowd_updates"]
+        changed = True
+
+    # remember upstream copies so later ingests match them by external_id
+    source = other.get("source") or {}
+    if source.get("external_id") is not None and source != target.get("source"):
+        merged = target.setdefault("merged_sources", [])
+        if source not in merged:
+            merged.append(source)
+            changed = True
+    return changed
+
+
+class DedupIndex:
+    """Finds likely duplicates among records as they are added.
+
+    Records are bucketed in a lat/lon grid with cells `radius_m` tall, so a
+    lookup only compares names against records in the neighbouring cells.
+    Two records match when they are within `radius_m` of each other and
+    their names reach `threshold` in `name_similarity`.
+    """
+
+    def __init__(self, radius_m=DEFAULT_RADIUS_M, threshold=DEFAULT_THRESHOLD):
+        self.radius_m = radius_m
+        self.threshold = threshold
+        self.cell_size = radius_m / METERS_PER_DEGREE
+        self.records = []
+        self._tokens = []
+        self._points = []
+        self._cells = {}
+
+    def __len__(self):
+        return len(self.records)
+
+    def _cell(self, lat, lon):
+        return (math.floor(lat / self.cell_size), math.floor(lon / self.cell_size))
+
+    def matches(self, record):
+        """Positions of indexed records that look like `record`, best first."""
+        point = _location(record)
+        if point is None:
+            return []
+        lat, lon = point
+        tokens = name_tokens(record.get("name"))
+        clat, clon = self._cell(lat, lon)
+        # lon degrees shrink with latitude, so more lon cells cover the radius
+        span = math.ceil(1 / max(math.cos(math.radians(lat)), 0.01))
+        lon_scale = math.cos(math.radians(lat))
+        found = []
+        for i in range(clat - 1, clat + 2):
+            for j in range(clon - span, clon + span + 1):
+                for pos in self._cells.get((i, j), ()):
+                    other_lat, other_lon = self._points[pos]
+                    meters = math.hypot(lat - other_lat, (lon - other_lon) * lon_scale) * METERS_PER_DEGREE
+                    if meters > self.radius_m:
+                        continue
+                    similarity = name_similarity(tokens, self._tokens[pos])
+                    if similarity >= self.threshold:
+                        found.append((-similarity, meters, pos))
+        found.sort()
+        return [pos for _, _, pos in found]
+
+    def find(self, record):
+        found = self.matches(record)
+        return found[0] if found else None
+
+    def add(self, record):
+        pos = len(self.records)
+        self.records.append(record)
+        self._tokens.append(name_tokens(record.get("name")))
+        point = _location(record)
+        self._points.append(point)
+        if point is not None:
+            self._cells.setdefault(self._cell(*point), []).append(pos)
+        return pos
+
+    def add_or_merge(self, record):
+        """Index `record`, or merge it into its duplicate.
+
+        Returns (position, merged) where merged is None for a new record and
+        otherwise whether the existing record changed.
+        """
+        pos = self.find(record)
+        if pos is None:
+            return self.add(record), None
+        return pos, merge_records(self.records[pos], record)
+
+
+def dedupe(records, radius_m=DEFAULT_RADIUS_M, threshold=DEFAULT_THRESHOLD):
+    """Return (kept records, number merged away), keeping first occurrences."""
+    index = DedupIndex(radius_m, threshold)
+    merged = 0
+    for record in records:
+        _, result = index.add_or_merge(record)
+        if result is not None:
+            merged += 1
+    return index.records, merged
+
+
+def main(args):
+    data = load_dataset(args.input)
+    kept, merged = dedupe(data, args.radius_m, args.threshold)
+    print(f"{len(data)} entries, {merged} duplicates merged, {len(kept)} kept")
+    if not args.apply:
+        print("Dry run — no changes written. Use --apply to rewrite the dataset.")
+        return
+    ts = datetime.utcnow().strftime("%Y%m%dT%H%M%SZ")
+    backup = f"{args.input}.bak.dedup.{ts}"
+    shutil.copy2(args.input, backup)
+    version = save_versioned(args.input, kept, "dedup")
+    print(f"Wrote {len(kept)} entries to {args.input} (backup: {backup}, changelog version {version})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merge nearby records whose names look alike")
+    parser.add_argument("--input", default=DATA_FILE)
+    parser.add_argument("--apply", action="store_true", help="Rewrite the dataset (creates backup)")
+    parser.add_argument("--radius-m", type=float, default=DEFAULT_RADIUS_M, help="Max distance between duplicates in meters")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="Min name similarity (0-1)")
+    args = parser.parse_args()
+    main(args)
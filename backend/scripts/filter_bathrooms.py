@@ -1,11 +1,23 @@
 import argparse
-import json
 import os
 import shutil
+import sys
 from datetime import datetime
 
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from changelog import save_versioned  # noqa: E402
+from dataset_store import default_data_path, load_dataset  # noqa: E402
 
-DATA_FILE = os.path.normpath(os.path.join(os.path.dirname(__file__), "..", "data", "bathrooms.json"))
+
+DATA_FILE = default_data_path(os.path.normpath(os.path.join(os.path.dirname(__file__), "..", "data")))
+
+# Default approximate bounding boxes
+# Irvine city approximate bbox
+IRVINE_BBOX = (33.6400, 33.7450, -117.9200, -117.6900)
+# Orange County approximate bbox
+ORANGE_BBOX = (33.4260, 33.9260, -118.0046, -117.4889)
+# Los Angeles County approximate bbox (broad)
+LA_BBOX = (33.7000, 34.9000, -118.9448, -117.6460)
 
 
 def in_bbox(lat, lon, bbox):
@@ -15,28 +27,38 @@ def in_bbox(lat, lon, bbox):
     return (lat_min <= lat <= lat_max) and (lon_min <= lon <= lon_max)
 
 
+def classify(entry, irvine_bbox, orange_bbox, la_bbox):
+    """'irvine', 'other' (rest of LA/Orange) or None for entries outside both."""
+    loc = entry.get("location")
+    lat = lon = None
+    if isinstance(loc, (list, tuple)) and len(loc) >= 2:
+        lat, lon = loc[0], loc[1]
+
+    if in_bbox(lat, lon, irvine_bbox):
+        return "irvine"
+
+    # if not in Irvine, check Orange or LA
+    if in_bbox(lat, lon, orange_bbox) or in_bbox(lat, lon, la_bbox):
+        return "other"
+    return None
+
+
 def load_data(path):
-    with open(path, "r", encoding="utf-8") as f:
-        return json.load(f)
+    return load_dataset(path)
 
 
 def save_with_backup(path, data):
     ts = datetime.utcnow().strftime("%Y%m%dT%H%M%SZ")
     backup = f"{path}.bak.{ts}"
     shutil.copy2(path, backup)
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
-    print(f"Wrote {len(data)} entries to {path} (backup: {backup})")
+    version = save_versioned(path, data, "filter_bathrooms")
+    print(f"Wrote {len(data)} entries to {path} (backup: {backup}, changelog version {version})")
 
 
 def main(args):
-    # Default approximate bounding boxes
-    # Irvine city approximate bbox
-    irvine_bbox = args.irvine_bbox or (33.6400, 33.7450, -117.9200, -117.6900)
-    # Orange County approximate bbox
-    orange_bbox = args.orange_bbox or (33.4260, 33.9260, -118.0046, -117.4889)
-    # Los Angeles County approximate bbox (broad)
-    la_bbox = args.la_bbox or (33.7000, 34.9000, -118.9448, -117.6460)
+    irvine_bbox = args.irvine_bbox or IRVINE_BBOX
+    orange_bbox = args.orange_bbox or ORANGE_BBOX
+    la_bbox = args.la_bbox or LA_BBOX
 
     data = load_data(DATA_FILE)
 
@@ -45,17 +67,10 @@ def main(args):
     removed = []
 
     for entry in data:
-        loc = entry.get("location")
-        lat = lon = None
-        if isinstance(loc, (list, tuple)) and len(loc) >= 2:
-            lat, lon = loc[0], loc[1]
-
-        if in_bbox(lat, lon, irvine_bbox):
+        region = classify(entry, irvine_bbox, orange_bbox, la_bbox)
+        if region == "irvine":
             irvine.append(entry)
-            continue
-
-        # if not in Irvine, check Orange or LA
-        if in_bbox(lat, lon, orange_bbox) or in_bbox(lat, lon, la_bbox):
+        elif region == "other":
             other_la_orange.append(entry)
         else:
             removed.append(entry)
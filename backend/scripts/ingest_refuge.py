@@ -1,58 +1,149 @@
 import argparse
 import json
 import os
+import random
 import shutil
+import sys
+import threading
 import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 import requests
 
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from changelog import save_versioned  # noqa: E402
+from dataset_store import default_data_path, load_dataset  # noqa: E402
+from dedup import DEFAULT_RADIUS_M, DedupIndex, merge_records  # noqa: E402
 
-REFUGE_API = "https://www.refugerestrooms.org/api/v1/restrooms"
-REFUGE_BY_LOCATION = "https://www.refugerestrooms.org/api/v1/restrooms/by_location"
-DATA_PATH = os.path.join(os.path.dirname(__file__), "..", "data", "bathrooms.json")
 
+REFUGE_BASE = "https://www.refugerestrooms.org"
+RESTROOMS_PATH = "/api/v1/restrooms"
+BY_LOCATION_PATH = "/api/v1/restrooms/by_location"
+DATA_PATH = default_data_path(os.path.normpath(os.path.join(os.path.dirname(__file__), "..", "data")))
+RETRY_STATUS = {429, 500, 502, 503, 504}
 
-def fetch_pages(per_page=50, max_pages=0):
-    page = 1
+
+class RateLimiter:
+    """Token bucket shared by the fetch threads; rate is requests/second."""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if not self.rate:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def make_session(pool_size=8):
+    # one pooled session for every request so connections get reused
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def fetch_page(session, url, params, limiter=None, retries=3, backoff=0.5):
+    """GET one page of results, retrying transient errors with exponential backoff."""
+    attempt = 0
     while True:
-        params = {"page": page, "per_page": per_page}
-        resp = requests.get(REFUGE_API, params=params, timeout=30)
-        resp.raise_for_status()
-        items = resp.json()
-        if not items:
-            break
+        if limiter is not None:
+            limiter.acquire()
+        try:
+            resp = session.get(url, params=params, timeout=30)
+            if resp.status_code not in RETRY_STATUS:
+                resp.raise_for_status()
+                return resp.json()
+            error = requests.HTTPError(f"{resp.status_code} for {resp.url}", response=resp)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            error = e
+        if attempt >= retries:
+            raise error
+        delay = backoff * (2 ** attempt)
+        print(f"Retrying page {params.get('page')} in {delay:.1f}s: {error}")
+        time.sleep(delay + random.uniform(0, backoff))
+        attempt += 1
+
+
+def fetch_concurrent(url, params, max_pages=0, concurrency=4, rate=5.0, retries=3,
+                     backoff=0.5, session=None, start_page=1):
+    """Yield (page, items) in page order with up to `concurrency` requests in flight.
+
+    Pages are requested ahead of the consumer; the first empty page ends the
+    run and anything fetched past it is discarded.
+    """
+    session = session or make_session(concurrency)
+    limiter = RateLimiter(rate, burst=concurrency) if rate else None
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        pending = {}
+        next_page = start_page
+        page = start_page
+        try:
+            while True:
+                while len(pending) < concurrency and not (max_pages and next_page > max_pages):
+                    page_params = dict(params, page=next_page)
+                    pending[next_page] = pool.submit(
+                        fetch_page, session, url, page_params, limiter, retries, backoff)
+                    next_page += 1
+                if page not in pending:
+                    return
+                items = pending.pop(page).result()
+                if not items:
+                    return
+                yield page, items
+                page += 1
+        finally:
+            for future in pending.values():
+                future.cancel()
+
+
+def fetch_pages(per_page=50, max_pages=0, concurrency=4, rate=5.0, retries=3, base_url=REFUGE_BASE):
+    for _, items in fetch_page_batches(per_page, max_pages, concurrency, rate, retries, base_url):
         for it in items:
             yield it
-        page += 1
-        if max_pages and page > max_pages:
-            break
 
 
-def fetch_by_location(lat, lng, radius_km=10, per_page=50, max_pages=0, max_results=0):
+def fetch_page_batches(per_page=50, max_pages=0, concurrency=4, rate=5.0, retries=3,
+                       base_url=REFUGE_BASE, start_page=1):
+    # (page, items) pairs, for callers that checkpoint by page
+    url = base_url.rstrip("/") + RESTROOMS_PATH
+    return fetch_concurrent(url, {"per_page": per_page}, max_pages=max_pages, concurrency=concurrency,
+                            rate=rate, retries=retries, start_page=start_page)
+
+
+def fetch_by_location(lat, lng, radius_km=10, per_page=50, max_pages=0, max_results=0,
+                      concurrency=4, rate=5.0, retries=3, base_url=REFUGE_BASE):
     """Fetch restrooms near a lat/lng using the /by_location endpoint.
 
     The Refuge API accepts `lat` and `lng` and returns nearby restrooms. This
     helper paginates over results similar to fetch_pages but scoped to a point.
     """
-    page = 1
+    url = base_url.rstrip("/") + BY_LOCATION_PATH
     yielded = 0
-    while True:
-        params = {"lat": lat, "lng": lng, "per_page": per_page, "page": page}
-        resp = requests.get(REFUGE_BY_LOCATION, params=params, timeout=30)
-        resp.raise_for_status()
-        items = resp.json()
-        if not items:
-            break
+    params = {"lat": lat, "lng": lng, "per_page": per_page}
+    for _, items in fetch_concurrent(url, params, max_pages=max_pages,
+                                     concurrency=concurrency, rate=rate, retries=retries):
         for it in items:
             yield it
             yielded += 1
             if max_results and yielded >= max_results:
                 return
-        page += 1
-        if max_pages and page > max_pages:
-            break
 
 
 def normalize_refuge_item(item):
@@ -101,7 +192,7 @@ def normalize_refuge_item(item):
         "ratings": ratings,
         "opening_hours": opening_hours,
         "crowd_updates": item.get("accessibility_notes") or item.get("notes") or "unknown",
-        "source": {"name": "refugerestrooms", "external_id": item.get("id")},
+        "source": {"name": "refugerestrooms", "external_id": item.get("id"), "updated_at": item.get("updated_at")},
         "fetched_at": datetime.utcnow().isoformat() + "Z",
     }
 
@@ -111,17 +202,190 @@ def normalize_refuge_item(item):
 def load_existing(path):
     if not os.path.exists(path):
         return []
-    with open(path, "r", encoding="utf-8") as f:
-        return json.load(f)
+    return load_dataset(path)
 
 
 def save_with_backup(path, data):
     ts = datetime.utcnow().strftime("%Y%m%dT%H%M%SZ")
     backup = f"{path}.bak.{ts}"
     shutil.copy2(path, backup)
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
-    print(f"Wrote {len(data)} entries to {path} (backup: {backup})")
+    version = save_versioned(path, data, "ingest_refuge")
+    print(f"Wrote {len(data)} entries to {path} (backup: {backup}, changelog version {version})")
+
+
+def load_checkpoint(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def write_json_atomic(path, data, indent=None):
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=indent)
+    os.replace(tmp, path)
+
+
+def external_key(entry):
+    source = entry.get("source") or {}
+    if source.get("name") != "refugerestrooms" or source.get("external_id") is None:
+        return None
+    return str(source["external_id"])
+
+
+def merged_keys(entry):
+    # upstream ids of duplicates dedup merged into this record
+    for source in entry.get("merged_sources") or []:
+        if source.get("name") == "refugerestrooms" and source.get("external_id") is not None:
+            yield str(source["external_id"])
+
+
+def upsert_item(existing, cleaned):
+    """Refresh an existing record from a newer upstream copy.
+
+    Our id and locally sourced fields (cleanliness/safety, crowd_updates)
+    are kept. Returns True if anything changed.
+    """
+    if (existing.get("source") or {}).get("updated_at") == cleaned["source"].get("updated_at") \
+            and cleaned["source"].get("updated_at") is not None:
+        return False
+    before = json.dumps(existing, sort_keys=True)
+    for field in ("name", "amenities", "location", "source", "fetched_at"):
+        existing[field] = cleaned[field]
+    if existing.get("opening_hours") != cleaned["opening_hours"]:
+        existing["opening_hours"] = cleaned["opening_hours"]
+        # compiled by normalize_data.py; stale now, the loader recompiles
+        existing.pop("opening_schedule", None)
+    ratings = dict(existing.get("ratings") or {})
+    ratings["overall"] = cleaned["ratings"]["overall"]
+    existing["ratings"] = ratings
+    # fetched_at alone doesn't count as a change
+    after = dict(existing, fetched_at=json.loads(before).get("fetched_at"))
+    return json.dumps(after, sort_keys=True) != before
+
+
+def save_incremental(path, data, changed, replaced):
+    # the dataset is a single JSON array, so it's rewritten compactly; the
+    # backup only holds the changed records (previous copies + added ids)
+    ts = datetime.utcnow().strftime("%Y%m%dT%H%M%S%fZ")
+    backup = f"{path}.delta.{ts}.json"
+    write_json_atomic(backup, {"replaced": replaced, "added": [i for i in changed if i not in replaced]})
+    version = save_versioned(path, data, "ingest_refuge --incremental", indent=None)
+    print(f"Wrote {len(changed)} changed of {len(data)} entries to {path} (delta backup: {backup}, "
+          f"changelog version {version})")
+
+
+def run_incremental(args, data_file, fetch_options):
+    """Upsert on source.external_id, checkpointing pages so a run can resume.
+
+    Checkpoints hold the last finished page and the records changed so
+    far; the dataset itself is written once, when the run completes.
+    """
+    checkpoint_file = os.path.join(os.path.dirname(data_file), "ingest_checkpoint.json")
+    checkpoint = load_checkpoint(checkpoint_file) or {}
+    run_params = {"per_page": args.per_page, "base_url": args.base_url}
+    start_page = 1
+    existing = load_existing(data_file)
+    changed = {}
+    replaced = {}
+    if checkpoint.get("params") == run_params and not checkpoint.get("completed"):
+        start_page = checkpoint.get("last_page", 0) + 1
+        print(f"Resuming interrupted run at page {start_page}")
+        # put back what the finished pages changed
+        positions = {entry.get("id"): i for i, entry in enumerate(existing)}
+        for record in checkpoint.get("pending", []):
+            if record["id"] in positions:
+                existing[positions[record["id"]]] = record
+            else:
+                existing.append(record)
+            changed[record["id"]] = True
+        replaced.update(checkpoint.get("replaced", {}))
+
+    by_external = {}
+    merged_into = {}
+    dedup = DedupIndex(args.dedup_radius_m)
+    for entry in existing:
+        key = external_key(entry)
+        if key is not None:
+            by_external[key] = entry
+        for merged_key in merged_keys(entry):
+            merged_into[merged_key] = entry
+        dedup.add(entry)
+
+    count = 0
+    last_page = start_page - 1
+    started_at = datetime.utcnow().isoformat() + "Z"
+
+    def commit(completed):
+        if args.dry_run:
+            return
+        if completed and changed:
+            save_incremental(data_file, existing, changed, replaced)
+        write_json_atomic(checkpoint_file, {
+            "params": run_params,
+            "last_page": last_page,
+            "completed": completed,
+            "started_at": checkpoint.get("started_at") if start_page > 1 else started_at,
+            "last_fetch_at": datetime.utcnow().isoformat() + "Z",
+            "pending": [] if completed else [entry for entry in existing if entry.get("id") in changed],
+            "replaced": {} if completed else replaced,
+        })
+
+    batches = fetch_page_batches(per_page=args.per_page, max_pages=args.max_pages,
+                                 start_page=start_page, **fetch_options)
+    added = updated = merged = 0
+    try:
+        for page, items in batches:
+            for raw in items:
+                count += 1
+                cleaned = normalize_refuge_item(raw)
+                key = (cleaned.get("name") or "").strip().lower()
+                if not key or not cleaned.get("location"):
+                    continue
+                ext = external_key(cleaned)
+                current = by_external.get(ext) if ext is not None else None
+                if current is not None:
+                    previous = json.loads(json.dumps(current))
+                    if upsert_item(current, cleaned):
+                        replaced.setdefault(current["id"], previous)
+                        changed[current["id"]] = True
+                        updated += 1
+                    continue
+                if ext is not None and ext in merged_into:
+                    # already folded into another record by an earlier run
+                    continue
+                pos = dedup.find(cleaned)
+                if pos is not None:
+                    target = dedup.records[pos]
+                    previous = json.loads(json.dumps(target))
+                    if merge_records(target, cleaned):
+                        replaced.setdefault(target["id"], previous)
+                        changed[target["id"]] = True
+                    if ext is not None:
+                        merged_into[ext] = target
+                    merged += 1
+                    continue
+                existing.append(cleaned)
+                dedup.add(cleaned)
+                if ext is not None:
+                    by_external[ext] = cleaned
+                changed[cleaned["id"]] = True
+                added += 1
+            last_page = page
+            if args.checkpoint_every and page % args.checkpoint_every == 0:
+                commit(False)
+    except BaseException:
+        # keep what the finished pages produced so the next run resumes after them
+        commit(False)
+        raise
+
+    print(f"Incremental run: {added} added, {updated} updated, {merged} merged into duplicates "
+          f"(scanned {count} remote items).")
+    if args.dry_run:
+        print("Dry run — nothing written.")
+        return
+    commit(True)
 
 
 def main(args):
@@ -129,19 +393,29 @@ def main(args):
     max_pages = args.max_pages
     dry = args.dry_run
 
-    data_file = os.path.normpath(os.path.join(os.path.dirname(__file__), "..", "data", "bathrooms.json"))
+    data_file = DATA_PATH
     existing = load_existing(data_file)
-    existing_names = { (e.get("name") or "").strip().lower(): e for e in existing }
+    dedup = DedupIndex(args.dedup_radius_m)
+    for entry in existing:
+        dedup.add(entry)
 
     new_items = []
+    merged = 0
     count = 0
+    fetch_options = dict(concurrency=args.concurrency, rate=args.rate_limit,
+                         retries=args.retries, base_url=args.base_url)
+    if args.incremental:
+        if args.by_location:
+            print("--incremental pages through the full listing; ignoring --by-location")
+        run_incremental(args, data_file, fetch_options)
+        return
     if args.by_location:
         lat, lng = args.by_location
         print(f"Fetching from Refuge by_location around {lat},{lng}...")
-        generator = fetch_by_location(lat=float(lat), lng=float(lng), radius_km=args.radius_km, per_page=per_page, max_pages=max_pages, max_results=args.max_results)
+        generator = fetch_by_location(lat=float(lat), lng=float(lng), radius_km=args.radius_km, per_page=per_page, max_pages=max_pages, max_results=args.max_results, **fetch_options)
     else:
         print("Fetching pages from Refuge API...")
-        generator = fetch_pages(per_page=per_page, max_pages=max_pages)
+        generator = fetch_pages(per_page=per_page, max_pages=max_pages, **fetch_options)
 
     for raw in generator:
         count += 1
@@ -150,13 +424,17 @@ def main(args):
         if not key or not cleaned.get("location"):
             print(f"Skipping entry with missing name or location: {raw.get('id')}")
             continue
-        if key in existing_names:
-            # exact name dedupe: skip
-            continue
-        new_items.append(cleaned)
+        # nearby records with a similar name are the same restroom; new
+        # items are indexed too so duplicates within one fetch merge as well
+        _, result = dedup.add_or_merge(cleaned)
+        if result is None:
+            new_items.append(cleaned)
+        elif result:
+            merged += 1
 
-    print(f"Found {len(new_items)} new items (scanned {count} remote items).")
-    if not new_items:
+    print(f"Found {len(new_items)} new items, merged {merged} duplicates into other records "
+          f"(scanned {count} remote items).")
+    if not new_items and not merged:
         return
 
     if dry:
@@ -165,8 +443,7 @@ def main(args):
             print("-", it.get("name"), it.get("location"))
         return
 
-    merged = existing + new_items
-    save_with_backup(data_file, merged)
+    save_with_backup(data_file, existing + new_items)
 
 
 if __name__ == "__main__":
@@ -177,5 +454,12 @@ if __name__ == "__main__":
     parser.add_argument("--by-location", nargs=2, metavar=("LAT","LNG"), help="Fetch using by_location endpoint: provide LAT LNG")
     parser.add_argument("--radius-km", type=float, default=10.0, help="Radius in km for by-location (informational)")
     parser.add_argument("--max-results", type=int, default=0, help="Stop after this many fetched results (0=unbounded)")
+    parser.add_argument("--concurrency", type=int, default=4, help="Pages requested in parallel")
+    parser.add_argument("--rate-limit", type=float, default=5.0, help="Max requests per second (0=unlimited)")
+    parser.add_argument("--retries", type=int, default=3, help="Retries per page on transient errors")
+    parser.add_argument("--base-url", default=REFUGE_BASE, help="Refuge API host, e.g. a local stand-in server")
+    parser.add_argument("--incremental", action="store_true", help="Upsert by external_id and resume from the last checkpoint")
+    parser.add_argument("--dedup-radius-m", type=float, default=DEFAULT_RADIUS_M, help="Max distance in meters between duplicates")
+    parser.add_argument("--checkpoint-every", type=int, default=20, help="Save progress every N pages in --incremental mode")
     args = parser.parse_args()
     main(args)
@@ -1,11 +1,16 @@
 #!/usr/bin/env python3
-import json
 import os
 import shutil
+import sys
 from datetime import datetime
 
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from changelog import save_versioned  # noqa: E402
+from dataset_store import default_data_path, load_dataset  # noqa: E402
+from hours import compile_opening_hours  # noqa: E402
 
-DATA_FILE = os.path.normpath(os.path.join(os.path.dirname(__file__), "..", "data", "bathrooms.json"))
+
+DATA_FILE = default_data_path(os.path.normpath(os.path.join(os.path.dirname(__file__), "..", "data")))
 
 
 def is_number(x):
@@ -71,10 +76,20 @@ def normalize_entry(e):
         e["ratings"] = new_ratings
         updated = True
 
-    # opening_hours
+    # opening_hours, plus its compiled minute-of-week intervals; hours we
+    # can't parse are kept as they are, without a schedule (the app then
+    # treats them as always open)
     oh = e.get("opening_hours")
-    if not isinstance(oh, str) or '-' not in (oh or ''):
-        e["opening_hours"] = "00:00-23:59"
+    if not isinstance(oh, str) or not oh.strip():
+        e["opening_hours"] = oh = "00:00-23:59"
+        updated = True
+    schedule = compile_opening_hours(oh)
+    if schedule is None:
+        if "opening_schedule" in e:
+            del e["opening_schedule"]
+            updated = True
+    elif e.get("opening_schedule") != schedule:
+        e["opening_schedule"] = schedule
         updated = True
 
     # crowd_updates
@@ -96,8 +111,7 @@ def normalize_entry(e):
 
 
 def main():
-    with open(DATA_FILE, 'r', encoding='utf-8') as f:
-        data = json.load(f)
+    data = load_dataset(DATA_FILE)
 
     new_data = []
     skipped = 0
@@ -115,10 +129,10 @@ def main():
     ts = datetime.utcnow().strftime("%Y%m%dT%H%M%SZ")
     backup = f"{DATA_FILE}.bak.normalize.{ts}"
     shutil.copy2(DATA_FILE, backup)
-    with open(DATA_FILE, 'w', encoding='utf-8') as f:
-        json.dump(new_data, f, ensure_ascii=False, indent=2)
+    version = save_versioned(DATA_FILE, new_data, "normalize_data")
 
-    print(f"Normalized {len(new_data)} entries; changed: {changed}; skipped (no loc): {skipped}; backup: {backup}")
+    print(f"Normalized {len(new_data)} entries; changed: {changed}; skipped (no loc): {skipped}; backup: {backup}; "
+          f"changelog version {version}")
 
 
 if __name__ == '__main__':
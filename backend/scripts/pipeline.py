@@ -0,0 +1,205 @@
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from changelog import commit_version  # noqa: E402
+from dataset_store import JsonArrayWriter, default_data_path, iter_dataset, load_dataset, write_store  # noqa: E402
+from dedup import DEFAULT_RADIUS_M, DedupIndex, merge_records  # noqa: E402
+from filter_bathrooms import IRVINE_BBOX, LA_BBOX, ORANGE_BBOX, classify  # noqa: E402
+from ingest_refuge import REFUGE_BASE, fetch_by_location, fetch_pages, normalize_refuge_item  # noqa: E402
+from normalize_data import normalize_entry  # noqa: E402
+
+
+DATA_FILE = default_data_path(os.path.normpath(os.path.join(os.path.dirname(__file__), "..", "data")))
+
+
+class Stage:
+    """Counts records in/out of one generator stage and the time spent in it."""
+
+    def __init__(self, name):
+        self.name = name
+        self.seen = 0
+        self.kept = 0
+        self.elapsed = 0.0
+
+    def source(self, iterable):
+        it = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(it)
+            except StopIteration:
+                self.elapsed += time.perf_counter() - start
+                return
+            self.elapsed += time.perf_counter() - start
+            self.seen += 1
+            self.kept += 1
+            yield item
+
+    def map(self, fn, iterable):
+        # fn returns the new record, or None to drop it
+        for item in iterable:
+            self.seen += 1
+            start = time.perf_counter()
+            out = fn(item)
+            self.elapsed += time.perf_counter() - start
+            if out is not None:
+                self.kept += 1
+                yield out
+
+    def report(self):
+        return f"{self.name:<10} in {self.seen:>8}  out {self.kept:>8}  {self.elapsed:8.3f}s"
+
+
+def fetched_records(args, stage):
+    """Refuge items as project records, duplicates within the fetch merged."""
+    options = dict(concurrency=args.concurrency, rate=args.rate_limit,
+                   retries=args.retries, base_url=args.base_url)
+    if args.by_location:
+        lat, lng = args.by_location
+        raw = fetch_by_location(lat=float(lat), lng=float(lng), per_page=args.per_page,
+                                max_pages=args.max_pages, max_results=args.max_results, **options)
+    else:
+        raw = fetch_pages(per_page=args.per_page, max_pages=args.max_pages, **options)
+    index = DedupIndex(args.dedup_radius_m)
+    start = time.perf_counter()
+    for item in raw:
+        stage.seen += 1
+        cleaned = normalize_refuge_item(item)
+        if not (cleaned.get("name") or "").strip() or not cleaned.get("location"):
+            continue
+        index.add_or_merge(cleaned)
+    stage.kept = len(index)
+    stage.elapsed = time.perf_counter() - start
+    return index
+
+
+def main(args):
+    stages = {name: Stage(name) for name in ("ingest", "existing", "normalize", "region")}
+
+    # the fetch is held in a dedup index (it is much smaller than the
+    # dataset) so existing records can stream past it and absorb their
+    # duplicates before they are written
+    fetched = DedupIndex(args.dedup_radius_m)
+    if args.fetch or args.by_location:
+        fetched = fetched_records(args, stages["ingest"])
+    absorbed = set()
+
+    def existing():
+        for entry in stages["existing"].source(iter_dataset(args.input)):
+            for pos in fetched.matches(entry):
+                if pos not in absorbed:
+                    absorbed.add(pos)
+                    merge_records(entry, fetched.records[pos])
+            yield entry
+
+    def records():
+        yield from existing()
+        for pos, entry in enumerate(fetched.records):
+            if pos not in absorbed:
+                yield entry
+
+    normalized = stages["normalize"].map(lambda e: normalize_entry(e)[0], records())
+
+    irvine_bbox = args.irvine_bbox or IRVINE_BBOX
+    orange_bbox = args.orange_bbox or ORANGE_BBOX
+    la_bbox = args.la_bbox or LA_BBOX
+    kept = {"irvine": 0, "other": 0}
+    caps = {"irvine": args.irvine_cap, "other": args.other_cap}
+
+    def region_filter(entry):
+        region = classify(entry, irvine_bbox, orange_bbox, la_bbox)
+        if region is None or (caps[region] and kept[region] >= caps[region]):
+            return None
+        kept[region] += 1
+        return (region, entry)
+
+    filtered = stages["region"].map(region_filter, normalized)
+
+    output = args.output or args.input
+    out_dir = os.path.dirname(os.path.abspath(output))
+    # Irvine records go straight to the output; the rest spool to a second
+    # temp file and are appended after, keeping the Irvine-first order of
+    # filter_bathrooms.py without holding records in memory
+    out = tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=out_dir, delete=False, suffix=".tmp")
+    spool = tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=out_dir, delete=False, suffix=".spool")
+    write_start = time.perf_counter()
+    try:
+        writer = JsonArrayWriter(out)
+        spooled = JsonArrayWriter(spool)
+        for region, entry in filtered:
+            (writer if region == "irvine" else spooled).write(entry)
+        spooled.close()
+        spool.close()
+        for record in iter_dataset(spool.name):
+            writer.write(record)
+        writer.close()
+        out.close()
+        total = time.perf_counter() - write_start
+        # the fetch ran before the timer started
+        write_time = total - sum(stage.elapsed for name, stage in stages.items() if name != "ingest")
+
+        print("stage          records in / out      time")
+        if absorbed:
+            print(f"(merged {len(absorbed)} fetched records into existing duplicates)")
+        for stage in stages.values():
+            print(stage.report())
+        print(f"{'write':<10} {'':>11}  out {writer.count:>8}  {write_time:8.3f}s "
+              f"(Irvine {kept['irvine']}, other LA/Orange {kept['other']})")
+        print(f"{'total':<10} {'':>25}  {total:8.3f}s")
+
+        if not args.apply:
+            print("Dry run — no changes written. Use --apply to replace the dataset.")
+            os.unlink(out.name)
+            return
+        if args.backup and os.path.exists(output):
+            ts = datetime.utcnow().strftime("%Y%m%dT%H%M%SZ")
+            backup = f"{output}.bak.pipeline.{ts}"
+            shutil.copy2(output, backup)
+            print(f"Backup: {backup}")
+        if output.endswith(".bin"):
+            # the binary store needs every record to build its columns
+            write_store(output, load_dataset(out.name))
+            os.unlink(out.name)
+        else:
+            os.replace(out.name, output)
+        version = commit_version(output, source="pipeline")
+        print(f"Wrote {writer.count} entries to {output}; changelog version {version}")
+    except BaseException:
+        out.close()
+        if os.path.exists(out.name):
+            os.unlink(out.name)
+        raise
+    finally:
+        spool.close()
+        os.unlink(spool.name)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ingest, normalize and region-filter the dataset in one streaming pass")
+    parser.add_argument("--input", default=DATA_FILE, help="Existing dataset to stream through (default: data/bathrooms.bin or .json)")
+    parser.add_argument("--output", help="Where to write the result (default: same as --input)")
+    parser.add_argument("--apply", action="store_true", help="Replace the output file (default is a dry run)")
+    parser.add_argument("--no-backup", dest="backup", action="store_false", help="Skip the single backup of the old output")
+    parser.add_argument("--fetch", action="store_true", help="Also pull new restrooms from the Refuge API")
+    parser.add_argument("--by-location", nargs=2, metavar=("LAT", "LNG"), help="Fetch with the by_location endpoint instead")
+    parser.add_argument("--per-page", type=int, default=50)
+    parser.add_argument("--max-pages", type=int, default=0, help="0=unbounded until API returns empty page")
+    parser.add_argument("--max-results", type=int, default=0, help="Stop after this many fetched results (0=unbounded)")
+    parser.add_argument("--concurrency", type=int, default=4, help="Pages requested in parallel")
+    parser.add_argument("--rate-limit", type=float, default=5.0, help="Max requests per second (0=unlimited)")
+    parser.add_argument("--retries", type=int, default=3, help="Retries per page on transient errors")
+    parser.add_argument("--base-url", default=REFUGE_BASE, help="Refuge API host")
+    parser.add_argument("--dedup-radius-m", type=float, default=DEFAULT_RADIUS_M, help="Max distance in meters between duplicates")
+    parser.add_argument("--irvine-cap", type=int, default=1000)
+    parser.add_argument("--other-cap", type=int, default=1000)
+    parser.add_argument("--irvine-bbox", nargs=4, type=float, metavar=("LAT_MIN", "LAT_MAX", "LON_MIN", "LON_MAX"), help="Custom irvine bbox")
+    parser.add_argument("--orange-bbox", nargs=4, type=float, metavar=("LAT_MIN", "LAT_MAX", "LON_MIN", "LON_MAX"), help="Custom orange bbox")
+    parser.add_argument("--la-bbox", nargs=4, type=float, metavar=("LAT_MIN", "LAT_MAX", "LON_MIN", "LON_MAX"), help="Custom LA bbox")
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,109 @@
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from dataset_store import default_data_path, iter_dataset, save_dataset  # noqa: E402
+from shards import (  # noqa: E402
+    DEFAULT_SHARD_SIZE, MANIFEST_NAME, read_manifest, shard_key, write_manifest,
+)
+
+
+DATA_DIR = os.path.normpath(os.path.join(os.path.dirname(__file__), "..", "data"))
+DATA_FILE = default_data_path(DATA_DIR)
+SHARD_DIR = os.path.join(DATA_DIR, "shards")
+
+
+def location_of(entry):
+    loc = entry.get("location")
+    if isinstance(loc, (list, tuple)) and len(loc) >= 2:
+        try:
+            return float(loc[0]), float(loc[1])
+        except (TypeError, ValueError):
+            pass
+    return None
+
+
+def partition(records, size):
+    """{shard name: [records]} plus the count of records without a location."""
+    shards = {}
+    skipped = 0
+    for entry in records:
+        loc = location_of(entry)
+        if loc is None:
+            # never ranked, so no shard needs them
+            skipped += 1
+            continue
+        shards.setdefault(shard_key(loc[0], loc[1], size), []).append(entry)
+    return shards, skipped
+
+
+def bbox_of(records):
+    lats = [location_of(e)[0] for e in records]
+    lons = [location_of(e)[1] for e in records]
+    return [min(lats), max(lats), min(lons), max(lons)]
+
+
+def main(args):
+    start = time.perf_counter()
+    shards, skipped = partition(iter_dataset(args.input), args.shard_size)
+    total = sum(len(records) for records in shards.values())
+    print(f"Read {total} located bathrooms into {len(shards)} shards of {args.shard_size:g} degrees "
+          f"({skipped} without a location skipped) in {time.perf_counter() - start:.2f}s")
+    if args.dry_run:
+        for name, records in sorted(shards.items(), key=lambda item: -len(item[1]))[:20]:
+            print(f"  {name}: {len(records)}")
+        print("Dry run — no shards written.")
+        return
+
+    os.makedirs(args.output, exist_ok=True)
+    manifest_path = os.path.join(args.output, MANIFEST_NAME)
+    previous = read_manifest(manifest_path) if os.path.exists(manifest_path) else None
+    version = (previous or {}).get("version", 0) + 1
+    extension = ".bin" if args.format == "bin" else ".json"
+
+    entries = []
+    for name, records in sorted(shards.items()):
+        # versioned names, so servers still on the old manifest keep
+        # loading the files it lists
+        file_name = f"{name}.v{version}{extension}"
+        path = os.path.join(args.output, file_name)
+        save_dataset(path, records)
+        entries.append({
+            "name": name,
+            "file": file_name,
+            "bbox": bbox_of(records),
+            "count": len(records),
+            "bytes": os.path.getsize(path),
+            # lets the app tell which shard holds an id without loading any
+            "ids": [e["id"] for e in records if e.get("id") is not None],
+        })
+    write_manifest(manifest_path, {
+        "version": version,
+        "shard_size": args.shard_size,
+        "source": os.path.basename(args.input),
+        "shards": entries,
+    })
+
+    # keep this version's and the previous one's files, drop older ones
+    keep = {MANIFEST_NAME} | {e["file"] for e in entries} | {e["file"] for e in (previous or {}).get("shards", [])}
+    removed = 0
+    for file_name in os.listdir(args.output):
+        if file_name not in keep and (file_name.endswith(".bin") or file_name.endswith(".json")):
+            os.remove(os.path.join(args.output, file_name))
+            removed += 1
+    print(f"Wrote {len(entries)} shards (manifest version {version}, "
+          f"{sum(e['bytes'] for e in entries)} bytes) to {args.output}; removed {removed} old files "
+          f"in {time.perf_counter() - start:.2f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Split the dataset into region shards with a manifest of their bounding boxes")
+    parser.add_argument("--input", default=DATA_FILE)
+    parser.add_argument("--output", default=SHARD_DIR, help="Directory for the shards and manifest.json")
+    parser.add_argument("--shard-size", type=float, default=DEFAULT_SHARD_SIZE, help="Grid cell size in degrees")
+    parser.add_argument("--format", choices=("bin", "json"), default="bin")
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,186 @@
+import argparse
+import gc
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+
+from werkzeug.serving import make_server
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# a worker that dies sooner than this after starting is not restarted again
+MIN_WORKER_LIFETIME = 1.0
+# how often the master checks on workers and dataset reloads
+MASTER_TICK = 0.2
+
+
+def listen(host, port, backlog=128):
+    sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def run_worker(app_module, sock, host, port):
+    # every worker accepts on the same listening socket; the kernel hands
+    # each connection to one of them
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGHUP, signal.SIG_DFL)
+    gc.enable()
+    server = make_server(host, port, app_module.app, threaded=True, fd=sock.fileno())
+    try:
+        server.serve_forever()
+    finally:
+        # workers' stores have no atexit hooks (os._exit skips them anyway),
+        # so write out buffered visits, reviews and crowd reports before leaving
+        try:
+            app_module.history.flush()
+            app_module.reviews.checkpoint()
+            app_module.crowd_reports.checkpoint()
+        finally:
+            os._exit(0)
+
+
+def spawn(app_module, sock, host, port):
+    pid = os.fork()
+    if pid == 0:
+        run_worker(app_module, sock, host, port)
+    return pid
+
+
+def prepare_fork(app_module):
+    # the state workers inherit: nothing buffered, nothing for the
+    # collector to touch (and so copy) in the inherited objects
+    app_module.history.flush()
+    app_module.reviews.checkpoint()
+    app_module.crowd_reports.checkpoint()
+    gc.unfreeze()
+    gc.collect()
+    gc.freeze()
+
+
+def main(args):
+    # app.py opens data/ relative to the working directory
+    os.chdir(BASE_DIR)
+    # everything built while importing the app (snapshot arrays, indexes,
+    # records) is created before the fork, so workers share those pages
+    # copy-on-write instead of each building and holding their own
+    gc.disable()
+    import app as app_module
+    dataset = app_module.dataset
+    if dataset is not None:
+        if not dataset.path.endswith('.bin'):
+            print('Dataset is JSON: its records are Python objects each worker will '
+                  'partly copy. Run scripts/convert_dataset.py to serve a shared mmap store.')
+        # the master reloads the dataset and re-forks the workers, so a new
+        # snapshot is built once and shared instead of once per worker
+        dataset.stop_polling()
+        app_module.prefork_master = os.getpid()
+    if args.state_ttl is not None:
+        # visits, reviews and crowd reports recorded by one worker reach the
+        # others through SQLite; this bounds how long another worker can
+        # serve an older view
+        app_module.history.cache_ttl = args.state_ttl
+        app_module.result_cache.ttl = args.state_ttl
+        app_module.reviews.refresh_interval = args.state_ttl
+        app_module.crowd_reports.refresh_interval = args.state_ttl
+    prepare_fork(app_module)
+
+    if not args.access_log:
+        # a log line per request is synchronous I/O on every worker
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    sock = listen(args.host, args.port)
+    workers = {}
+    for _ in range(args.workers):
+        workers[spawn(app_module, sock, args.host, args.port)] = time.monotonic()
+    forked_version = dataset.current.version if dataset is not None else None
+    print(f'Serving on http://{args.host}:{args.port} with {args.workers} workers '
+          f'(master pid {os.getpid()})', flush=True)
+
+    stopping = False
+    reload_requested = False
+    # workers on an older snapshot, stopped once their replacements run
+    retired = set()
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def request_reload(signum, frame):
+        # sent by a worker's /api/reload
+        nonlocal reload_requested
+        reload_requested = True
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGHUP, request_reload)
+    next_poll = time.monotonic() + args.poll_interval
+    while workers:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        if pid == 0:
+            if dataset is not None and not stopping and (reload_requested or time.monotonic() >= next_poll):
+                force, reload_requested = reload_requested, False
+                next_poll = time.monotonic() + args.poll_interval
+                try:
+                    snapshot = dataset.reload(force=force)
+                except OSError as e:
+                    dataset.last_error = str(e)
+                    snapshot = dataset.current
+                if snapshot.version != forked_version:
+                    forked_version = snapshot.version
+                    prepare_fork(app_module)
+                    old = list(workers)
+                    for _ in range(args.workers):
+                        workers[spawn(app_module, sock, args.host, args.port)] = time.monotonic()
+                    for old_pid in old:
+                        retired.add(old_pid)
+                        try:
+                            os.kill(old_pid, signal.SIGTERM)
+                        except ProcessLookupError:
+                            pass
+                    print(f'Dataset version {snapshot.version} loaded; replaced {len(old)} workers', flush=True)
+            time.sleep(MASTER_TICK)
+            continue
+        started = workers.pop(pid, None)
+        if pid in retired:
+            retired.discard(pid)
+            continue
+        if stopping or started is None:
+            continue
+        if time.monotonic() - started < MIN_WORKER_LIFETIME:
+            print(f'Worker {pid} exited right after starting (status {status}); not restarting', flush=True)
+            continue
+        print(f'Worker {pid} exited (status {status}); starting a new one', flush=True)
+        workers[spawn(app_module, sock, args.host, args.port)] = time.monotonic()
+    sock.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve the API with preforked workers sharing one dataset')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5001)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 2)
+    parser.add_argument('--state-ttl', type=float, default=5.0,
+                        help='Seconds a worker may serve cached visit history, reviews, crowd reports or results '
+                             'before re-reading')
+    parser.add_argument('--poll-interval', type=float, default=2.0,
+                        help='Seconds between checks of the dataset file for changes')
+    parser.add_argument('--access-log', action='store_true', help='Log every request')
+    args = parser.parse_args()
+    main(args)
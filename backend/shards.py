@@ -0,0 +1,190 @@
+import json
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from dataset_store import open_dataset
+from ranking import KM_PER_DEGREE
+from snapshot import DatasetSnapshot, file_stamp
+
+MANIFEST_NAME = 'manifest.json'
+DEFAULT_SHARD_SIZE = 1.0  # degrees, roughly 110km
+# queries without max_radius_km are ranked within this radius
+DEFAULT_SEARCH_RADIUS_KM = 50.0
+MANIFEST_CHECK_SECONDS = 2.0
+
+
+def shard_key(lat, lon, size=DEFAULT_SHARD_SIZE):
+    """Name of the grid shard a location falls in, e.g. '33_-118'."""
+    return f'{math.floor(lat / size) * size:g}_{math.floor(lon / size) * size:g}'
+
+
+def read_manifest(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    if not isinstance(manifest.get('shards'), list):
+        raise ValueError(f'{path} is not a shard manifest')
+    if any(not isinstance(entry.get('ids'), list) for entry in manifest['shards']):
+        raise ValueError(f'{path} has no shard ids; re-run scripts/shard_dataset.py')
+    return manifest
+
+
+def write_manifest(path, manifest):
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, path)
+
+
+class Shard:
+    __slots__ = ('name', 'path', 'bbox', 'count', 'bytes')
+
+    def __init__(self, name, path, bbox, count, size):
+        self.name = name
+        self.path = path
+        self.bbox = bbox
+        self.count = count
+        self.bytes = size
+
+    def distance(self, lat, lon):
+        """Degrees from a point to the shard's bounding box (0 inside it)."""
+        lat_min, lat_max, lon_min, lon_max = self.bbox
+        dlat = max(lat_min - lat, 0.0, lat - lat_max)
+        dlon = max(lon_min - lon, 0.0, lon - lon_max)
+        return math.sqrt(dlat * dlat + dlon * dlon)
+
+
+class ShardRouter:
+    """A dataset split into region shards, each loaded on first use.
+
+    The manifest written by scripts/shard_dataset.py lists every shard's
+    file, bounding box and bathroom ids. A query only touches the shards whose box is
+    within its search radius; each loaded shard is a DatasetSnapshot of
+    its own. Past `memory_budget` bytes of loaded shard files the least
+    recently used shards are dropped (`on_evict(name)` is called for each).
+    A changed manifest replaces every shard, like a dataset reload.
+    """
+
+    def __init__(self, manifest_path, memory_budget, on_evict=None, on_change=None):
+        self.manifest_path = manifest_path
+        self.memory_budget = memory_budget
+        self.on_evict = on_evict
+        self.on_change = on_change
+        self.loads = 0
+        self.evictions = 0
+        self.last_error = None
+        self._lock = threading.Lock()
+        self._checked = time.monotonic()
+        self._read(read_manifest(manifest_path), file_stamp(manifest_path))
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+    def _read(self, manifest, stamp):
+        base = os.path.dirname(self.manifest_path)
+        self.version = manifest.get('version', 1)
+        self.stamp = stamp
+        self.shards = {
+            entry['name']: Shard(entry['name'], os.path.join(base, entry['file']), tuple(entry['bbox']),
+                                 entry['count'], entry['bytes'])
+            for entry in manifest['shards']
+        }
+        # shard position breaks ties between shards, like row order within one
+        self.order = {name: i for i, name in enumerate(self.shards)}
+        self._loaded = OrderedDict()
+        id_shards = {}
+        for entry in manifest['shards']:
+            for bathroom_id in entry['ids']:
+                id_shards.setdefault(bathroom_id, []).append(entry['name'])
+        self._id_shards = id_shards
+
+    def check(self, force=False):
+        """Re-read the manifest if it changed; returns whether it did."""
+        now = time.monotonic()
+        if not force and now - self._checked < MANIFEST_CHECK_SECONDS:
+            return False
+        self._checked = now
+        try:
+            stamp = file_stamp(self.manifest_path)
+            if not force and stamp == self.stamp:
+                return False
+            manifest = read_manifest(self.manifest_path)
+        except (OSError, ValueError) as e:
+            self.last_error = str(e)
+            return False
+        self.last_error = None
+        with self._lock:
+            self._read(manifest, stamp)
+        if self.on_change is not None:
+            self.on_change()
+        return True
+
+    def search_radius(self, user_context):
+        """Search radius of a query in degrees."""
+        radius = user_context.get('max_radius_km')
+        return float(DEFAULT_SEARCH_RADIUS_KM if radius is None else radius) / KM_PER_DEGREE
+
+    def route(self, user_context):
+        """Names of the shards within the query's search radius, nearest first."""
+        lat, lon = user_context['location']
+        radius = self.search_radius(user_context)
+        near = [(shard.distance(lat, lon), name) for name, shard in self.shards.items()]
+        return [name for dist, name in sorted(near) if dist <= radius]
+
+    def snapshot(self, name):
+        """The shard's DatasetSnapshot, loading it (and evicting others) if needed."""
+        with self._lock:
+            snapshot = self._loaded.get(name)
+            if snapshot is not None:
+                self._loaded.move_to_end(name)
+                return snapshot
+            version = self.version
+            shard = self.shards[name]
+        snapshot = DatasetSnapshot(open_dataset(shard.path), version)
+        evicted = []
+        with self._lock:
+            if version != self.version:
+                # the manifest changed while loading; serve it once, don't keep it
+                return snapshot
+            snapshot = self._loaded.setdefault(name, snapshot)
+            self._loaded.move_to_end(name)
+            self.loads += 1
+            while len(self._loaded) > 1 and self.loaded_bytes() > self.memory_budget:
+                evicted.append(self._loaded.popitem(last=False)[0])
+            self.evictions += len(evicted)
+        if self.on_evict is not None:
+            for evicted_name in evicted:
+                self.on_evict(evicted_name)
+        return snapshot
+
+    def loaded(self):
+        """(name, snapshot) of every shard in memory."""
+        with self._lock:
+            return list(self._loaded.items())
+
+    def loaded_bytes(self):
+        return sum(self.shards[name].bytes for name in self._loaded)
+
+    def shards_of(self, bathroom_id):
+        """Names of the shards holding a bathroom id, from the manifest."""
+        return self._id_shards.get(bathroom_id, [])
+
+    def stats(self):
+        with self._lock:
+            return {
+                "version": self.version,
+                "shards": len(self.shards),
+                "loaded": list(self._loaded),
+                "loaded_bytes": self.loaded_bytes(),
+                "memory_budget": self.memory_budget,
+                "loads": self.loads,
+                "evictions": self.evictions,
+            }
+
+
+def default_manifest_path(data_dir):
+    return os.path.join(data_dir, 'shards', MANIFEST_NAME)
+
@@ -0,0 +1,127 @@
+import os
+import threading
+
+from columnar import BathroomColumns
+from dataset_store import open_dataset
+from filter_index import FilterIndex
+from records import RecordFragments, compact_records
+from spatial import GridIndex
+
+
+class DatasetSnapshot:
+    """The dataset plus everything derived from it, never mutated once built.
+
+    Requests grab one snapshot and use it throughout, so a reload can't
+    hand them a mix of old and new structures.
+    """
+
+    def __init__(self, bathrooms, version, stamp=None):
+        if isinstance(bathrooms, list):
+            # slotted records with shared values instead of a dict each
+            bathrooms = compact_records(bathrooms)
+        self.bathrooms = bathrooms
+        self.version = version
+        self.stamp = stamp
+        # stores (BathroomStore and the like) hand over their arrays as-is
+        if hasattr(bathrooms, 'column'):
+            self.columns = BathroomColumns.from_store(bathrooms)
+        else:
+            self.columns = BathroomColumns(bathrooms)
+        self.index = GridIndex(self.columns)
+        self.filter_index = FilterIndex(self.columns)
+        self.fragments = RecordFragments(bathrooms)
+
+
+def file_stamp(path):
+    st = os.stat(path)
+    return (st.st_mtime_ns, st.st_size)
+
+
+class SnapshotManager:
+    """Holds the current DatasetSnapshot and swaps in rebuilt ones.
+
+    Rebuilds happen on the polling thread or the reload caller, never on
+    the request path; the swap itself is a single reference assignment.
+    """
+
+    def __init__(self, path, on_swap=None):
+        self.path = path
+        self.on_swap = on_swap
+        self._build_lock = threading.Lock()
+        self._poller = None
+        self._poll_interval = None
+        self._stop_polling = None
+        self.last_error = None
+        stamp = file_stamp(path)
+        self._current = DatasetSnapshot(self._read(), 1, stamp)
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        # forked workers keep the parent's snapshot (shared copy-on-write)
+        # but need their own lock and poller thread
+        self._build_lock = threading.Lock()
+        if self._poller is not None:
+            self._poller = None
+            self.start_polling(self._poll_interval)
+
+    @property
+    def current(self):
+        return self._current
+
+    def _read(self):
+        return open_dataset(self.path)
+
+    def reload(self, force=False):
+        """Rebuild if the file changed (or force); returns the current snapshot."""
+        with self._build_lock:
+            old = self._current
+            stamp = file_stamp(self.path)
+            if not force and stamp == old.stamp:
+                return old
+            try:
+                new = DatasetSnapshot(self._read(), old.version + 1, stamp)
+            except (ValueError, OSError) as e:
+                # most likely a script is still writing the file; keep
+                # serving the old snapshot and try again on the next poll
+                self.last_error = str(e)
+                return old
+            self.last_error = None
+            self._current = new
+        if self.on_swap is not None:
+            self.on_swap(old, new)
+        return new
+
+    def install(self, bathrooms):
+        """Swap in an in-memory dataset in place of the file's contents.
+
+        It stays current until the file itself changes or reload(force=True).
+        """
+        with self._build_lock:
+            old = self._current
+            new = DatasetSnapshot(bathrooms, old.version + 1, old.stamp)
+            self._current = new
+        if self.on_swap is not None:
+            self.on_swap(old, new)
+        return new
+
+    def start_polling(self, interval=2.0):
+        if self._poller is not None:
+            return
+        self._poll_interval = interval
+        stop = self._stop_polling = threading.Event()
+
+        def poll():
+            while not stop.wait(interval):
+                try:
+                    self.reload()
+                except OSError as e:
+                    self.last_error = str(e)
+
+        self._poller = threading.Thread(target=poll, name='dataset-poller', daemon=True)
+        self._poller.start()
+
+    def stop_polling(self):
+        # whoever stops it calls reload() itself from then on
+        if self._poller is not None:
+            self._stop_polling.set()
+            self._poller = None
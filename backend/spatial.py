@@ -0,0 +1,65 @@
+import numpy as np
+
+DEFAULT_CELL_SIZE = 0.01  # degrees, roughly 1km
+
+
+class GridIndex:
+    """Uniform lat/lon grid over the rows of a BathroomColumns.
+
+    Distances are in degrees, the same unit `simple_distance` uses.
+    """
+
+    def __init__(self, columns, cell_size=DEFAULT_CELL_SIZE):
+        self.cell_size = cell_size
+        self.lat = columns.lat
+        self.lon = columns.lon
+        rows = np.flatnonzero(~np.isnan(self.lat))
+        cell_lat = np.floor(self.lat[rows] / cell_size).astype(np.int64)
+        cell_lon = np.floor(self.lon[rows] / cell_size).astype(np.int64)
+        # rows grouped by cell; each cell is a slice of self.order
+        order = np.lexsort((rows, cell_lon, cell_lat))
+        self.order = rows[order]
+        cell_lat, cell_lon = cell_lat[order], cell_lon[order]
+        self.cells = {}
+        if len(self.order):
+            starts = np.flatnonzero(np.r_[True, (np.diff(cell_lat) != 0) | (np.diff(cell_lon) != 0)])
+            ends = np.r_[starts[1:], len(self.order)]
+            for start, end in zip(starts.tolist(), ends.tolist()):
+                self.cells[(int(cell_lat[start]), int(cell_lon[start]))] = (start, end)
+            self.bbox = (float(self.lat[rows].min()), float(self.lat[rows].max()),
+                         float(self.lon[rows].min()), float(self.lon[rows].max()))
+        else:
+            self.bbox = None
+
+    def _cell(self, lat, lon):
+        return (int(np.floor(lat / self.cell_size)), int(np.floor(lon / self.cell_size)))
+
+    def max_distance(self, lat, lon):
+        # distance to the farthest corner of the indexed area
+        if self.bbox is None:
+            return 0.0
+        lat_min, lat_max, lon_min, lon_max = self.bbox
+        return max(abs(lat - lat_min), abs(lat - lat_max)) + max(abs(lon - lon_min), abs(lon - lon_max))
+
+    def query_ring(self, lat, lon, inner, outer):
+        """Return sorted rows with inner < distance <= outer."""
+        if outer < 0 or not self.cells:
+            return np.empty(0, dtype=np.int64)
+        clat, clon = self._cell(lat, lon)
+        span = int(np.ceil(outer / self.cell_size))
+        if (2 * span + 1) ** 2 > len(self.cells):
+            # radius covers more cells than are populated, walk those instead
+            slices = [s for k, s in self.cells.items()
+                      if abs(k[0] - clat) <= span and abs(k[1] - clon) <= span]
+        else:
+            slices = [self.cells[key] for key in (
+                (clat + i, clon + j)
+                for i in range(-span, span + 1)
+                for j in range(-span, span + 1)) if key in self.cells]
+        if not slices:
+            return np.empty(0, dtype=np.int64)
+        rows = np.concatenate([self.order[start:end] for start, end in slices])
+        dist = np.sqrt((lat - self.lat[rows]) ** 2 + (lon - self.lon[rows]) ** 2)
+        rows = rows[(dist > inner) & (dist <= outer)]
+        rows.sort()
+        return rows
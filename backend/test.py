@@ -1,10 +1,11 @@
-import os, json
+import os
+from dataset_store import default_data_path, load_dataset
+from evaluate import precision_at_k
 from ranking import rank_bathrooms, simple_distance
 import time
 
 BASE_DIR = os.path.dirname(__file__)
-with open(os.path.join(BASE_DIR, 'data', 'bathrooms.json')) as f:
-    bathrooms = json.load(f)
+bathrooms = load_dataset(default_data_path(os.path.join(BASE_DIR, 'data')))
 
 
 def run_example(example_name, user_context):
@@ -22,15 +23,6 @@ def run_example(example_name, user_context):
     print(f"\nLatency: {latency:.2f} ms")
     return results
 
-def precision_at_k(results, required_feature):
-    relevant = 0
-
-    for b in results:
-        if required_feature in b.get("amenities", []):
-            relevant += 1
-
-    return relevant / len(results) if results else 0
-
 # context1 = {
 #     "preferences": ["baby_changing"],
 #     "time": "14:30",
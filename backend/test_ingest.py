@@ -0,0 +1,112 @@
+import json
+import os
+import sys
+import threading
+import types
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'scripts'))
+import ingest_refuge  # noqa: E402
+from changelog import changelog_path  # noqa: E402
+
+PER_PAGE = 2
+PAGES = 3
+
+
+def refuge_item(external_id, updated_at='2024-01-01'):
+    # far enough apart that dedup never merges two of them
+    return {'id': external_id, 'name': f'Restroom {external_id}', 'latitude': 33.0 + external_id * 0.01,
+            'longitude': -117.0, 'accessible': True, 'updated_at': updated_at}
+
+
+class StandIn:
+    """Local stand-in for the Refuge API's paged restroom listing."""
+
+    def __init__(self):
+        self.items = [refuge_item(i) for i in range(PER_PAGE * PAGES)]
+        self.fail_page = None
+        self.requested = []
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                query = parse_qs(urlparse(self.path).query)
+                page, per_page = int(query['page'][0]), int(query['per_page'][0])
+                stand_in.requested.append(page)
+                if page == stand_in.fail_page:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                body = json.dumps(stand_in.items[(page - 1) * per_page:page * per_page]).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+
+
+@pytest.fixture
+def stand_in():
+    server = StandIn()
+    yield server
+    server.server.shutdown()
+
+
+def run(stand_in, data_file):
+    args = types.SimpleNamespace(per_page=PER_PAGE, base_url=stand_in.url, max_pages=0, dry_run=False,
+                                 checkpoint_every=1, dedup_radius_m=ingest_refuge.DEFAULT_RADIUS_M)
+    # one request at a time, so the pages are fetched in order
+    ingest_refuge.run_incremental(args, data_file, dict(concurrency=1, rate=0, retries=0, base_url=stand_in.url))
+
+
+def ids_by_external(data_file):
+    with open(data_file, encoding='utf-8') as f:
+        return {entry['source']['external_id']: entry['id'] for entry in json.load(f) if entry.get('source')}
+
+
+def test_incremental_ingest_resumes_and_keeps_ids(stand_in, tmp_path):
+    data_file = str(tmp_path / 'bathrooms.json')
+    with open(data_file, 'w', encoding='utf-8') as f:
+        json.dump([{'id': 'local', 'name': 'Local Restroom', 'location': [34.5, -118.0]}], f)
+    checkpoint_file = str(tmp_path / 'ingest_checkpoint.json')
+
+    stand_in.fail_page = PAGES
+    with pytest.raises(Exception):
+        run(stand_in, data_file)
+    with open(checkpoint_file, encoding='utf-8') as f:
+        checkpoint = json.load(f)
+    assert checkpoint['last_page'] == PAGES - 1 and not checkpoint['completed']
+    assert len(checkpoint['pending']) == PER_PAGE * (PAGES - 1)
+    # checkpoints don't write the dataset
+    assert list(ids_by_external(data_file)) == []
+    assert not os.path.exists(changelog_path(data_file))
+
+    stand_in.fail_page = None
+    stand_in.requested.clear()
+    run(stand_in, data_file)
+    assert min(stand_in.requested) == PAGES
+    ids = ids_by_external(data_file)
+    assert sorted(ids) == list(range(PER_PAGE * PAGES))
+    # records from the pages before the failure keep the ids they were given then
+    assert {entry['source']['external_id']: entry['id'] for entry in checkpoint['pending']}.items() <= ids.items()
+
+    # a completed run starts over; upstream changes update records in place
+    stand_in.items[0] = refuge_item(0, updated_at='2024-02-01')
+    stand_in.requested.clear()
+    run(stand_in, data_file)
+    assert min(stand_in.requested) == 1
+    assert ids_by_external(data_file) == ids
+    with open(data_file, encoding='utf-8') as f:
+        records = json.load(f)
+    assert len(records) == PER_PAGE * PAGES + 1
+    assert next(r for r in records if r['id'] == ids[0])['source']['updated_at'] == '2024-02-01'
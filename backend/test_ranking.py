@@ -0,0 +1,94 @@
+import os
+import random
+
+import numpy as np
+import pytest
+
+from columnar import rank_nearby
+from dataset_store import default_data_path, load_dataset
+from hours import minute_of_week
+from ranking import KM_PER_DEGREE, distance_weight, rank_bathrooms, score_bathroom
+from snapshot import DatasetSnapshot
+from tiles import TileSet, rank_from_tiles
+
+BASE_DIR = os.path.dirname(__file__)
+QUERIES = 200
+TOP_K = 10
+
+
+@pytest.fixture(scope='module')
+def snapshot():
+    return DatasetSnapshot(load_dataset(default_data_path(os.path.join(BASE_DIR, 'data'))), 1)
+
+
+def contexts(snapshot, seed):
+    # around random bathrooms, at random times, some with a visit history
+    rng = random.Random(seed)
+    columns = snapshot.columns
+    for i in range(QUERIES):
+        row = int(rng.choice(columns.located))
+        context = {
+            'location': [float(columns.lat[row]) + rng.uniform(-0.02, 0.02),
+                         float(columns.lon[row]) + rng.uniform(-0.02, 0.02)],
+            'urgency': rng.choice(['low', 'normal', 'high']),
+            'day': rng.randrange(7),
+            'time': '%02d:%02d' % (rng.randrange(24), rng.randrange(60)),
+        }
+        history = {columns.ids[int(rng.choice(columns.located))]: 2.0} if i % 4 == 0 else {}
+        yield context, history
+
+
+def full_scan(snapshot, context, history, rows=None):
+    """Row ids of the top_k by scoring every given (default: located) row."""
+    columns = snapshot.columns
+    rows = columns.located if rows is None else rows
+    scores = columns.score(context, history, rows)
+    # ties go to the earlier row, as in rank_bathrooms
+    order = np.lexsort((rows, -scores))[:TOP_K]
+    return rows[order].tolist()
+
+
+def test_columnar_scores_match_rank_bathrooms(snapshot):
+    columns = snapshot.columns
+    located = [snapshot.bathrooms[row] for row in columns.located]
+    for context, history in contexts(snapshot, 1):
+        minute = minute_of_week(context['time'], context['day'])
+        weight = distance_weight(context['urgency'])
+        expected = [score_bathroom(b, context, history, minute, weight)
+                    for b in rank_bathrooms(located, context, history, TOP_K)]
+        rows = np.array(full_scan(snapshot, context, history))
+        order = np.argsort(rows)
+        got = np.empty(len(rows))
+        got[order] = columns.score(context, history, rows[order])
+        assert np.allclose(got, expected)
+
+
+def test_rank_nearby_matches_full_scan(snapshot):
+    columns = snapshot.columns
+    for context, history in contexts(snapshot, 2):
+        rows = rank_nearby(columns, snapshot.index, context, history, TOP_K)
+        assert rows.tolist() == full_scan(snapshot, context, history)
+
+
+def test_rank_nearby_matches_full_scan_with_filters_and_radius(snapshot):
+    columns = snapshot.columns
+    for i, (context, history) in enumerate(contexts(snapshot, 3)):
+        context['filters'] = {'amenities': ['wheelchair']} if i % 2 else {}
+        context['max_radius_km'] = [0.5, 2, 10][i % 3]
+        candidates = snapshot.filter_index.resolve(context['filters'])
+        rows = columns.located if candidates is None else np.intersect1d(candidates, columns.located)
+        lat, lon = context['location']
+        dist = np.sqrt((columns.lat[rows] - lat) ** 2 + (columns.lon[rows] - lon) ** 2)
+        rows = rows[dist <= context['max_radius_km'] / KM_PER_DEGREE]
+        found = rank_nearby(columns, snapshot.index, context, history, TOP_K, candidates)
+        assert found.tolist() == full_scan(snapshot, context, history, rows)
+
+
+def test_tiles_match_full_scan(snapshot):
+    columns = snapshot.columns
+    tiles = TileSet(columns, snapshot.index, snapshot.version, top_k=TOP_K)
+    for context, history in contexts(snapshot, 4):
+        rows = rank_from_tiles(tiles, columns, context, history, TOP_K)
+        if rows is not None:
+            assert rows.tolist() == full_scan(snapshot, context, history)
+    assert tiles.builds
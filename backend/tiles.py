@@ -0,0 +1,362 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from columnar import top_k_positions
+from hours import MINUTES_PER_WEEK, minute_of_week
+from ranking import (
+    CLEANLINESS_SCORE, DISTANCE_SCORE_FACTOR, MAX_DISTANCE_SCORE, OPEN_SCORE,
+    SAFETY_SCORE, distance_weight,
+)
+
+TILE_CELL_SIZE = 0.01  # degrees, roughly 1km
+HOURS_PER_WEEK = MINUTES_PER_WEEK // 60
+URGENCY_WEIGHTS = (distance_weight('low'), distance_weight('normal'), distance_weight('high'))
+# tiles with more candidates than this aren't worth storing; ranking
+# falls back to the spatial search there
+MAX_TILE_CANDIDATES = 256
+MAX_TILES = 200000
+# rebasing checks every changed row against every tile; past this many
+# checks the tiles are dropped and rebuilt on demand instead
+REBASE_LIMIT = 50000000
+# slack for float rounding between the bounds and the exact scores
+EPS = 1e-6
+
+
+def row_signature(columns):
+    """Per-row values the tiles depend on, comparable across snapshots."""
+    static = (columns.cleanliness * CLEANLINESS_SCORE + columns.safety * SAFETY_SCORE
+              + columns.crowd_points[columns.crowd_code])
+    schedule_hash = np.array([hash(s) for s in columns.schedules], dtype=np.int64)
+    return {
+        'lat': np.asarray(columns.lat, dtype=np.float64),
+        'lon': np.asarray(columns.lon, dtype=np.float64),
+        'static': static,
+        'schedule': schedule_hash[columns.schedule_id] if len(schedule_hash) else
+        np.zeros(len(columns), dtype=np.int64),
+    }
+
+
+def hourly_open(columns):
+    """(hours, schedules) flags: open at some minute / every minute of the hour."""
+    starts = np.arange(HOURS_PER_WEEK)[:, None] * 60
+    start, end, owner = columns.schedule_start, columns.schedule_end, columns.schedule_owner
+    any_open = np.zeros((HOURS_PER_WEEK, len(columns.schedules)), dtype=bool)
+    all_open = np.zeros_like(any_open)
+    hour, interval = np.nonzero((start < starts + 60) & (end > starts))
+    any_open[hour, owner[interval]] = True
+    # intervals are merged, so full coverage means one interval covers it
+    hour, interval = np.nonzero((start <= starts) & (end >= starts + 60))
+    all_open[hour, owner[interval]] = True
+    return any_open, all_open
+
+
+class TileSet:
+    """Candidate rows per (grid cell, hour of week, urgency) for unfiltered ranking.
+
+    For every row the score anywhere in the cell during the hour lies
+    between a lower bound (closed if it closes at all, farthest corner)
+    and an upper bound (open if it opens at all, nearest point). With tau
+    the k-th largest lower bound, rows whose upper bound is below tau can
+    never make the top k, so a tile keeps only the others and a request
+    re-ranks just those exactly. Tiles are built on first use (or all at
+    once by scripts/build_tiles.py) and kept in a bounded LRU.
+    """
+
+    def __init__(self, columns, index, version=None, top_k=10, cell_size=TILE_CELL_SIZE,
+                 max_candidates=MAX_TILE_CANDIDATES, max_tiles=MAX_TILES):
+        self.columns = columns
+        self.index = index
+        self.version = version
+        self.top_k = top_k
+        self.cell_size = cell_size
+        self.max_candidates = max_candidates
+        self.max_tiles = max_tiles
+        self.signature = row_signature(columns)
+        self.any_open, self.all_open = hourly_open(columns)
+        # (cell_lat, cell_lon, hour, weight) -> (sorted rows, tau), rows is
+        # None where the tile had too many candidates
+        self.tiles = OrderedDict()
+        self._prefixes = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.builds = 0
+
+    def __len__(self):
+        return len(self.tiles)
+
+    def key(self, user_context):
+        lat, lng = user_context['location']
+        minute = minute_of_week(user_context.get('time'), user_context.get('day'))
+        return (int(np.floor(lat / self.cell_size)), int(np.floor(lng / self.cell_size)),
+                minute // 60, distance_weight(user_context.get('urgency', 'normal')))
+
+    def _hour_prefix(self, hour):
+        # the rows with the highest location independent upper and lower
+        # bounds this hour; tiles only ever look this far down the list
+        prefix = self._prefixes.get(hour)
+        if prefix is None:
+            columns = self.columns
+            rows = columns.located
+            static = self.signature['static'][rows]
+            schedule = columns.schedule_id[rows]
+            size = min(len(rows), self.max_candidates + self.top_k)
+            prefix = []
+            for flags in (self.any_open[hour], self.all_open[hour]):
+                values = static + flags[schedule] * float(OPEN_SCORE)
+                top = np.argpartition(-values, size - 1)[:size] if size < len(rows) else np.arange(len(rows))
+                top = top[np.argsort(-values[top], kind='stable')]
+                prefix.append((rows[top], values[top]))
+            self._prefixes[hour] = prefix
+        return prefix
+
+    def build(self, cell_lat, cell_lon, hour, weight):
+        """(sorted candidate rows or None, tau) for one tile."""
+        columns = self.columns
+        size = self.cell_size
+        lat0, lon0 = cell_lat * size, cell_lon * size
+        lat1, lon1 = lat0 + size, lon0 + size
+        reach = MAX_DISTANCE_SCORE / (DISTANCE_SCORE_FACTOR * weight)
+        # rows that can get a distance score somewhere in the cell
+        near = self.index.query_ring(lat0 + size / 2, lon0 + size / 2, -1.0, size + reach)
+        lat, lon = columns.lat[near], columns.lon[near]
+        dlat = np.maximum(np.maximum(lat0 - lat, lat - lat1), 0)
+        dlon = np.maximum(np.maximum(lon0 - lon, lon - lon1), 0)
+        nearest = np.sqrt(dlat ** 2 + dlon ** 2)
+        keep = nearest < reach
+        near, lat, lon, nearest = near[keep], lat[keep], lon[keep], nearest[keep]
+        farthest = np.sqrt(np.maximum(np.abs(lat - lat0), np.abs(lat - lat1)) ** 2
+                           + np.maximum(np.abs(lon - lon0), np.abs(lon - lon1)) ** 2)
+        static = self.signature['static'][near]
+        schedule = columns.schedule_id[near]
+        factor = DISTANCE_SCORE_FACTOR * weight
+        upper = (self.any_open[hour][schedule] * float(OPEN_SCORE) + static
+                 + np.maximum(0, MAX_DISTANCE_SCORE - nearest * factor))
+        lower = (self.all_open[hour][schedule] * float(OPEN_SCORE) + static
+                 + np.maximum(0, MAX_DISTANCE_SCORE - farthest * factor))
+
+        (upper_rows, upper_values), (lower_rows, lower_values) = self._hour_prefix(hour)
+        far_lower = lower_values[~np.isin(lower_rows, near, assume_unique=True)]
+        # any k distinct rows give a valid tau; the exact k-th may be higher
+        lowers = np.concatenate([lower, far_lower])
+        if len(lowers) >= self.top_k:
+            tau = float(np.partition(lowers, len(lowers) - self.top_k)[len(lowers) - self.top_k]) - EPS
+        else:
+            tau = -np.inf
+
+        far_hit = upper_values >= tau
+        if far_hit.all() and len(upper_rows) < len(columns.located):
+            # rows past the prefix could still qualify
+            return None, tau
+        far_rows = upper_rows[far_hit]
+        far_rows = far_rows[~np.isin(far_rows, near, assume_unique=True)]
+        rows = np.union1d(near[upper >= tau], far_rows)
+        if len(rows) > self.max_candidates:
+            return None, tau
+        return rows.astype(np.int64), tau
+
+    def _store(self, key, tile):
+        with self._lock:
+            self.tiles[key] = tile
+            self.tiles.move_to_end(key)
+            while len(self.tiles) > self.max_tiles:
+                self.tiles.popitem(last=False)
+
+    def lookup(self, user_context):
+        """The tile for this context, building it on a miss."""
+        key = self.key(user_context)
+        with self._lock:
+            tile = self.tiles.get(key)
+            if tile is not None:
+                self.tiles.move_to_end(key)
+                self.hits += 1
+                return tile
+        tile = self.build(*key)
+        self.builds += 1
+        self._store(key, tile)
+        return tile
+
+    def populated_cells(self):
+        rows = self.columns.located
+        cells = np.stack([np.floor(self.columns.lat[rows] / self.cell_size),
+                          np.floor(self.columns.lon[rows] / self.cell_size)], axis=1).astype(np.int64)
+        return [tuple(c) for c in np.unique(cells, axis=0).tolist()]
+
+    def build_all(self, cells=None, hours=range(HOURS_PER_WEEK), weights=URGENCY_WEIGHTS,
+                  skip_existing=True, progress=None):
+        """Build every tile of the given (default: populated) cells.
+
+        Returns the number of tiles built; with skip_existing, tiles kept
+        by a rebase are left alone so only the changed ones are rebuilt.
+        """
+        cells = self.populated_cells() if cells is None else cells
+        built = 0
+        for i, (cell_lat, cell_lon) in enumerate(cells):
+            for weight in weights:
+                for hour in hours:
+                    key = (cell_lat, cell_lon, hour, weight)
+                    if skip_existing and key in self.tiles:
+                        continue
+                    self._store(key, self.build(*key))
+                    built += 1
+            if progress is not None:
+                progress(i + 1, len(cells))
+        return built
+
+    def rebase(self, columns, index, version=None):
+        """A TileSet for new columns, keeping every tile the change can't affect.
+
+        Rows are matched by id. A tile is dropped if one of its candidates
+        was removed or changed; rows that are new or changed are added to
+        the tiles they could now reach, which keeps every tile exact.
+        """
+        new = TileSet(columns, index, version, self.top_k, self.cell_size,
+                      self.max_candidates, self.max_tiles)
+        with self._lock:
+            tiles = list(self.tiles.items())
+        if not tiles:
+            return new
+        remap = _match_rows(self.ids, self.signature, columns, new.signature)
+        changed = np.ones(len(columns), dtype=bool)
+        changed[remap[remap >= 0]] = False
+        changed = np.flatnonzero(changed & ~np.isnan(new.signature['lat']))
+        if len(changed) * len(tiles) > REBASE_LIMIT:
+            return new
+
+        lat, lon = new.signature['lat'][changed], new.signature['lon'][changed]
+        static = new.signature['static'][changed]
+        schedule = columns.schedule_id[changed]
+        size = self.cell_size
+        for (cell_lat, cell_lon, hour, weight), (rows, tau) in tiles:
+            if rows is None:
+                continue
+            rows = remap[rows]
+            if (rows < 0).any():
+                continue
+            if len(changed):
+                lat0, lon0 = cell_lat * size, cell_lon * size
+                dlat = np.maximum(np.maximum(lat0 - lat, lat - lat0 - size), 0)
+                dlon = np.maximum(np.maximum(lon0 - lon, lon - lon0 - size), 0)
+                upper = (new.any_open[hour][schedule] * float(OPEN_SCORE) + static + np.maximum(
+                    0, MAX_DISTANCE_SCORE - np.sqrt(dlat ** 2 + dlon ** 2) * DISTANCE_SCORE_FACTOR * weight))
+                rows = np.union1d(rows, changed[upper >= tau])
+                if len(rows) > self.max_candidates:
+                    continue
+            new.tiles[(cell_lat, cell_lon, hour, weight)] = (np.sort(rows), tau)
+        return new
+
+    @property
+    def ids(self):
+        return self.columns.ids
+
+    def save(self, path):
+        """Write the built tiles plus the row ids/signature they were built on."""
+        with self._lock:
+            tiles = [(key, tile) for key, tile in self.tiles.items() if tile[0] is not None]
+        rows = [tile[0] for _, tile in tiles]
+        offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(r) for r in rows])
+        np.savez_compressed(
+            path,
+            keys=np.array([key for key, _ in tiles], dtype=np.float64).reshape(-1, 4),
+            tau=np.array([tile[1] for _, tile in tiles], dtype=np.float64),
+            offsets=offsets,
+            rows=np.concatenate(rows).astype(np.int64) if rows else np.empty(0, dtype=np.int64),
+            ids=np.array([_id_key(i) for i in self.ids]),
+            top_k=self.top_k,
+            cell_size=self.cell_size,
+            **{f'sig_{name}': values for name, values in self.signature.items()},
+        )
+
+    @classmethod
+    def load(cls, path, columns, index, version=None, **options):
+        """Tiles from `path`, rebased onto `columns` if the dataset changed since."""
+        with np.load(path) as saved:
+            top_k = int(saved['top_k'])
+            cell_size = float(saved['cell_size'])
+            stored = _StoredTiles(
+                [str(i) for i in saved['ids']],
+                {name: saved[f'sig_{name}'] for name in ('lat', 'lon', 'static', 'schedule')})
+            keys, tau, offsets, rows = saved['keys'], saved['tau'], saved['offsets'], saved['rows']
+            for i, (cell_lat, cell_lon, hour, weight) in enumerate(keys.tolist()):
+                stored.tiles[(int(cell_lat), int(cell_lon), int(hour), weight)] = (
+                    rows[offsets[i]:offsets[i + 1]], float(tau[i]))
+        options.setdefault('top_k', top_k)
+        options.setdefault('cell_size', cell_size)
+        if options['top_k'] != top_k or options['cell_size'] != cell_size:
+            return cls(columns, index, version, **options)
+        stored.top_k, stored.cell_size = top_k, cell_size
+        stored.max_candidates = options.get('max_candidates', MAX_TILE_CANDIDATES)
+        stored.max_tiles = options.get('max_tiles', MAX_TILES)
+        return TileSet.rebase(stored, columns, index, version)
+
+
+class _StoredTiles:
+    # just enough of a TileSet for rebase(): tiles plus the ids/signature
+    # of the rows they were built on
+
+    def __init__(self, ids, signature):
+        self.ids = ids
+        self.signature = signature
+        self.tiles = OrderedDict()
+        self._lock = threading.Lock()
+
+
+def _id_key(bathroom_id):
+    # stores keep a missing id as ''
+    return '' if bathroom_id is None else str(bathroom_id)
+
+
+def _match_rows(old_ids, old_signature, columns, new_signature):
+    """Array mapping old rows to new rows with the same id and values, else -1."""
+    remap = np.full(len(old_ids), -1, dtype=np.int64)
+    id_rows = {}
+    for row, bathroom_id in enumerate(columns.ids):
+        id_rows.setdefault(_id_key(bathroom_id), []).append(row)
+    # the n-th old row with an id pairs with the n-th new one
+    seen = {}
+    candidate = np.full(len(old_ids), -1, dtype=np.int64)
+    for row, bathroom_id in enumerate(old_ids):
+        bathroom_id = _id_key(bathroom_id)
+        rows = id_rows.get(bathroom_id, ())
+        n = seen.get(bathroom_id, 0)
+        seen[bathroom_id] = n + 1
+        if n < len(rows):
+            candidate[row] = rows[n]
+    matched = candidate >= 0
+    target = candidate[matched]
+    same = np.ones(len(target), dtype=bool)
+    for name in ('lat', 'lon', 'static', 'schedule'):
+        same &= old_signature[name][matched] == new_signature[name][target]
+    remap[np.flatnonzero(matched)[same]] = target[same]
+    return remap
+
+
+def rank_from_tiles(tiles, columns, user_context, user_history, top_k=10, crowd=None, ratings=None):
+    """Rank an unfiltered request from its tile, or None if it can't be.
+
+    Rows in the user's history, with a live crowd level or with live
+    ratings above the dataset's can score above their bound, so they're
+    always re-ranked with the tile's candidates.
+    """
+    if top_k > tiles.top_k:
+        return None
+    rows, tau = tiles.lookup(user_context)
+    if rows is None:
+        return None
+    if user_history:
+        extra = [row for bathroom_id in user_history for row in columns.id_rows.get(bathroom_id, ())]
+        if extra:
+            extra = np.array(extra, dtype=np.int64)
+            rows = np.union1d(rows, extra[~np.isnan(columns.lat[extra])])
+    if crowd is not None and len(crowd):
+        rows = np.union1d(rows, crowd.rows[~np.isnan(columns.lat[crowd.rows])])
+    if ratings is not None and len(ratings.raised):
+        rows = np.union1d(rows, ratings.raised[~np.isnan(columns.lat[ratings.raised])])
+    scores = columns.score(user_context, user_history, rows, crowd, ratings)
+    positions = top_k_positions(scores, rows, top_k)
+    if len(positions) < min(top_k, len(columns.located)) or (len(positions) and scores[positions[-1]] < tau):
+        # can't happen for a tile matching the data; better safe than wrong
+        return None
+    return rows[positions]